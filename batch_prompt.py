@@ -1,12 +1,11 @@
+#!/usr/bin/env python
 """
-Batch Prompting: This technique involves generating multiple outputs from
-different, same or slightly varied prompts, often repeated over a large number
-of inputs (e.g., 100 or more). 
-
-For same inputs, the goal is to explore the range of possible responses the AI
-can generate. By collecting a broad set of responses, patterns can be analyzed,
-or the most relevant or creative outputs can be selected. This technique is
-particularly useful for tasks like brainstorming, where diversity of ideas is
-valued, or for fine-tuning the AI by identifying and addressing common errors
-or biases across a large sample size.
+Batch Prompting: generate many outputs per input, from repeated runs of the
+same prompt or from prompt variants; see `metaprompt/batch_prompt.py` for the
+arguments. Also installed as the `metaprompt-batch` command.
 """
+import sys
+from metaprompt.batch_prompt import main
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+"""
+Offline benchmark of the `apply.py` pipeline.
+
+Generates synthetic corpora and runs `apply.py --yes` over them with the
+`fake_core.py` core, so no network access is needed. For every corpus size it
+reports:
+
+- files per second over the whole run
+- checkpoint cost per file, from the `checkpoint` phase of the `--trace`
+- discovery time inside the run, and `utils.expand_folders` time in process
+- peak resident memory of the run
+
+Latency, response length, failures and throttling of the fake model are set
+with `--latency`, `--jitter`, `--tokens`, `--failure_rate`, `--throttle_rate`
+and `--quota`. Failed requests are retried by `apply.py`; a file that still
+fails is counted as failed.
+
+    python benchmarks/bench_apply.py --sizes 10 100 1000 --concurrency 8
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+repo = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, repo)
+from metaprompt import utils
+
+def make_corpus(root:str, n_files:int, file_bytes:int=512,
+                per_folder:int=1000)->str:
+    """
+    Write `n_files` text files of about `file_bytes` each under `root`, at most
+    `per_folder` to a folder. Returns the corpus folder.
+    """
+    corpus = os.path.join(root, 'corpus')
+    line = "The quick brown fox jumps over the lazy dog. "
+    for i in range(n_files):
+        folder = os.path.join(corpus, f"part{i // per_folder:04d}")
+        if i % per_folder == 0:
+            os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, f"doc{i:06d}.txt"), 'w') as f:
+            f.write(f"Document {i}\n"
+                    + (line * (file_bytes // len(line) + 1))[:file_bytes])
+    return corpus
+
+def fake_env(args)->dict:
+    env = dict(os.environ,
+               METAPROMPT_FAKE_LATENCY=str(args.latency),
+               METAPROMPT_FAKE_JITTER=str(args.jitter),
+               METAPROMPT_FAKE_TOKENS=str(args.tokens),
+               METAPROMPT_FAKE_FAILURE_RATE=str(args.failure_rate),
+               METAPROMPT_FAKE_THROTTLE_RATE=str(args.throttle_rate),
+               METAPROMPT_FAKE_QUOTA=str(args.quota or ''),
+               METAPROMPT_FAKE_SEED=str(args.seed))
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [repo, env.get('PYTHONPATH')]))
+    return env
+
+def run_apply(workdir:str, corpus:str, args, extra=())->dict:
+    """
+    Run `apply.py` over the corpus in `workdir`. Returns the wall time, the
+    peak resident memory in MiB and the parsed trace.
+    """
+    trace = os.path.join(workdir, 'trace.jsonl')
+    command = [sys.executable, os.path.join(repo, 'apply.py'), corpus,
+               'fake_core.py', '--prompt', 'Summarize this document.', '--yes',
+               '--quiet_resume', '--no-cache', '--sort', 'forward',
+               '--concurrency', str(args.concurrency), '--trace', trace,
+               *extra]
+    with open(os.path.join(workdir, 'apply.log'), 'w') as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, cwd=workdir, env=fake_env(args),
+                                   stdout=log, stderr=subprocess.STDOUT)
+        _, status, rusage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+    if status != 0:
+        raise RuntimeError(f"apply.py failed, see {workdir}/apply.log")
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak = rusage.ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10)
+    with open(trace) as f:
+        events = [json.loads(line) for line in f]
+    return {'wall': wall, 'peak_mb': peak, 'events': events}
+
+def phase_seconds(events:list, name:str)->float:
+    return sum(e['seconds'] for e in events
+               if e['event'] == 'phase' and e['name'] == name)
+
+def time_expand_folders(corpus:str, repeat:int=3)->float:
+    """
+    Best of `repeat` in-process walks of the corpus with `expand_folders`.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        utils.expand_folders([corpus], sort='forward')
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def bench(n_files:int, args)->dict:
+    workdir = tempfile.mkdtemp(prefix=f"metaprompt-bench-{n_files}-")
+    try:
+        corpus = make_corpus(workdir, n_files, args.file_bytes)
+        run = run_apply(workdir, corpus, args)
+        events = run['events']
+        files = sum(e['event'] == 'file' for e in events)
+        checkpoint = phase_seconds(events, 'checkpoint')
+        return {'files': n_files, 'processed': files,
+                'requests': sum(e['event'] == 'request' for e in events),
+                'wall_s': run['wall'],
+                'files_per_s': files / run['wall'] if run['wall'] else 0,
+                'checkpoint_ms_per_file': 1e3 * checkpoint / files if files else 0,
+                'discovery_s': phase_seconds(events, 'discovery'),
+                'expand_folders_s': time_expand_folders(corpus),
+                'peak_mb': run['peak_mb']}
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+COLUMNS = [('files', 'files', '{:>8}'), ('processed', 'processed', '{:>10}'),
+           ('wall_s', 'wall s', '{:>9.2f}'), ('files_per_s', 'files/s', '{:>10.1f}'),
+           ('checkpoint_ms_per_file', 'ckpt ms/file', '{:>14.3f}'),
+           ('discovery_s', 'discovery s', '{:>13.3f}'),
+           ('expand_folders_s', 'expand s', '{:>10.3f}'),
+           ('peak_mb', 'peak MB', '{:>9.1f}')]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark apply.py offline with a fake model.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000], help='Corpus sizes, in files')
+    parser.add_argument('--file_bytes', type=int, default=512, help='Size of each synthetic file')
+    parser.add_argument('--concurrency', type=int, default=1, help='Passed on to apply.py')
+    parser.add_argument('--latency', type=float, default=0.0, help='Fake model seconds per request')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Fake model extra random latency')
+    parser.add_argument('--tokens', type=int, default=64, help='Fake model tokens per response')
+    parser.add_argument('--failure_rate', type=float, default=0.0, help='Fake model probability of a 503')
+    parser.add_argument('--throttle_rate', type=float, default=0.0, help='Fake model probability of a 429')
+    parser.add_argument('--quota', type=int, default=None, help='Fake model requests in flight before a 429')
+    parser.add_argument('--seed', type=int, default=0, help='Fake model seed')
+    parser.add_argument('--json', default=None, help='Also write the results to this JSON file')
+    parser.add_argument('--keep', action='store_true', help='Keep the generated corpora and run folders')
+    args = parser.parse_args(argv)
+
+    print("".join(f"{header:>{len(fmt.format(0))}}"
+                  for _, header, fmt in COLUMNS))
+    results = []
+    for n_files in args.sizes:
+        result = bench(n_files, args)
+        results.append(result)
+        print("".join(fmt.format(result[key]) for key, _, fmt in COLUMNS))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'settings': vars(args), 'results': results}, f, indent=2)
+    return results
+
+if __name__ == '__main__':
+    main()
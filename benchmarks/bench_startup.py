@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""
+Cold-start benchmark of `apply.py`.
+
+Times fresh interpreters for three fixed costs paid by every invocation:
+
+- `import`: importing `metaprompt.utils`
+- `help`: `apply.py --help`
+- `resume`: a run on the `fake_core.py` core over a small corpus that is
+  already fully checkpointed, so no file is processed
+
+Pass `--repo` more than once to compare checkouts, e.g. before and after a
+change with `git worktree add /tmp/before HEAD~1`:
+
+    python benchmarks/bench_startup.py --repo . --repo /tmp/before
+"""
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+here = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+def timed(command:list, cwd:str, env:dict)->float:
+    start = time.perf_counter()
+    subprocess.run(command, cwd=cwd, env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+def commands(repo:str)->dict:
+    apply = os.path.join(repo, 'apply.py')
+    return {
+        'import': [sys.executable, '-c', 'import metaprompt.utils'],
+        'help': [sys.executable, apply, '--help'],
+        'resume': [sys.executable, apply, 'corpus', 'fake_core.py', '--prompt',
+                   'Summarize this document.', '--yes', '--quiet_resume',
+                   '--no-cache'],
+    }
+
+def bench(repo:str, repeat:int=5)->dict:
+    """
+    Median and best seconds of each command for the checkout at `repo`.
+    """
+    repo = os.path.abspath(repo)
+    workdir = tempfile.mkdtemp(prefix="metaprompt-startup-")
+    env = dict(os.environ, PYTHONPATH=repo)
+    try:
+        os.makedirs(os.path.join(workdir, 'corpus'))
+        for i in range(10):
+            with open(os.path.join(workdir, 'corpus', f"doc{i}.txt"), 'w') as f:
+                f.write(f"Document {i}\n")
+        resume = commands(repo)['resume']
+        timed(resume, workdir, env) # checkpoint every file
+        results = {}
+        for name, command in commands(repo).items():
+            times = [timed(command, workdir, env) for _ in range(repeat)]
+            results[name] = (statistics.median(times), min(times))
+        return results
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark apply.py cold start.')
+    parser.add_argument('--repo', action='append', help='Checkout to benchmark (repeatable, default: this one)')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs of each command')
+    args = parser.parse_args(argv)
+
+    print(f"{'repo':<40}{'command':<9}{'median s':>10}{'best s':>9}")
+    for repo in args.repo or [here]:
+        for name, (median, best) in bench(repo, args.repeat).items():
+            print(f"{repo:<40}{name:<9}{median:>10.3f}{best:>9.3f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+import os
+from metaprompt.fake import FakeGenerativeModel
+
+# Offline stand-in for an aistudio core, for benchmarks and tests. Configure
+# the fake model with METAPROMPT_FAKE_* environment variables.
+generation_config = {
+    "temperature": 1,
+    "top_p": 0.95,
+    "top_k": 64,
+    "max_output_tokens": 8192,
+    "response_mime_type": "text/plain",
+}
+
+model = FakeGenerativeModel(
+    model_name="models/fake",
+    generation_config=generation_config,
+    system_instruction="You are a careful technical writer.",
+    latency=float(os.environ.get("METAPROMPT_FAKE_LATENCY", 0)),
+    jitter=float(os.environ.get("METAPROMPT_FAKE_JITTER", 0)),
+    response_tokens=int(os.environ.get("METAPROMPT_FAKE_TOKENS", 64)),
+    failure_rate=float(os.environ.get("METAPROMPT_FAKE_FAILURE_RATE", 0)),
+    throttle_rate=float(os.environ.get("METAPROMPT_FAKE_THROTTLE_RATE", 0)),
+    quota=int(os.environ["METAPROMPT_FAKE_QUOTA"]) if os.environ.get("METAPROMPT_FAKE_QUOTA") else None,
+    seed=int(os.environ.get("METAPROMPT_FAKE_SEED", 0)),
+)
+
+history = [
+    {"role": "user", "parts": ["<content>def add(a, b): return a + b</content>\n<user_request>Write a docstring.</user_request>"]},
+    {"role": "model", "parts": ["Return the sum of `a` and `b`."]},
+]
+
+chat_session = model.start_chat(history=history)
@@ -0,0 +1,570 @@
+"""
+METAPROMPT, google ai studio meta prompting
+
+`apply.py` is a script that applies a prompt to a list of text files.
+The script uses the `google.generativeai` library to generate responses to the
+prompt. The script takes the following arguments:
+
+- `text_files`: A list of text files to process.
+- `core`: The core conversation script to execute from the `./core` folder.
+- `prompt`: The prompt to apply to each file.
+- `append`: A string to append to the output filename.
+- `sink`, `sink_path`, `sink_flush`: Where outputs go: one file per input (`files`, the default), or one record per input in a single JSONL file (`jsonl`) or Parquet dataset (`parquet`, needs `pyarrow`) at `sink_path` (default `outputs/<core>.jsonl` or `.parquet`). Records hold the source path, prompt, turns, output, token counts and timings; files answered in one pack share its counts and time evenly. Bulk sinks are buffered and flushed with the checkpoint every `sink_flush` records, so a crash never leaves them and the checkpoint out of sync.
+- `interact`: A flag to interactively confirm and edit the output.
+- `editor`: The editor to use for interactive mode (default: `nvim`).
+- `persist`: The file location of the checkpoint store (`.sqlite`). An existing `.shelve` checkpoint at the same location, or a store from an older version with pickled turns, is converted on first use; `python -m metaprompt.checkpoint database/` converts them up front.
+- `ignore_checkpoint`: A flag to ignore the checkpoint file.
+- `key_by`: Match files to their checkpoint records by `path` (the default) or by `content`: the SHA-256 of the file with a fingerprint of the core and prompt. By content, edited files and files done with another core or prompt are processed again, and renamed or copied files get the output of the file with the same content without a request.
+- `watch`, `watch_debounce`: After processing the files, keep watching the folders for files created, modified or moved into them, and process them in batches once `watch_debounce` seconds pass without another change. Implies `--key_by content`.
+- `shard`: Process only shard `i` of `N` (`--shard i/N`, 0-based) of the files, assigned by a hash of their path, so the split is the same on every worker and does not move files when others are added. Each shard checkpoints to its own store (e.g. `database/core.shard0-of-4.sqlite`); combine them with `python -m metaprompt.sharding database/core.shard*.sqlite --into database/core.sqlite`.
+- `concurrency`: With `--yes`, the number of files to process at once.
+- `pack_tokens`, `pack_files`: With `--yes`, which `--pack_tokens` requires, send small files together, up to `pack_tokens` estimated tokens and `pack_files` files per request, each in its own tagged block. The answers are split back into one checkpoint entry and output file per file; files whose answer cannot be parsed are sent one by one.
+- `rpm`, `tpm`, `max_retries`: Requests and estimated tokens per minute allowed, and retries of throttled (429) or transient (5xx) failures with jittered exponential backoff. Concurrent requests adapt to throttling: the number in flight halves on a 429 and grows back by one per window of successes, up to `concurrency`.
+- `cache`/`no-cache`: Replay first-turn responses from the on-disk response cache, keyed by core history, model settings, prompt and file content (default: on).
+- `cache_path`, `cache_max_mb`, `cache_max_days`: Location and eviction limits of the response cache.
+- `prefix_cache`, `prefix_cache_ttl`, `prefix_cache_path`: Register the core history and system instruction once as a server-side context cache, and send requests against it instead of resending them. The cache is kept across runs, its TTL is extended during long runs, and it is replaced when the core script changes. The prompt tokens served from the cache are reported at the end.
+- `stream`: Render responses chunk by chunk as they are generated, writing them straight to the output file, and report time to first token.
+- `include`, `exclude`, `max_bytes`, `binary`, `encoding`, `no_ignore_files`: Filters applied while walking folders; `.git` and the like, files ignored by `.gitignore`/`.metapromptignore`, and binary files are skipped by default.
+- `chunk_tokens`, `chunk_overlap`, `mmap`, `reduce`: Map-reduce files estimated over `chunk_tokens` tokens: split them into overlapping chunks, process each chunk with the prompt (checkpointed per chunk), and merge the outputs by concatenation or with a final request. In interactive mode the merged output is shown for approval (y), skipping (s) or quitting (q); chunks stay checkpointed either way.
+- `context`, `context_window`: Which earlier turns are resent with each file: `full` (all, the default), `reset` (core history only), `window` (the last `context_window` files) or `compact` (the window plus a running summary of older files, updated every `context_window` files; older files not summarized yet are sent whole). Every request reports its prompt token count.
+- `trace`: Append a JSONL trace of phase timings (core script, history loading, discovery, checkpointing, output, editor, review) and of every request's latency, time to first token and token counts. A summary with percentiles, tokens per second and files per minute is printed at the end of every run.
+- `profile`: Run under cProfile and dump the stats (default `apply.prof`).
+- `prefetch`: In interactive mode, send the first turn of the next `prefetch` files in the background while the current one is reviewed. Prefetched files are forked from the conversation as it was when they were sent, and are dropped if the prompt changes.
+- `index`/`no-index`, `index_path`: Keep the full-text search index of checkpointed inputs and outputs up to date as files are checkpointed (default: on); search it with `python -m metaprompt.search`.
+- `dedup`, `dedup_threshold`, `near_duplicates`, `dedup_report`: Before processing, cluster the inputs into exact duplicates (`exact`) or also near duplicates, by MinHash estimated Jaccard similarity of at least `dedup_threshold` (`near`). Only the first file of each cluster is sent; the others get its output without a request. Near duplicates are `copy`-ed the same way, or shown for review with the copied response in interactive mode (`review`, the default). The number of requests avoided is reported at the end, and `dedup_report` writes one JSON line per duplicate.
+- `quiet_resume`: On resume, print a summary line instead of each finalized conversation.
+
+# Examples of use cases
+- generating readmes for huge sequence of files - we want to apply a certain
+  prompt at the start of each file, and then possibly tweak the output.
+  [put code files in a folder, and point the cycler to it]
+- generating a summaries of a huge sequence of files
+- drafting email responses to a huge list of emails we need to respond to
+- drafting responses to a huge list of customer reviews
+"""
+import os
+import contextlib
+import time
+import argparse
+from rich import print
+from metaprompt import utils, engine, cache, checkpoint, dedup, packing, prefix_cache, discovery, chunking, context, prefetch, ratelimit, search, sharding, sinks, telemetry, watch
+
+def positive_int(value:str)->int:
+    """
+    argparse type of counts that must be at least 1.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"takes a whole number, not {value!r}") from None
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, not {number}")
+    return number
+
+def build_parser()->argparse.ArgumentParser:
+    """
+    see file header for details
+    """
+    parser = argparse.ArgumentParser(description='Process some files with generative AI.')
+    parser.add_argument('text_files', nargs='+', help='List of text files to process')
+    parser.add_argument('core', nargs='?', type=str, help='Core conversation script to execute from the ./core folder')
+    parser.add_argument('--prompt', required=False, help='Prompt to apply to each file') # TODO: if not provided, check stdin, and if still not, ask for it
+    parser.add_argument('--newprompt_on_break', action='store_true', help='Prompt for a new prompt on break')
+    parser.add_argument('--sort', default='reverse', help='Order of the files within each folder: forward, reverse or none')
+    parser.add_argument('--include', action='append', help='Only process files in folders matching this glob (repeatable)')
+    parser.add_argument('--exclude', action='append', default=list(discovery.DEFAULT_EXCLUDE), help='Skip files and folders matching this glob (repeatable)')
+    parser.add_argument('--max_bytes', type=int, default=None, help='Skip files in folders larger than this')
+    parser.add_argument('--binary', action='store_true', help='Also process files in folders that look binary or do not decode')
+    parser.add_argument('--encoding', default='utf-8', help='Encoding used to sniff text files in folders')
+    parser.add_argument('--no_ignore_files', action='store_true', help='Do not apply .gitignore/.metapromptignore rules in folders')
+    parser.add_argument('--sink', choices=sinks.KINDS, default='files', help='Write one output file per input (files), or all outputs to one JSONL file or Parquet dataset')
+    parser.add_argument('--sink_path', default=None, help='File (jsonl) or folder (parquet) the outputs are written to (default: outputs/<core>.jsonl or .parquet)')
+    parser.add_argument('--sink_flush', type=int, default=100, help='With --sink jsonl or parquet, write the outputs and commit the checkpoint every this many records')
+    parser.add_argument('--append', default="_work", help='String to append to the output filename')
+    parser.add_argument('--prepend', default="../outputs/", help='String/folder to prepend to the output filename')
+    parser.add_argument('--yes', '-y', action='store_true', help='Automatically confirm all prompts')
+    parser.add_argument('--editor', default='nvim', help='Editor to use for interactive mode (default: nvim)')
+    parser.add_argument('--persist', default="database/{CORE}", required=False, help='File location of the checkpoint store')
+    parser.add_argument('--ignore_checkpoint', action='store_true', help='Ignore the checkpoint file')
+    parser.add_argument('--key_by', choices=['path', 'content'], default='path', help='Match files to checkpoint records by path, or by content, core and prompt')
+    parser.add_argument('--watch', action='store_true', help='Keep watching the folders and process files as they are created or changed')
+    parser.add_argument('--watch_debounce', type=float, default=2.0, help='Seconds without a change before a batch of changed files is processed')
+    parser.add_argument('--shard', type=sharding.parse_shard, default=None, help='Process only shard i of N (i/N, 0-based) of the files, checkpointed to a store of its own')
+    parser.add_argument('--skipN', type=int, default=0, help='Skip the first N files')
+    parser.add_argument('--cache', action=argparse.BooleanOptionalAction, default=True, help='Replay first-turn responses from the on-disk response cache (--no-cache to disable)')
+    parser.add_argument('--cache_path', default="database/cache.sqlite", help='File location of the response cache')
+    parser.add_argument('--cache_max_mb', type=float, default=512, help='Evict least recently used cache entries above this size')
+    parser.add_argument('--cache_max_days', type=float, default=30, help='Evict cache entries older than this')
+    parser.add_argument('--prefix_cache', action='store_true', help='Send the core history through a server-side context cache instead of with every request')
+    parser.add_argument('--prefix_cache_ttl', type=float, default=3600, help='Seconds the context cache lives between refreshes')
+    parser.add_argument('--prefix_cache_path', default="database/prefix_cache.json", help='File recording the context cache of each core script')
+    parser.add_argument('--stream', action='store_true', help='Render responses as they are generated and write them straight to the output file')
+    parser.add_argument('--chunk_tokens', type=int, default=None, help='Split files estimated over this many tokens into chunks, processed with the same prompt and merged')
+    parser.add_argument('--chunk_overlap', type=int, default=200, help='Estimated tokens of overlap between consecutive chunks')
+    parser.add_argument('--mmap', action='store_true', help='Read chunked files through mmap')
+    parser.add_argument('--reduce', choices=['concat', 'model'], default='concat', help='Merge chunk outputs by concatenation or with one more request')
+    parser.add_argument('--context', choices=context.MODES, default='full', help='Earlier turns resent with each file: all of them, only the core history, the last --context_window files, or those plus a summary of older files')
+    parser.add_argument('--context_window', type=int, default=1, help='Number of recent files kept in window and compact context modes')
+    parser.add_argument('--dedup', choices=dedup.MODES, default='off', help='Send only one file of each cluster of exact (exact) or also near (near) duplicate inputs')
+    parser.add_argument('--dedup_threshold', type=float, default=0.9, help='Estimated Jaccard similarity at which inputs are near duplicates')
+    parser.add_argument('--near_duplicates', choices=['copy', 'review'], default='review', help='Copy the output to near duplicates, or show it for review in interactive mode')
+    parser.add_argument('--dedup_report', default=None, help='Write the duplicates found, their representatives and outcomes to this JSONL file')
+    parser.add_argument('--index', action=argparse.BooleanOptionalAction, default=True, help='Add checkpointed turns to the full-text search index (--no-index to disable)')
+    parser.add_argument('--index_path', default="database/search.sqlite", help='File location of the full-text search index')
+    parser.add_argument('--trace', default=None, help='Append per-phase timings and per-request latency and token counts to this JSONL file')
+    parser.add_argument('--profile', nargs='?', const='apply.prof', default=None, help='Run under cProfile, dumping stats to this file (default: apply.prof)')
+    parser.add_argument('--prefetch', type=int, default=0, help='In interactive mode, send the first turn of the next K files in the background during review')
+    parser.add_argument('--quiet_resume', action='store_true', help='On resume, print one summary line instead of every finalized conversation')
+    parser.add_argument('--concurrency', type=positive_int, default=1, help='With --yes, number of files to process concurrently, each on a chat forked from the core history')
+    parser.add_argument('--pack_tokens', type=int, default=None, help='With --yes (required), pack small files into requests of up to this many estimated tokens of content')
+    parser.add_argument('--pack_files', type=int, default=20, help='Most files in one packed request')
+    parser.add_argument('--rpm', type=float, default=None, help='Requests per minute')
+    parser.add_argument('--tpm', type=float, default=None, help='Estimated tokens per minute')
+    parser.add_argument('--max_retries', type=int, default=5, help='Retries of a throttled or transient failure, with jittered exponential backoff')
+    return parser
+
+ynmc_help = """
+y: yes
+m: modify prompt - edit the response and then decision
+c: modify content - and then prompt
+q: quit
+i: insert text
+a: append text
+
+d: debug
+p: toggle new prompt on break
+"""
+
+
+def main(argv=None):
+    """
+    Run `apply` with the command line arguments `argv` (default
+    `sys.argv[1:]`).
+    """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.pack_tokens and not args.yes:
+        parser.error("--pack_tokens needs --yes: packed answers cannot be reviewed one by one")
+
+    utils.resolve_core(args)
+    if args.watch:
+        args.key_by = 'content'
+
+    # Record phase timings and requests, and report them however the run ends
+    trace = telemetry.configure(args.trace)
+    ratelimit.configure(rpm=args.rpm, tpm=args.tpm,
+                        concurrency=args.concurrency if args.yes else None,
+                        max_retries=args.max_retries)
+    search.configure(args.index_path if args.index else None)
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        if not args.watch:
+            return run(args)
+        paths = list(args.text_files)
+        with telemetry.phase('core_script'):
+            core = utils.run_core_script(args)
+        counts = run(args, core)
+        more = watch.watch(args, paths, run, core)
+        return {k: counts[k] + more[k] for k in counts}
+    finally:
+        print(trace.summary())
+        trace.close()
+        search.configure()
+        if args.profile:
+            import pstats
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+
+def report_dedup(args:argparse.Namespace, dedup_plan:dedup.DedupPlan):
+    print(f"[yellow]{dedup_plan.report()}[/yellow]")
+    if args.dedup_report:
+        dedup_plan.write_report(args.dedup_report)
+
+def run(args:argparse.Namespace, core:dict=None,
+        store:checkpoint.CheckpointStore=None):
+    """
+    Process `args.text_files` as configured by the parsed arguments. Returns
+    the `{'done', 'failed'}` counts of files.
+
+    `core` is the result of `utils.run_core_script` for `args.core`, run
+    here if not given. `store` is the open checkpoint store of the run, e.g.
+    one the daemon keeps between jobs; it is released rather than closed at
+    the end. By default the store at `args.persist` is opened.
+    """
+    import sys
+    from tqdm import tqdm
+    from rich.console import Console
+
+    # Execute the core script, keeping only its model, session and history
+    if core is None:
+        with telemetry.phase('core_script'):
+            core = utils.run_core_script(args)
+    model = core['model']
+    history = core['history']
+    core_history = list(history)
+
+    # Register the core history as cached context, requests then reference it
+    prefix = None
+    if args.prefix_cache and core_history:
+        try:
+            prefix = prefix_cache.PrefixCache(model, core_history,
+                                              utils.find_core(args.core),
+                                              args.prefix_cache_path,
+                                              ttl=args.prefix_cache_ttl)
+            model = prefix.wrap()
+        except Exception as e: # e.g. a core under the minimum cached size
+            print(f"[red]Context caching unavailable, sending the core history "
+                  f"with every request: {e}[/red]")
+
+    # Load or create the checkpoint store, first access of the store
+    if args.shard is not None:
+        args.persist = sharding.persist_path(args)
+    with telemetry.phase('history_load'):
+        history = utils.load_and_combine_history(args, history, store=store)
+
+    # Expand out any folders, lazily: files are fed to the loop as they are found
+    args.text_files = telemetry.timed(discovery.iter_files(
+        args.text_files, sort=args.sort, include=args.include,
+        exclude=args.exclude, max_bytes=args.max_bytes, binary=args.binary,
+        encoding=args.encoding,
+        ignore_files=() if args.no_ignore_files else discovery.IGNORE_FILES),
+        'discovery')
+    if args.shard is not None:
+        args.text_files = sharding.select(args.text_files, args.shard)
+
+    # Start chat session with history
+    chat_session = model.start_chat(history=history)
+
+    # Cluster duplicate inputs up front, reading every file once
+    dedup_plan = None
+    if args.dedup != 'off':
+        args.text_files, dedup_plan = dedup.plan(args.text_files, args.dedup,
+                                                 args.dedup_threshold,
+                                                 args.chunk_tokens)
+
+    # Open the checkpoint once and drop skipped and finalized files as they come
+    keep_open = store is not None
+    store = store if keep_open else utils.shelf(args)
+    sinks.attach(store, args)
+    fingerprint = (cache.core_fingerprint(core_history, model)
+                   if args.cache or args.key_by == 'content' else None)
+    if args.key_by == 'content':
+        args.prompt = args.prompt if args.prompt \
+                             else input("Please enter a prompt:\n")
+        store.setup = watch.setup_fingerprint(fingerprint, args.prompt)
+        args.text_files = watch.plan_resume(args, store, args.text_files)
+    else:
+        args.text_files = utils.plan_resume(args, store, args.text_files)
+
+    # Decide which earlier turns are resent with each file
+    context_policy = context.ContextPolicy(args.context, model, core_history,
+                                           chat_session, window=args.context_window,
+                                           ranges=store.ranges())
+
+    # Responses to the first turn of a file are cached by content
+    response_cache = (cache.ResponseCache(args.cache_path,
+                                          max_bytes=args.cache_max_mb * 2**20,
+                                          max_age=args.cache_max_days * 24 * 3600)
+                      if args.cache else None)
+
+    # Non-interactive runs can fan out over chats forked from the core history,
+    # or pack small files into shared requests
+    if args.yes and (args.concurrency > 1 or args.pack_tokens):
+        args.prompt = args.prompt if args.prompt \
+                             else input("Please enter a prompt:\n")
+        process = packing.run_packed if args.pack_tokens else engine.run_concurrent
+        if dedup_plan is None:
+            counts = process(args, model, core_history, chat_session,
+                             args.text_files, store=store,
+                             response_cache=response_cache)
+        else:
+            # representatives first, then duplicates from their outputs
+            counts = process(args, model, core_history, chat_session,
+                             dedup_plan.defer(args.text_files), store=store,
+                             response_cache=response_cache)
+            unmatched = []
+            for text_file in dedup_plan.deferred:
+                source = dedup_plan.source(text_file, args.prompt, store)
+                if source is None:
+                    dedup_plan.record(text_file, 'sent')
+                    unmatched.append(text_file)
+                    continue
+                dedup.fan_out(args, store, source[0], text_file)
+                dedup_plan.record(text_file, 'copied')
+                telemetry.record_file(text_file)
+                counts['done'] += 1
+            if unmatched:
+                more = process(args, model, core_history, chat_session,
+                               unmatched, store=store,
+                               response_cache=response_cache)
+                counts = {k: counts[k] + more[k] for k in counts}
+            report_dedup(args, dedup_plan)
+        store.release() if keep_open else store.close()
+        if response_cache is not None:
+            print(response_cache.report())
+            response_cache.close()
+        if prefix is not None:
+            print(prefix.report())
+        print(f"Processing complete. {counts['done']} output files created, "
+              f"{counts['failed']} failed.")
+        return counts
+
+    # Process each file
+    counts = {'done': 0, 'failed': 0}
+    def review_merged(text_file:str, merged:str)->bool:
+        # chunked files are reviewed once merged; edits are not offered
+        print(f"[yellow]Merged output of {text_file}:[/yellow]")
+        print(merged)
+        with telemetry.phase('review'):
+            answer = input("Is this okay? (y/s/q): ").strip().lower()
+        if answer.startswith('q'):
+            print("Quitting...")
+            store.commit()
+            sys.exit()
+        if answer.startswith('s'):
+            print("Skipping...")
+            return False
+        return True
+    shown_help = False
+    console = Console()
+    sending = ((lambda: contextlib.nullcontext()) if args.stream
+               else (lambda: console.status("Sending message...")))
+    prefetcher = (prefetch.Prefetcher(args.text_files, args.prefetch, args, model,
+                                      lambda: context_policy.snapshot(chat_session),
+                                      response_cache, fingerprint,
+                                      skip=dedup_plan.__contains__ if dedup_plan else None)
+                  if args.prefetch > 0 else None)
+    for text_file in tqdm(prefetcher or args.text_files, desc="Processing files"):
+
+        args.prompt = args.prompt if args.prompt \
+                             else input("Please enter a prompt:\n")
+
+        # Files too large for one request are map-reduced over chunks
+        if chunking.needs_chunking(text_file, args.chunk_tokens):
+            try:
+                output = engine.run_chunked(
+                    args, model, core_history, chat_session, text_file, store,
+                    response_cache, fingerprint, history=context_policy.log,
+                    review=None if args.yes else review_merged)
+            except Exception as e:
+                print(f"[red]Failed {text_file}: {e}[/red]")
+                counts['failed'] += 1
+                continue
+            if output is not None:
+                counts['done'] += 1
+            continue
+
+        # Duplicates reuse the output of their cluster's representative
+        source = (dedup_plan.source(text_file, args.prompt, store)
+                  if dedup_plan is not None else None)
+        if dedup_plan is not None and text_file in dedup_plan and source is None:
+            dedup_plan.record(text_file, 'sent')
+        if source is not None and (source[1] == 1.0 or args.yes
+                                   or args.near_duplicates == 'copy'):
+            dedup.fan_out(args, store, source[0], text_file)
+            dedup_plan.record(text_file, 'copied')
+            print(f"[green]{text_file} duplicates {source[0]}, output copied[/green]")
+            telemetry.record_file(text_file)
+            counts['done'] += 1
+            continue
+
+        with open(text_file, 'r') as f:
+            file_content = f.read()
+
+        key = (cache.cache_key(fingerprint, args.prompt, file_content)
+               if response_cache is not None else None)
+
+        # Streamed chunks go straight to the output file, rewritten on accept
+        stream_f = (utils.open_output(text_file, args)
+                    if args.stream and store.sink is None else None)
+
+        # Interactively confirm, and if not, edit output
+        file_start = time.perf_counter()
+        start_index = context_policy.begin(chat_session)
+        prefetched = (prefetcher.take(text_file, args.prompt)
+                      if prefetcher is not None else None)
+        if source is not None:
+            # a near duplicate up for review: show the representative's response
+            prefetched = cache.cached_response(dedup.output_text(store, source[0]))
+            dedup_plan.record(text_file, 'reviewed')
+        prompt_mode = 'standard'
+        is_okay, editor_output = '', ''
+        skipped = False
+        while True:
+
+            iC = len(chat_session.history)
+
+            # Handle prompt mode
+            # import pdb; pdb.set_trace()
+            if prompt_mode == 'standard':
+                # Determine what to say
+                inst = "user_request" if iC == start_index else "user_response"
+                user_content = (args.prompt if iC == start_index 
+                           else editor_output if 'response_text' in locals() 
+                           else None)
+                if user_content is None:
+                    raise ValueError("Content is None. This should not happen.")
+                message_to_agent = engine.format_message(
+                    user_content, inst,
+                    file_content if iC == start_index else None)
+                # import pdb; pdb.set_trace()
+                # Say it and get the response
+                print(f"[yellow]{message_to_agent}[/yellow]")
+                if iC == start_index and prefetched is not None:
+                    # splice the prefetched turn in where it would have been sent
+                    response = prefetched
+                    utils.append_turns(chat_session, message_to_agent,
+                                       response.parts[0].text)
+                else:
+                    try:
+                        with sending():
+                            response = utils.send_message(
+                                chat_session, message_to_agent,
+                                key=key if iC == start_index else None,
+                                response_cache=response_cache,
+                                stream=args.stream, out_f=stream_f)
+                    except Exception as e:
+                        # retries ran out: count the file and go on
+                        print(f"[red]Failed {text_file}: {e}[/red]")
+                        counts['failed'] += 1
+                        skipped = True
+                        break
+                response_text = response.parts[0].text
+                utils.print_message(response, show_text=not args.stream
+                                    or response is prefetched)
+            elif prompt_mode == 'insert':
+                insertion = input("Please enter the insertion text: ")
+                message_to_agent = (
+                    f'<user>{insertion}</user>\n'
+                    f"""
+                    {f'<content>{editor_output}</content>' if iC == start_index else ''}
+                    """
+                    )
+                print(f"[yellow]{message_to_agent}[/yellow]")
+                with sending():
+                    response = utils.send_message(chat_session, message_to_agent,
+                                                  stream=args.stream, out_f=stream_f)
+                response_text = response.parts[0].text
+                utils.print_message(response, show_text=not args.stream)
+            elif prompt_mode == 'append':
+                append = input("Please enter the appended text: ")
+                message_to_agent = (
+                    f"""
+                    {f'<content>{editor_output}</content>' if iC == start_index else ''}
+                    """
+                    f'<user>{append}</user>\n'
+                    )
+                print(f"[yellow]{message_to_agent}[/yellow]")
+                with sending():
+                    response = utils.send_message(chat_session, message_to_agent,
+                                                  stream=args.stream, out_f=stream_f)
+                response_text = response.parts[0].text
+                utils.print_message(response, show_text=not args.stream)
+            elif prompt_mode == 'skip':
+                # Taking the following approach to make linters happy
+                response, response_text = ((None, None) 
+                                           if 'response_text' not in locals() 
+                                           else (locals()['response'], 
+                                                 locals()['response_text']))
+                if response is None:
+                    raise ValueError("Response is None. This should not happen.")
+            else:
+                raise ValueError("Prompt mode is not recognized.")
+
+            # keep the lookahead busy while the reviewer is at it
+            if prefetcher is not None:
+                prefetcher.fill()
+            print(ynmc_help) if not shown_help else None
+            if not shown_help: shown_help = True
+            with telemetry.phase('review'):
+                is_okay = input("Is this okay? (y/m/c/q/i/a) [d/p]: ").strip().lower() \
+                                if not args.yes else 'y'
+
+            if is_okay.startswith('y'): # if okay, break
+                break
+            elif is_okay.startswith('m'): # if modify, edit the response
+                prompt_mode = False
+                editor_output = utils.edit_content_with_editor(
+                    message_to_agent, response_text, args.editor)
+            elif is_okay.startswith('r'): # if return, edit the response and return to prompt
+                prompt_mode = True
+                editor_output = utils.edit_content_with_editor(
+                    message_to_agent, response_text, args.editor)
+            elif is_okay.startswith('q'):
+                print("Quitting...")
+                store.commit() # flush the outputs of the files done
+                sys.exit()
+            elif is_okay.startswith('s'): # if skip, skip this file
+                print("Skipping...")
+                skipped = True
+                break
+            # an option to cycle back with a prepended message
+            elif is_okay.startswith('i'):
+                pass
+            # an option to cycle back with a appended message
+            elif is_okay.startswith('a'):
+                pass
+            # save the current state
+            elif is_okay.startswith('w'):
+                log_start = context_policy.end(chat_session, start_index, final=False)
+                utils.persist_text_file_conversation(args, chat_session, text_file, log_start, is_final=False, store=store, history=context_policy.log)
+
+
+            if 'd' in is_okay:
+                import pdb; pdb.set_trace()
+            if 'p' in is_okay:
+                # toggle change prompt on break
+                args.newprompt_on_break = not args.newprompt_on_break
+
+
+        if stream_f is not None:
+            stream_f.close()
+            if skipped:
+                os.remove(stream_f.name)
+
+        # Save the current state to the checkpoint store
+        if not skipped:
+
+            # Repersist the history
+            log_start = context_policy.end(chat_session, start_index)
+            utils.persist_text_file_conversation(args, chat_session, text_file,
+                                                 log_start, is_final=True,
+                                                 store=store,
+                                                 history=context_policy.log)
+            # Save the output with appended string
+            seconds = time.perf_counter() - file_start
+            utils.write_output(text_file, args, context_policy.log, log_start,
+                               store, seconds=seconds, **sinks.usage(response))
+            telemetry.record_file(text_file, seconds)
+            counts['done'] += 1
+            if dedup_plan is not None:
+                dedup_plan.done(text_file, args.prompt)
+
+        # If prompt on break, display the upcoming `text_file` and ask for a new
+        # prompt
+        if args.newprompt_on_break:
+            print(f"[yellow]Upcoming file: {text_file}[/yellow]")
+            args.prompt = input("Please enter a new prompt:\n")
+            if args.key_by == 'content':
+                store.setup = watch.setup_fingerprint(fingerprint, args.prompt)
+            if prefetcher is not None:
+                prefetcher.invalidate()
+
+
+    if prefetcher is not None:
+        prefetcher.close()
+    if dedup_plan is not None:
+        report_dedup(args, dedup_plan)
+    store.release() if keep_open else store.close()
+    if response_cache is not None:
+        print(response_cache.report())
+        response_cache.close()
+    if prefix is not None:
+        print(prefix.report())
+    print(f"Processing complete. {counts['done']} output files created, "
+          f"{counts['failed']} failed.")
+    return counts
@@ -0,0 +1,343 @@
+"""
+Batch Prompting: This technique involves generating multiple outputs from
+different, same or slightly varied prompts, often repeated over a large number
+of inputs (e.g., 100 or more).
+
+For same inputs, the goal is to explore the range of possible responses the AI
+can generate. By collecting a broad set of responses, patterns can be analyzed,
+or the most relevant or creative outputs can be selected. This technique is
+particularly useful for tasks like brainstorming, where diversity of ideas is
+valued, or for fine-tuning the AI by identifying and addressing common errors
+or biases across a large sample size.
+
+The engine runs the matrix of inputs x prompt variants x `samples`. Every
+sample is sent on its own chat forked from the core history, on a pool of
+`concurrency` workers sharing one `ratelimit.Scheduler`. Results are appended to a JSONL
+file as they complete, not held in memory. Within a cell (one input and one
+prompt variant) a response equal to an earlier one, or nearly so, is written
+as a short record pointing at the first instead of in full. The number of
+samples done per cell is checkpointed, so an interrupted run picks up where it
+stopped; a sample that completed but was not yet checkpointed is sent again.
+
+- `text_files`: Inputs, files or folders.
+- `core`: The core conversation script to execute from the `./core` folder.
+- `prompt`: A prompt variant; repeat for several.
+- `prompts_file`: A file with one prompt variant per line.
+- `samples`: Samples per input and prompt variant.
+- `concurrency`: Number of samples in flight at once.
+- `rpm`, `tpm`, `max_retries`: Requests and tokens per minute allowed across
+  all workers, and retries of throttled or transient failures.
+- `similarity`: Responses at least this similar to an earlier response of the
+  same cell are collapsed into it (1 for exact duplicates only).
+- `output`: The JSONL file results are appended to.
+- `persist`: The file location of the sample counts (`.sqlite`).
+- `ignore_checkpoint`: Reset the sample counts and start over.
+"""
+import argparse
+import concurrent.futures
+import difflib
+import hashlib
+import json
+import os
+import re
+import sqlite3
+from rich import print
+from metaprompt import utils, engine, discovery, ratelimit, telemetry
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cells (
+    cell TEXT PRIMARY KEY,
+    input TEXT NOT NULL,
+    variant INTEGER NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS responses (
+    cell TEXT NOT NULL,
+    id TEXT NOT NULL,
+    text TEXT NOT NULL,
+    count INTEGER NOT NULL DEFAULT 1,
+    PRIMARY KEY (cell, id)
+);
+"""
+
+def normalize(text:str)->str:
+    return re.sub(r'\s+', ' ', text).strip().lower()
+
+def response_id(text:str)->str:
+    return hashlib.sha256(normalize(text).encode('utf-8')).hexdigest()[:16]
+
+def cell_key(text_file:str, prompt:str)->str:
+    """
+    Key of an input and prompt variant; tied to the prompt text rather than
+    its position, so editing the variants does not mix up their counts.
+    """
+    return f"{text_file}#{hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:12]}"
+
+class SampleStore:
+    """
+    Per cell sample counts and the distinct responses seen so far, in SQLite.
+    """
+
+    def __init__(self, path:str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+
+    def done(self, cell:str)->int:
+        row = self.connection.execute(
+            "SELECT done FROM cells WHERE cell = ?", (cell,)).fetchone()
+        return row[0] if row else 0
+
+    def responses(self, cell:str)->list:
+        """
+        `(id, text)` of the distinct responses of a cell, oldest first.
+        """
+        return self.connection.execute(
+            "SELECT id, text FROM responses WHERE cell = ? ORDER BY rowid",
+            (cell,)).fetchall()
+
+    def record(self, cell:str, text_file:str, variant:int, rid:str,
+               text:str=None)->int:
+        """
+        Count one more sample of the cell, a new response if `text` is given
+        and a duplicate of response `rid` otherwise. Returns the sample index.
+        """
+        with self.connection:
+            sample = self.done(cell)
+            self.connection.execute(
+                "INSERT INTO cells (cell, input, variant, done) VALUES (?, ?, ?, 1) "
+                "ON CONFLICT(cell) DO UPDATE SET done = done + 1",
+                (cell, text_file, variant))
+            if text is not None:
+                self.connection.execute(
+                    "INSERT OR IGNORE INTO responses (cell, id, text) VALUES (?, ?, ?)",
+                    (cell, rid, text))
+            else:
+                self.connection.execute(
+                    "UPDATE responses SET count = count + 1 WHERE cell = ? AND id = ?",
+                    (cell, rid))
+        return sample
+
+    def reset(self):
+        with self.connection:
+            self.connection.execute("DELETE FROM cells")
+            self.connection.execute("DELETE FROM responses")
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class Deduplicator:
+    """
+    Collapse responses of a cell onto earlier ones: exact matches after
+    normalizing case and whitespace, and near matches at or above
+    `similarity` by `difflib` ratio. Only cells still being sampled are kept.
+    """
+
+    def __init__(self, store:SampleStore, similarity:float=0.9):
+        self.store = store
+        self.similarity = similarity
+        self.seen = {}
+
+    def match(self, cell:str, text:str):
+        """
+        Returns
+        -------
+        rid : str
+            the id of the response, or of the earlier response it duplicates
+        similarity : float
+            None for a new response, else its similarity to the earlier one
+        """
+        if cell not in self.seen:
+            self.seen[cell] = {rid: normalize(t)
+                               for rid, t in self.store.responses(cell)}
+        seen = self.seen[cell]
+        rid = response_id(text)
+        if rid in seen:
+            return rid, 1.0
+        if self.similarity < 1:
+            normalized = normalize(text)
+            for other, other_text in seen.items():
+                matcher = difflib.SequenceMatcher(None, normalized, other_text,
+                                                  autojunk=False)
+                if (matcher.real_quick_ratio() >= self.similarity
+                        and matcher.quick_ratio() >= self.similarity
+                        and matcher.ratio() >= self.similarity):
+                    return other, matcher.ratio()
+        seen[rid] = normalize(text)
+        return rid, None
+
+    def forget(self, cell:str):
+        self.seen.pop(cell, None)
+
+def iter_samples(text_files, prompts:list, samples:int, store:SampleStore):
+    """
+    Lazily yield `(cell, text_file, variant, prompt, content)` for every
+    sample still to do. File content is read once per input.
+    """
+    for text_file in text_files:
+        content = None
+        for variant, prompt in enumerate(prompts):
+            cell = cell_key(text_file, prompt)
+            todo = samples - store.done(cell)
+            if todo <= 0:
+                continue
+            if content is None:
+                content = engine.read_text_file(text_file)
+            for _ in range(todo):
+                yield cell, text_file, variant, prompt, content
+
+def sample(model, core_history:list, content:str, prompt:str):
+    """
+    Send one sample on a chat forked from the core history. Never cached,
+    since samples should differ.
+    """
+    _, response = engine.send_forked(model, core_history, content, prompt)
+    return response
+
+def run_batch(args, model, core_history:list, text_files, prompts:list,
+              store:SampleStore, out_f)->dict:
+    """
+    Run every sample still to do on a pool of `args.concurrency` workers,
+    with at most `2 * args.concurrency` in flight.
+
+    Completed samples are deduplicated, appended to `out_f` and counted in
+    the `store`, in that order, on the calling thread.
+
+    Returns
+    -------
+    dict of counts for 'unique', 'duplicate' and 'failed' samples
+    """
+    counts = {'unique': 0, 'duplicate': 0, 'failed': 0}
+    dedup = Deduplicator(store, args.similarity)
+    todo = iter_samples(text_files, prompts, args.samples, store)
+    concurrency = max(args.concurrency, 1)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        def submit(n):
+            submitted = {}
+            for task in todo:
+                cell, _, _, prompt, content = task
+                submitted[pool.submit(sample, model, core_history, content,
+                                      prompt)] = task
+                if len(submitted) == n:
+                    break
+            return submitted
+        in_flight = submit(2 * concurrency)
+        while in_flight:
+            finished, _ = concurrent.futures.wait(
+                in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                cell, text_file, variant, prompt, _ = in_flight.pop(future)
+                try:
+                    response = future.result()
+                except Exception as e:
+                    print(f"[red]Failed {text_file} (variant {variant}): {e}[/red]")
+                    counts['failed'] += 1
+                    continue
+                text = response.parts[0].text
+                rid, similarity = dedup.match(cell, text)
+                record = {'input': text_file, 'variant': variant,
+                          'sample': store.done(cell), 'id': rid}
+                if similarity is None:
+                    usage = response.usage_metadata
+                    record.update(prompt=prompt, text=text,
+                                  prompt_tokens=usage.prompt_token_count,
+                                  candidates_tokens=usage.candidates_token_count)
+                    counts['unique'] += 1
+                else:
+                    record.update(duplicate_of=rid,
+                                  similarity=round(similarity, 4))
+                    counts['duplicate'] += 1
+                with telemetry.phase('output'):
+                    out_f.write(json.dumps(record) + "\n")
+                    out_f.flush()
+                with telemetry.phase('checkpoint'):
+                    store.record(cell, text_file, variant, rid,
+                                 text if similarity is None else None)
+                if store.done(cell) >= args.samples:
+                    dedup.forget(cell)
+                    telemetry.record_file(cell)
+            in_flight.update(submit(2 * concurrency - len(in_flight)))
+    return counts
+
+def read_prompts(args)->list:
+    prompts = list(args.prompt or [])
+    if args.prompts_file:
+        with open(args.prompts_file) as f:
+            prompts += [line.strip() for line in f if line.strip()]
+    if not prompts:
+        prompts = [input("Please enter a prompt:\n")]
+    return prompts
+
+def build_parser()->argparse.ArgumentParser:
+    """
+    see file header for details
+    """
+    parser = argparse.ArgumentParser(description='Sample many responses per input and prompt variant.')
+    parser.add_argument('text_files', nargs='+', help='List of text files or folders to process')
+    parser.add_argument('core', nargs='?', type=str, help='Core conversation script to execute from the ./core folder')
+    parser.add_argument('--prompt', action='append', help='Prompt variant to apply to each file (repeatable)')
+    parser.add_argument('--prompts_file', default=None, help='File with one prompt variant per line')
+    parser.add_argument('--samples', type=int, default=5, help='Samples per input and prompt variant')
+    parser.add_argument('--concurrency', type=int, default=8, help='Number of samples in flight at once')
+    parser.add_argument('--rpm', type=float, default=None, help='Requests per minute across all workers')
+    parser.add_argument('--tpm', type=float, default=None, help='Estimated tokens per minute across all workers')
+    parser.add_argument('--max_retries', type=int, default=5, help='Retries of a throttled or transient failure, with jittered exponential backoff')
+    parser.add_argument('--similarity', type=float, default=0.9, help='Collapse responses at least this similar to an earlier one of the same cell (1: exact only)')
+    parser.add_argument('--output', default="outputs/batch_{CORE}", help='JSONL file results are appended to (extension replaced by .jsonl)')
+    parser.add_argument('--persist', default="database/batch_{CORE}", help='File location of the sample counts (extension replaced by .sqlite)')
+    parser.add_argument('--ignore_checkpoint', action='store_true', help='Reset the sample counts and start over')
+    parser.add_argument('--sort', default='forward', help='Order of the files within each folder: forward, reverse or none')
+    parser.add_argument('--include', action='append', help='Only process files in folders matching this glob (repeatable)')
+    parser.add_argument('--exclude', action='append', default=list(discovery.DEFAULT_EXCLUDE), help='Skip files and folders matching this glob (repeatable)')
+    parser.add_argument('--max_bytes', type=int, default=None, help='Skip files in folders larger than this')
+    parser.add_argument('--trace', default=None, help='Append per-phase timings and per-request latency and token counts to this JSONL file')
+    return parser
+
+def with_extension(path:str, extension:str)->str:
+    return os.path.splitext(path)[0] + extension
+
+def main(argv=None):
+    """
+    Run the batch with the command line arguments `argv` (default
+    `sys.argv[1:]`). Returns the counts of `run_batch`.
+    """
+    args = build_parser().parse_args(argv)
+    utils.resolve_core(args)
+    trace = telemetry.configure(args.trace)
+    try:
+        with telemetry.phase('core_script'):
+            core = utils.run_core_script(args)
+        prompts = read_prompts(args)
+        text_files = discovery.iter_files(
+            args.text_files, sort=args.sort, include=args.include,
+            exclude=args.exclude, max_bytes=args.max_bytes)
+        output = with_extension(utils.string_substitute(args.output, args), '.jsonl')
+        if os.path.dirname(output):
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+        ratelimit.configure(rpm=args.rpm, tpm=args.tpm,
+                            concurrency=args.concurrency,
+                            max_retries=args.max_retries)
+        with SampleStore(with_extension(utils.string_substitute(args.persist, args),
+                                        '.sqlite')) as store, \
+             open(output, 'a') as out_f:
+            if args.ignore_checkpoint:
+                store.reset()
+            counts = run_batch(args, core['model'], list(core['history']),
+                               telemetry.timed(text_files, 'discovery'),
+                               prompts, store, out_f)
+        print(f"Batch complete. {counts['unique']} distinct and "
+              f"{counts['duplicate']} duplicate samples written to {output}, "
+              f"{counts['failed']} failed.")
+        return counts
+    finally:
+        print(trace.summary())
+        trace.close()
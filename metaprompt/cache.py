@@ -0,0 +1,159 @@
+"""
+Content addressed response cache.
+
+Reruns over the same corpus with the same core script and prompt would pay
+for every generation again. Responses to the first turn of each file are
+stored on disk under a hash of the core history, the model settings, the
+prompt and the file content, and are returned without a request on a hit.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from types import SimpleNamespace
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key      TEXT PRIMARY KEY,
+    text     TEXT NOT NULL,
+    tokens   INTEGER,
+    size     INTEGER NOT NULL,
+    created  REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+"""
+
+def model_settings(model)->dict:
+    """
+    The settings of a `GenerativeModel` that change what it generates.
+    """
+    system_instruction = getattr(model, '_system_instruction', None)
+    if system_instruction is not None and hasattr(system_instruction, 'parts'):
+        system_instruction = [part.text for part in system_instruction.parts]
+    return {'model_name': getattr(model, 'model_name', None),
+            'generation_config': getattr(model, '_generation_config', None),
+            'safety_settings': getattr(model, '_safety_settings', None),
+            'system_instruction': system_instruction}
+
+def core_fingerprint(core_history:list, model)->str:
+    """
+    Hash of the core history and model settings, computed once per run.
+    """
+    from google.generativeai.types import content_types
+    digest = hashlib.sha256()
+    # whatever form the core script wrote its history in
+    for turn in content_types.to_contents(list(core_history)):
+        digest.update(turn.role.encode('utf-8') + b'\0')
+        for part in turn.parts:
+            digest.update(part.text.encode('utf-8') + b'\0')
+    digest.update(json.dumps(model_settings(model), sort_keys=True,
+                             default=str).encode('utf-8'))
+    return digest.hexdigest()
+
+def cache_key(fingerprint:str, prompt:str, file_content:str)->str:
+    digest = hashlib.sha256(fingerprint.encode('utf-8'))
+    for field in (prompt, file_content):
+        digest.update(b'\0' + field.encode('utf-8'))
+    return digest.hexdigest()
+
+def cached_response(text:str, tokens:int=None):
+    """
+    Stand-in for a `GenerateContentResponse` with the fields apply.py reads.
+    """
+    return SimpleNamespace(
+        text=text, parts=[SimpleNamespace(text=text)], cached=True,
+        usage_metadata=SimpleNamespace(candidates_token_count=tokens,
+                                       prompt_token_count=0,
+                                       total_token_count=tokens))
+
+class ResponseCache:
+    """
+    SQLite backed response cache with size and age based eviction.
+
+    Entries older than `max_age` seconds are dropped, then the least recently
+    used entries until the stored text fits in `max_bytes`. Safe to share
+    between the worker threads of the concurrent engine.
+    """
+
+    def __init__(self, path:str, max_bytes:int=512*2**20,
+                 max_age:float=30*24*3600):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+        self.evict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.evict()
+        self.connection.close()
+
+    def get(self, key:str):
+        """
+        Return the cached response for `key`, or None on a miss.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT text, tokens, created FROM responses WHERE key = ?",
+                (key,)).fetchone()
+            now = time.time()
+            if row is None or now - row[2] > self.max_age:
+                self.misses += 1
+                return None
+            self.connection.execute(
+                "UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self.connection.commit()
+            self.hits += 1
+        return cached_response(row[0], row[1])
+
+    def put(self, key:str, text:str, tokens:int=None):
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses "
+                "(key, text, tokens, size, created, accessed) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, text, tokens, len(text.encode('utf-8')), now, now))
+            self.connection.commit()
+
+    def evict(self)->int:
+        """
+        Drop expired entries, then least recently used ones over the size
+        limit. Returns the number of entries dropped.
+        """
+        with self.lock:
+            cursor = self.connection.execute(
+                "DELETE FROM responses WHERE created < ?",
+                (time.time() - self.max_age,))
+            dropped = cursor.rowcount
+            total, = self.connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()
+            if total > self.max_bytes:
+                stale = []
+                for key, size in self.connection.execute(
+                        "SELECT key, size FROM responses ORDER BY accessed"):
+                    if total <= self.max_bytes:
+                        break
+                    stale.append((key,))
+                    total -= size
+                self.connection.executemany(
+                    "DELETE FROM responses WHERE key = ?", stale)
+                dropped += len(stale)
+            self.connection.commit()
+        return dropped
+
+    def report(self)->str:
+        return f"Response cache: {self.hits} hits, {self.misses} misses"
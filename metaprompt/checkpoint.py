@@ -0,0 +1,505 @@
+"""
+Append-only checkpoint store.
+
+Replaces the shelve checkpoint, which re-pickled the whole chat history on
+every save. Turns are appended to a SQLite table one row each, so a save only
+writes the turns that are new since the last one, and per-file records point
+at their turns by index so they can be looked up without loading the whole
+history.
+
+Turns are stored as plain role and text columns, so reading them needs
+neither pickle nor the SDK; `Content` objects are only rebuilt by `history`,
+when a chat is resumed. Turns with anything but a single text part keep their
+`Content` protobuf bytes as well. Stores written with pickled turns (format 0)
+are converted in place the first time they are opened for writing, and
+shelve checkpoints are migrated, see `open_store` or
+
+    python -m metaprompt.checkpoint database/
+"""
+import dbm
+import os
+import shelve
+import sqlite3
+from types import SimpleNamespace
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS turns (
+    idx     INTEGER PRIMARY KEY,
+    role    TEXT,
+    text    TEXT,
+    content BLOB
+);
+CREATE TABLE IF NOT EXISTS files (
+    key   TEXT PRIMARY KEY,
+    start INTEGER NOT NULL,
+    stop  INTEGER NOT NULL,
+    final INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS digests (
+    key    TEXT PRIMARY KEY,
+    digest TEXT NOT NULL,
+    setup  TEXT,
+    size   INTEGER,
+    mtime  INTEGER
+);
+CREATE INDEX IF NOT EXISTS digests_by_content ON digests (digest, setup);
+"""
+
+# PRAGMA user_version of the stores written: plain turns, protobuf bytes in
+# `content` only for turns that are not a single text part. Format 0 pickled
+# every turn into `content`.
+FORMAT = 1
+
+# bytes of the store read through mmap instead of read() calls
+MMAP_SIZE = 1 << 28
+
+class CheckpointStore:
+    """
+    SQLite backed checkpoint of a chat history and its per-file records.
+
+    The history is an append-only log of turns; `append_history` writes the
+    turns of a history past the ones already stored. Each file record holds
+    the `[start, stop)` range of its turns in that log.
+
+    Records can also carry the digest of the content they were made from and
+    of the core and prompt (`setup`) they were made with, so files can be
+    matched by content rather than by path, see `watch.plan_resume`. Digests
+    announced with `expect` are written when their record is finalized.
+
+    Records are committed as they are put. With a `sink` (see `sinks`), they
+    are committed `commit_every` at a time, the sink being flushed first;
+    a file's turns are appended before its record is put and its output is
+    written to the sink right after, so the commit is made before the turns
+    of the next file are appended, or its record put. The search index is
+    updated after every commit, see `search`.
+
+    A store can be kept open across runs, e.g. by the daemon: `release` ends
+    a run without closing the connection, and with `keep_history` the turns
+    rebuilt by `history` are kept, so the next run only reads the new ones.
+    """
+
+    def __init__(self, path:str, readonly:bool=False, keep_history:bool=False):
+        self.path = path
+        self.readonly = readonly
+        self.kept = [] if keep_history else None
+        self.setup = None
+        self.pending = {}
+        self.sink = None
+        self.commit_every = 1
+        self.uncommitted = 0
+        self.unrecorded = False
+        if readonly: # shareable between threads, e.g. by a browser
+            self.connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True,
+                                              check_same_thread=False)
+        else:
+            # used by one thread at a time, not always the one opening it
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.executescript(SCHEMA)
+        self.connection.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+        self._length = self.connection.execute(
+            "SELECT COUNT(*) FROM turns").fetchone()[0]
+        self.format = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if not readonly and self.format < FORMAT:
+            if self._length:
+                self.upgrade()
+            self.connection.execute(f"PRAGMA user_version={FORMAT}")
+            self.format = FORMAT
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def commit(self):
+        if self.sink is not None:
+            self.sink.flush()
+        self.connection.commit()
+        self.uncommitted = 0
+        if not self.readonly:
+            from metaprompt import search, telemetry # both import this module
+            with telemetry.phase('index'):
+                search.update(self)
+
+    def commit_due(self):
+        """
+        Commit once `commit_every` records are waiting, between files only.
+        """
+        if self.uncommitted >= self.commit_every and not self.unrecorded:
+            # the outputs of the records so far are in the sink by now
+            self.commit()
+
+    def release(self):
+        """
+        End a run on the store: commit, close its sink and forget its
+        settings, leaving the connection open for the next run.
+        """
+        self.commit()
+        if self.sink is not None:
+            self.sink.close()
+        self.sink, self.commit_every = None, 1
+        self.setup, self.pending = None, {}
+
+    def stale(self)->bool:
+        """
+        True if the file was removed or written by another connection since
+        this one counted its turns, so it must be opened again.
+        """
+        if not os.path.exists(self.path):
+            return True
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM turns").fetchone()[0] != self._length
+
+    def close(self):
+        self.release()
+        self.connection.close()
+
+    def __len__(self):
+        return self._length
+
+    def __contains__(self, key:str):
+        return self.connection.execute(
+            "SELECT 1 FROM files WHERE key = ?", (key,)).fetchone() is not None
+
+    def __getitem__(self, key:str)->dict:
+        row = self.connection.execute(
+            "SELECT start, stop, final FROM files WHERE key = ?",
+            (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return record(*row)
+
+    def get(self, key:str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self)->list:
+        return [key for key, in self.connection.execute(
+            "SELECT key FROM files ORDER BY start")]
+
+    def count(self, pattern:str=None)->int:
+        """
+        Number of file records, of those with keys matching the GLOB
+        `pattern` if given.
+        """
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM files WHERE ? IS NULL OR key GLOB ?",
+            (pattern, pattern)).fetchone()[0]
+
+    def page(self, offset:int=0, limit:int=50, pattern:str=None)->list:
+        """
+        `(key, start, stop, final)` of a page of file records in history
+        order, without loading any turns.
+        """
+        return self.connection.execute(
+            "SELECT key, start, stop, final FROM files "
+            "WHERE ? IS NULL OR key GLOB ? ORDER BY start, key LIMIT ? OFFSET ?",
+            (pattern, pattern, limit, offset)).fetchall()
+
+    def texts(self, start:int=0, stop:int=None)->list:
+        """
+        `(idx, role, text)` of the turns `[start, stop)`, read from the plain
+        columns.
+        """
+        stop = self._length if stop is None else stop
+        return self.connection.execute(
+            "SELECT idx, role, text FROM turns WHERE idx >= ? AND idx < ? "
+            "ORDER BY idx", (start, stop)).fetchall()
+
+    def file_ranges(self, since:int=0)->list:
+        """
+        `(key, start, stop)` of the file records with turns at or after
+        `since`, in history order.
+        """
+        return self.connection.execute(
+            "SELECT key, start, stop FROM files WHERE stop > ? AND stop > start "
+            "ORDER BY start", (since,)).fetchall()
+
+    def finalized(self)->set:
+        """
+        The keys of every file with a final record, in one query.
+        """
+        return {key for key, in self.connection.execute(
+            "SELECT key FROM files WHERE final = 1")}
+
+    def ranges(self)->list:
+        """
+        `(start, stop)` history ranges of the final records, oldest first.
+        """
+        return self.connection.execute(
+            "SELECT DISTINCT start, stop FROM files WHERE final = 1 AND stop > start "
+            "ORDER BY start").fetchall()
+
+    def append_history(self, history:list)->int:
+        """
+        Append the turns of `history` that are not stored yet. `history` must
+        extend the stored one, as `chat_session.history` does over a run.
+
+        Returns the number of turns written.
+        """
+        new_turns = history[self._length:]
+        if not new_turns:
+            return 0
+        self.commit_due()
+        self.unrecorded = True
+        self.connection.executemany(
+            "INSERT INTO turns (idx, role, text, content) VALUES (?, ?, ?, ?)",
+            ((self._length + i, *encode(turn))
+             for i, turn in enumerate(new_turns)))
+        self._length += len(new_turns)
+        return len(new_turns)
+
+    def put(self, key:str, start:int, stop:int, final:bool=False):
+        """
+        Record that the turns `[start, stop)` of the history belong to `key`.
+        """
+        self.commit_due()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO files (key, start, stop, final) "
+            "VALUES (?, ?, ?, ?)", (key, start, stop, int(final)))
+        if final and key in self.pending:
+            self.set_digest(key, *self.pending.pop(key), commit=False)
+        self.uncommitted += 1
+        self.unrecorded = False
+        if self.sink is None:
+            self.commit()
+
+    def expect(self, key:str, digest:str, size:int=None, mtime:int=None):
+        """
+        Record `digest`, with the current `setup`, once `key` is finalized.
+        """
+        self.pending[key] = (digest, size, mtime)
+
+    def set_digest(self, key:str, digest:str, size:int=None, mtime:int=None,
+                   commit:bool=True):
+        """
+        Record that `key` was made from content with `digest` (of `size`
+        bytes, modified at `mtime` ns) with the current `setup`.
+        """
+        self.connection.execute(
+            "INSERT OR REPLACE INTO digests (key, digest, setup, size, mtime) "
+            "VALUES (?, ?, ?, ?, ?)", (key, digest, self.setup, size, mtime))
+        if commit:
+            self.commit()
+
+    def digest(self, key:str):
+        """
+        `(digest, setup, size, mtime)` recorded for `key`, or None.
+        """
+        return self.connection.execute(
+            "SELECT digest, setup, size, mtime FROM digests WHERE key = ?",
+            (key,)).fetchone()
+
+    def find_content(self, digest:str)->str:
+        """
+        The key of a final record with turns made from content with `digest`
+        with the current `setup`, or None.
+        """
+        row = self.connection.execute(
+            "SELECT d.key FROM digests d JOIN files f ON f.key = d.key "
+            "WHERE d.digest = ? AND d.setup IS ? AND f.final = 1 "
+            "AND f.stop > f.start ORDER BY f.start LIMIT 1",
+            (digest, self.setup)).fetchone()
+        return row[0] if row is not None else None
+
+    def invalidate(self, key:str):
+        """
+        Mark the records of `key` and of its chunks as not final, e.g. once
+        the file has changed.
+        """
+        prefix = key + '#chunk'
+        self.connection.execute(
+            "UPDATE files SET final = 0 WHERE key = ? OR substr(key, 1, ?) = ?",
+            (key, len(prefix), prefix))
+        self.commit()
+
+    def history(self, start:int=0, stop:int=None)->list:
+        """
+        Rebuild the `Content` turns `[start, stop)` of the stored history,
+        e.g. to resume a chat. Use `turns` or `texts` to only read them.
+        """
+        stop = self._length if stop is None else stop
+        if self.kept is not None and start == 0 and stop >= len(self.kept):
+            self.kept += self.decode_turns(len(self.kept), stop)
+            return list(self.kept)
+        return self.decode_turns(start, stop)
+
+    def decode_turns(self, start:int, stop:int)->list:
+        return [decode(role, text, content, self.format)
+                for role, text, content in self.connection.execute(
+                    "SELECT role, text, content FROM turns "
+                    "WHERE idx >= ? AND idx < ? ORDER BY idx", (start, stop))]
+
+    def turns(self, start:int=0, stop:int=None)->list:
+        """
+        The turns `[start, stop)` as lightweight stand-ins with the `role`
+        and `parts[0].text` of a `Content`, without the SDK.
+        """
+        return [plain_turn(role, text)
+                for _, role, text in self.texts(start, stop)]
+
+    def file_turns(self, key:str)->list:
+        """
+        The turns recorded for `key`, see `turns`.
+        """
+        rec = self[key]
+        return self.turns(rec['input_index'].start, rec['input_index'].stop)
+
+    def upgrade(self, batch:int=1000):
+        """
+        Convert the pickled turns of a format 0 store in place, then reclaim
+        the space they took.
+        """
+        import pickle
+        import google.ai # used in unpickling
+        for offset in range(0, self._length, batch):
+            rows = self.connection.execute(
+                "SELECT idx, content FROM turns WHERE idx >= ? AND idx < ?",
+                (offset, offset + batch)).fetchall()
+            self.connection.executemany(
+                "UPDATE turns SET content = ? WHERE idx = ?",
+                ((encode(pickle.loads(content))[2], idx)
+                 for idx, content in rows if content is not None))
+        self.connection.execute(f"PRAGMA user_version={FORMAT}")
+        self.connection.commit()
+        self.connection.execute("VACUUM")
+
+def record(start:int, stop:int, final)->dict:
+    """
+    Build the per-file record in the layout the shelve checkpoint used.
+    """
+    return {'input_index':  slice(start, stop, 2),
+            'output_index': slice(start + 1, stop, 2),
+            'final': bool(final)}
+
+def is_store(path:str)->bool:
+    """
+    True if `path` is a SQLite checkpoint store.
+    """
+    try:
+        connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            tables = {name for name, in connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'")}
+        finally:
+            connection.close()
+    except sqlite3.DatabaseError:
+        return False
+    return {'turns', 'files'} <= tables
+
+def turn_text(turn)->str:
+    return "".join(part.text for part in turn.parts)
+
+def is_plain(turn)->bool:
+    """
+    True if `turn` is a single text part, rebuilt exactly from its text.
+    """
+    if len(turn.parts) != 1:
+        return False
+    part = turn.parts[0]
+    return [field.name for field, _ in type(part).pb(part).ListFields()] == ['text']
+
+def encode(turn)->tuple:
+    """
+    `(role, text, content)` columns of a turn: `content` holds the protobuf
+    bytes of turns that are not plain, None otherwise.
+    """
+    content = None if is_plain(turn) else type(turn).serialize(turn)
+    return turn.role, turn_text(turn), content
+
+def decode(role:str, text:str, content:bytes, format:int=FORMAT):
+    """
+    Rebuild the `Content` of a stored turn.
+    """
+    from google.generativeai import protos
+    if content is None:
+        # built on the raw protobuf classes, several times faster than
+        # through the proto-plus constructors
+        return protos.Content.wrap(protos.Content.pb()(
+            role=role, parts=[protos.Part.pb()(text=text)]))
+    if format == 0:
+        import pickle
+        return pickle.loads(content)
+    return protos.Content.deserialize(content)
+
+def plain_turn(role:str, text:str):
+    return SimpleNamespace(role=role, parts=[SimpleNamespace(text=text)])
+
+def store_path(persist:str)->str:
+    """
+    Path of the store for a `--persist` location, e.g. `database/core.sqlite`.
+    """
+    return os.path.splitext(persist)[0] + '.sqlite'
+
+def migrate_shelve(shelve_path:str, store:CheckpointStore)->int:
+    """
+    One-time copy of a shelve checkpoint into an empty store.
+
+    Returns the number of file records migrated.
+    """
+    import google.ai # used in unpickling
+    with shelve.open(shelve_path, flag='r') as shelf:
+        if 'history' in shelf:
+            store.append_history(shelf['history'])
+        keys = [key for key in shelf.keys() if key != 'history']
+        for key in keys:
+            rec = shelf[key]
+            start = rec['input_index'].start
+            stop = max(rec['input_index'].stop, rec['output_index'].stop)
+            stop += (stop - start) % 2 # older records stopped short of the last turn
+            store.put(key, start, stop, rec.get('final', False))
+    return len(keys)
+
+def open_store(persist:str, readonly:bool=False,
+               keep_history:bool=False)->CheckpointStore:
+    """
+    Open the store for a `--persist` location, migrating the shelve checkpoint
+    at the same location the first time, and upgrading a store with pickled
+    turns.
+    """
+    path = store_path(persist)
+    shelve_path = os.path.splitext(persist)[0] + '.shelve'
+    needs_migration = not os.path.exists(path) and dbm.whichdb(shelve_path)
+    store = CheckpointStore(path, readonly=readonly, keep_history=keep_history)
+    if needs_migration and not readonly:
+        from rich import print
+        n = migrate_shelve(shelve_path, store)
+        print(f"[yellow]Migrated {n} records from {shelve_path} to {path}[/yellow]")
+    return store
+
+def convert(path:str)->str:
+    """
+    Bring a shelve checkpoint or a store with pickled turns to the current
+    format. Returns the path of the store.
+    """
+    if path.endswith('.sqlite'):
+        with CheckpointStore(path) as store:
+            return store.path
+    persist = path[:path.index('.shelve')] + '.shelve' if '.shelve' in path else path
+    with open_store(persist) as store:
+        return store.path
+
+def main(argv=None):
+    import argparse
+    import glob
+    from rich import print
+    parser = argparse.ArgumentParser(description='Convert shelve checkpoints and stores with pickled turns to the current store format.')
+    parser.add_argument('paths', nargs='+', help='Checkpoints, or folders of checkpoints')
+    args = parser.parse_args(argv)
+    paths = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            paths += sorted(glob.glob(os.path.join(path, '*.sqlite')))
+            paths += sorted({p[:p.index('.shelve')] + '.shelve' for p in
+                             glob.glob(os.path.join(path, '*.shelve*'))})
+        else:
+            paths.append(path)
+    for path in paths:
+        print(f"{path} -> {convert(path)}")
+
+if __name__ == '__main__':
+    main()
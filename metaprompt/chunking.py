@@ -0,0 +1,91 @@
+"""
+Token-aware chunking of large input files.
+
+Files too large for a single request are read lazily, optionally through
+mmap, and split on line boundaries into chunks of an estimated number of
+tokens, with some overlap between consecutive chunks. `engine.run_chunked`
+sends each chunk with the prompt and merges the chunk outputs.
+"""
+import mmap
+import os
+from metaprompt import utils
+
+CHARS_PER_TOKEN = 4
+
+CHUNK_PROMPT = "{prompt}\n(The content is part {part} of a larger file.)"
+REDUCE_PROMPT = ("Each <part> above is the result of this request on consecutive "
+                 "parts of one file: {prompt}\nMerge them into a single result "
+                 "for the whole file.")
+
+def estimate_tokens(text:str)->int:
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+def needs_chunking(text_file:str, max_tokens:int=None)->bool:
+    """
+    True if chunking is enabled and the file is estimated over `max_tokens`,
+    judged from its size alone.
+    """
+    if not max_tokens:
+        return False
+    return os.path.getsize(text_file) > max_tokens * CHARS_PER_TOKEN
+
+def iter_lines(path:str, encoding:str='utf-8', use_mmap:bool=False):
+    if not use_mmap:
+        with open(path, 'r', encoding=encoding, errors='replace') as f:
+            yield from f
+        return
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for line in iter(mm.readline, b''):
+                yield line.decode(encoding, errors='replace')
+
+def iter_chunks(path:str, max_tokens:int, overlap_tokens:int=0,
+                encoding:str='utf-8', use_mmap:bool=False):
+    """
+    Lazily split a file into chunks of at most `max_tokens` estimated tokens.
+
+    Chunks end on line boundaries; lines longer than a chunk are cut. Each
+    chunk after the first starts with the trailing lines of the previous one,
+    up to `overlap_tokens` (at most half a chunk) and as many as fit next to
+    the chunk's first new line.
+    """
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    overlap_chars = min(overlap_tokens, max_tokens // 2) * CHARS_PER_TOKEN
+    lines, size = [], 0
+    for line in iter_lines(path, encoding, use_mmap):
+        for i in range(0, max(len(line), 1), max_chars):
+            piece = line[i:i + max_chars]
+            if lines and size + len(piece) > max_chars:
+                yield "".join(lines)
+                # as much overlap as fits next to the piece
+                room = min(overlap_chars, max_chars - len(piece))
+                tail, tail_size = [], 0
+                for previous in reversed(lines):
+                    if tail_size + len(previous) > room:
+                        break
+                    tail.insert(0, previous)
+                    tail_size += len(previous)
+                lines, size = tail, tail_size
+            lines.append(piece)
+            size += len(piece)
+    if lines:
+        yield "".join(lines)
+
+def chunk_key(text_file:str, index:int, args)->str:
+    """
+    Checkpoint key of a chunk; tied to the chunking settings, since other
+    settings cut the file differently.
+    """
+    return f"{text_file}#chunk{index}:{args.chunk_tokens}:{args.chunk_overlap}"
+
+def chunk_prompt(prompt:str, index:int)->str:
+    return CHUNK_PROMPT.format(prompt=prompt, part=index + 1)
+
+def merge_content(outputs:list)->str:
+    return "\n".join(f'<part id="{i + 1}">{output}</part>'
+                     for i, output in enumerate(outputs))
+
+def concat(outputs:list)->str:
+    return "".join(utils.divider(i) + output for i, output in enumerate(outputs))
@@ -0,0 +1,144 @@
+"""
+Bounded conversation context.
+
+By default every file is sent on one chat session that keeps all earlier
+files' turns, so request N resends the content of the N-1 files before it.
+A `ContextPolicy` decides what is resent with each file instead:
+
+- `full`: everything, as before
+- `reset`: only the core history
+- `window`: the core history and the last K files
+- `compact`: like `window`, plus a summary of the files that fell out of it,
+  written once `window` of them have; until then they are sent whole
+
+Whatever the policy, all turns still go to the log that is checkpointed, so
+the checkpoint indices and `load_and_combine_history` are unaffected.
+"""
+import collections
+from metaprompt import utils
+
+MODES = ('full', 'reset', 'window', 'compact')
+
+COMPACT_PROMPT = ("<content>{content}</content>\n"
+                  "<user_request>Summarize the earlier exchanges above in a few "
+                  "short paragraphs, keeping anything needed to handle later "
+                  "files consistently.</user_request>\n")
+
+def summary_turns(summary:str)->list:
+    """
+    A user/model pair that carries the summary of earlier files.
+    """
+    return [{'role': 'user',
+             'parts': [f"<summary>{summary}</summary>\n"
+                       "<user_request>This summarizes the earlier files of this "
+                       "session.</user_request>\n"]},
+            {'role': 'model', 'parts': ["Understood."]}]
+
+class ContextPolicy:
+    """
+    Sets the chat context before each file and splices the file's turns into
+    the log afterwards.
+
+    Inputs
+    ------
+    mode : str
+        one of MODES
+    model : GenerativeModel
+        used to write summaries in `compact` mode
+    core_history : list
+        the history of the core script
+    chat_session : ChatSession
+        the session, started on the combined (checkpointed) history
+    window : int
+        number of recent files kept in `window` and `compact` modes
+    ranges : list
+        `(start, stop)` log ranges of files already processed, oldest first,
+        to seed the window on resume; in `compact` mode the summary of the
+        ranges before the window is rebuilt before the next file
+    """
+
+    def __init__(self, mode:str, model, core_history:list, chat_session,
+                 window:int=1, ranges:list=()):
+        if mode not in MODES:
+            raise ValueError(f"Context mode {mode} is not one of {MODES}")
+        self.mode = mode
+        self.model = model
+        self.core_history = list(core_history)
+        self.window = window if mode in ('window', 'compact') else 0
+        # in full mode the chat history is the log
+        self.log = (chat_session.history if mode == 'full'
+                    else list(chat_session.history))
+        ranges = list(ranges)
+        self.recent = collections.deque(ranges[-self.window:] if self.window else ())
+        # files of an earlier run that fell out of the window
+        self.evicted = ranges[:-self.window] if mode == 'compact' else []
+        self.summary = None
+        self._resumed = bool(self.evicted)
+        self._spliced = 0
+
+    def context(self)->list:
+        turns = list(self.core_history)
+        if self.summary:
+            turns += summary_turns(self.summary)
+        # files that fell out of the window are sent until they are summarized
+        for start, stop in [*self.evicted, *self.recent]:
+            turns += self.log[start:stop]
+        return turns
+
+    def snapshot(self, chat_session)->list:
+        """
+        A copy of the turns the next file would be sent with.
+        """
+        if self.mode == 'full':
+            return list(chat_session.history)
+        return self.context()
+
+    def begin(self, chat_session)->int:
+        """
+        Set the context for the next file. Returns the index in
+        `chat_session.history` where the file's turns will start.
+        """
+        self._spliced = 0
+        if self._resumed:
+            self._resumed = False
+            self.compact()
+        if self.mode != 'full':
+            chat_session.history = self.context()
+        return len(chat_session.history)
+
+    def end(self, chat_session, start_index:int, final:bool=True)->int:
+        """
+        Splice the file's turns from `start_index` into the log; can be called
+        again for the same file, e.g. when saving before the final answer.
+        Returns the log index of the file's first turn.
+        """
+        if self.mode == 'full':
+            return start_index
+        turns = chat_session.history[start_index:]
+        log_start = len(self.log) - self._spliced
+        self.log.extend(turns[self._spliced:])
+        self._spliced = len(turns)
+        if final and self.window:
+            self.recent.append((log_start, len(self.log)))
+            while len(self.recent) > self.window:
+                evicted = self.recent.popleft()
+                if self.mode == 'compact':
+                    self.evicted.append(evicted)
+            if len(self.evicted) >= self.window:
+                self.compact()
+        return log_start
+
+    def compact(self):
+        """
+        Fold the files that fell out of the window into the running summary,
+        with one request on a chat forked from the core history.
+        """
+        content = [f"<summary>{self.summary}</summary>"] if self.summary else []
+        for start, stop in self.evicted:
+            content += [f"<{turn.role}>{turn.parts[0].text}</{turn.role}>"
+                        for turn in self.log[start:stop]]
+        chat = self.model.start_chat(history=self.core_history)
+        response = utils.send_message(
+            chat, COMPACT_PROMPT.format(content="\n".join(content)))
+        self.summary = response.parts[0].text
+        self.evicted = []
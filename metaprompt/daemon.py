@@ -0,0 +1,434 @@
+"""
+Long-lived daemon serving `apply` jobs from a local job queue.
+
+Every `apply.py` invocation pays for importing the SDK and executing the
+core script before it sends anything. The daemon pays once: it keeps the
+process, the models built by each core script, the request scheduler and
+the checkpoint stores with their loaded history warm, and runs jobs
+submitted over a Unix socket.
+
+    python -m metaprompt.daemon serve --workers 4
+    python -m metaprompt.daemon submit corpus/ core_example.py --prompt "..." --priority 5
+    python -m metaprompt.daemon status
+
+A job is the command line of a non-interactive `apply.py` run. The client
+parses it, so mistakes are reported before anything is queued. Jobs go into
+a SQLite queue, highest priority first, then oldest first. The queue
+survives restarts: jobs that were running when the daemon stopped are run
+again, and resume from their checkpoints. A pool of `workers` threads
+serves the queue. Jobs writing to the same checkpoint store, or the same
+JSONL or Parquet output (see `sinks`), run one at a time. `submit` streams
+each finished file back, and the job's counts, unless `--no-wait` is given.
+
+Relative paths are resolved against the client's working directory. Jobs
+submitted from the daemon's own working directory keep them as given, so
+their checkpoint keys match those of `apply.py` runs there. Rate limits,
+telemetry and the search index are those of the daemon, shared by all jobs.
+"""
+import argparse
+import contextlib
+import json
+import os
+import queue
+import socket
+import socketserver
+import sqlite3
+import sys
+import threading
+import time
+
+SOCKET = "database/metaprompt.sock"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id        INTEGER PRIMARY KEY AUTOINCREMENT,
+    priority  INTEGER NOT NULL DEFAULT 0,
+    status    TEXT NOT NULL DEFAULT 'queued',
+    args      TEXT NOT NULL,
+    cwd       TEXT NOT NULL,
+    submitted REAL NOT NULL,
+    finished  REAL,
+    counts    TEXT,
+    error     TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority DESC, id);
+"""
+
+# arguments holding paths relative to the working directory
+PATH_ARGS = ('persist', 'cache_path', 'prefix_cache_path', 'dedup_report',
+             'sink_path')
+
+class JobQueue:
+    """
+    Persistent priority queue of jobs, safe to share between threads.
+    """
+
+    def __init__(self, path:str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+
+    def submit(self, args:dict, cwd:str, priority:int=0, on_queued=None)->int:
+        """
+        Queue a job. `on_queued(job)` is called before any worker can claim
+        it, e.g. to start listening to its events.
+        """
+        with self.lock:
+            job = self.connection.execute(
+                "INSERT INTO jobs (priority, args, cwd, submitted) VALUES (?, ?, ?, ?)",
+                (priority, json.dumps(args), cwd, time.time())).lastrowid
+            self.connection.commit()
+            if on_queued is not None:
+                on_queued(job)
+            self.available.notify()
+        return job
+
+    def claim(self, timeout:float=None):
+        """
+        Mark the next queued job running and return `(id, args, cwd)`,
+        waiting up to `timeout` seconds for one. None on timeout.
+        """
+        with self.lock:
+            while True:
+                row = self.connection.execute(
+                    "SELECT id, args, cwd FROM jobs WHERE status = 'queued' "
+                    "ORDER BY priority DESC, id LIMIT 1").fetchone()
+                if row is not None:
+                    self.connection.execute(
+                        "UPDATE jobs SET status = 'running' WHERE id = ?", (row[0],))
+                    self.connection.commit()
+                    return row[0], json.loads(row[1]), row[2]
+                if not self.available.wait(timeout):
+                    return None
+
+    def finish(self, job:int, counts:dict=None, error:str=None):
+        with self.lock:
+            self.connection.execute(
+                "UPDATE jobs SET status = ?, finished = ?, counts = ?, error = ? "
+                "WHERE id = ?", ('failed' if error else 'done', time.time(),
+                                 json.dumps(counts), error, job))
+            self.connection.commit()
+
+    def requeue(self)->int:
+        """
+        Queue again the jobs left running by a previous daemon.
+        """
+        with self.lock:
+            n = self.connection.execute(
+                "UPDATE jobs SET status = 'queued' WHERE status = 'running'").rowcount
+            self.connection.commit()
+        return n
+
+    def jobs(self, job:int=None, limit:int=20)->list:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id, priority, status, submitted, finished, counts, error "
+                "FROM jobs WHERE ? IS NULL OR id = ? ORDER BY id DESC LIMIT ?",
+                (job, job, limit)).fetchall()
+        names = ('id', 'priority', 'status', 'submitted', 'finished', 'counts', 'error')
+        return [dict(zip(names, row)) for row in rows]
+
+    def close(self):
+        self.connection.close()
+
+def localize(args:argparse.Namespace, cwd:str)->argparse.Namespace:
+    """
+    Resolve the relative paths of a job against the client's `cwd`, unless
+    that is the daemon's working directory.
+    """
+    if os.path.abspath(cwd) == os.getcwd():
+        return args
+    args.text_files = [os.path.join(cwd, path) for path in args.text_files]
+    if getattr(args, 'sink', 'files') != 'files' and not args.sink_path:
+        from metaprompt import sinks
+        args.sink_path = sinks.default_path(args)
+    for name in PATH_ARGS:
+        value = getattr(args, name, None)
+        if value:
+            setattr(args, name, os.path.join(cwd, value))
+    return args
+
+class Daemon:
+    """
+    Inputs
+    ------
+    queue_path : str
+        SQLite file of the job queue
+    workers : int
+        number of jobs run at once
+    """
+
+    def __init__(self, queue_path:str, workers:int=2):
+        from metaprompt import telemetry
+        self.jobs = JobQueue(queue_path)
+        self.workers = workers
+        self.cores = {}
+        self.cores_lock = threading.Lock()
+        self.store_locks = {}
+        self.stores = {}
+        self.subscribers = {}
+        self.subscribers_lock = threading.Lock()
+        self.current = threading.local()
+        self.stopping = threading.Event()
+        self.telemetry = telemetry.current()
+        self.telemetry.subscribe(self.on_event)
+
+    def core(self, args:argparse.Namespace)->dict:
+        """
+        The core script's model and history, run once per version of the
+        script.
+        """
+        from metaprompt import utils
+        path = utils.find_core(args.core)
+        if path is None:
+            raise FileNotFoundError(f"Core script {args.core} not found.")
+        key = (path, os.path.getmtime(path))
+        with self.cores_lock:
+            if key not in self.cores:
+                print(f"Loading core {path}")
+                self.cores = {k: v for k, v in self.cores.items() if k[0] != path}
+                self.cores[key] = utils.run_core_script(args)
+            return self.cores[key]
+
+    def store_locks_for(self, args:argparse.Namespace)->list:
+        """
+        The locks of the checkpoint store and bulk output sink of a job, in
+        a fixed order so that jobs sharing either never deadlock.
+        """
+        from metaprompt import sharding, sinks
+        paths = {sharding.persist_path(args)}
+        if getattr(args, 'sink', 'files') != 'files':
+            paths.add(os.path.abspath(sinks.sink_path(args)))
+        with self.cores_lock:
+            return [self.store_locks.setdefault(path, threading.Lock())
+                    for path in sorted(paths)]
+
+    def store(self, args:argparse.Namespace)->'checkpoint.CheckpointStore':
+        """
+        The open checkpoint store of a job, kept with its loaded history
+        between jobs; opened again if another process wrote to it. Call with
+        the store's lock held.
+        """
+        from metaprompt import checkpoint, sharding
+        path = sharding.persist_path(args)
+        store = self.stores.get(path)
+        if store is not None and store.stale():
+            self.drop_store(store) # its runs were committed on release
+            store = None
+        if store is None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            store = checkpoint.open_store(path, keep_history=True)
+            self.stores[path] = store
+        return store
+
+    def drop_store(self, store:'checkpoint.CheckpointStore'):
+        """
+        Close a store without committing and forget it, e.g. once its job
+        failed, which loses what the job did not commit, as a crash would.
+        """
+        self.stores.pop(store.path, None)
+        store.connection.rollback()
+        store.connection.close()
+
+    def publish(self, job:int, event:dict):
+        with self.subscribers_lock:
+            listeners = list(self.subscribers.get(job, ()))
+        for listener in listeners:
+            listener.put(event)
+
+    def on_event(self, event:dict):
+        # files are reported on the thread running their job
+        job = getattr(self.current, 'job', None)
+        if job is not None and event['event'] == 'file':
+            self.publish(job, {'event': 'file', 'job': job, 'file': event['file']})
+
+    def listen(self, job:int)->queue.Queue:
+        events = queue.Queue()
+        with self.subscribers_lock:
+            self.subscribers.setdefault(job, []).append(events)
+        return events
+
+    def unlisten(self, job:int, events:queue.Queue):
+        with self.subscribers_lock:
+            self.subscribers.get(job, []).remove(events)
+
+    def run_job(self, job:int, values:dict, cwd:str)->dict:
+        from metaprompt import apply
+        args = localize(argparse.Namespace(**values), cwd)
+        # nobody is there to answer prompts
+        args.yes, args.newprompt_on_break = True, False
+        core = self.core(args)
+        with contextlib.ExitStack() as held:
+            for lock in self.store_locks_for(args):
+                held.enter_context(lock)
+            store = self.store(args)
+            try:
+                return apply.run(args, core=core, store=store)
+            except BaseException:
+                self.drop_store(store)
+                raise
+
+    def work(self):
+        while not self.stopping.is_set():
+            claimed = self.jobs.claim(timeout=0.5)
+            if claimed is None:
+                continue
+            job, values, cwd = claimed
+            self.current.job = job
+            self.publish(job, {'event': 'running', 'job': job})
+            try:
+                counts = self.run_job(job, values, cwd)
+            except BaseException as e: # a job must not take its worker down
+                self.jobs.finish(job, error=f"{type(e).__name__}: {e}")
+                self.publish(job, {'event': 'failed', 'job': job, 'error': str(e)})
+            else:
+                self.jobs.finish(job, counts)
+                self.publish(job, {'event': 'done', 'job': job, 'counts': counts})
+            finally:
+                self.current.job = None
+
+    def serve(self, path:str=SOCKET):
+        requeued = self.jobs.requeue()
+        if requeued:
+            print(f"Requeued {requeued} interrupted jobs")
+        for _ in range(self.workers):
+            threading.Thread(target=self.work, daemon=True).start()
+        if os.path.exists(path):
+            os.remove(path)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        daemon = self
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                request = json.loads(self.rfile.readline())
+                def send(message):
+                    self.wfile.write((json.dumps(message) + "\n").encode('utf-8'))
+                    self.wfile.flush()
+                daemon.handle(request, send)
+        self.server = socketserver.ThreadingUnixStreamServer(path, Handler)
+        self.server.daemon_threads = True
+        print(f"Serving on {path} with {self.workers} workers")
+        try:
+            self.server.serve_forever()
+        finally:
+            self.stopping.set()
+            self.server.server_close()
+            self.telemetry.unsubscribe(self.on_event)
+            # stores of jobs still running are left as a crash would leave them
+            for path, store in list(self.stores.items()):
+                lock = self.store_locks[path]
+                if lock.acquire(blocking=False):
+                    store.close()
+                    lock.release()
+            os.remove(path)
+
+    def handle(self, request:dict, send):
+        if request['op'] == 'status':
+            send({'jobs': self.jobs.jobs(request.get('job'))})
+        elif request['op'] == 'submit':
+            listening = []
+            def on_queued(job):
+                if request.get('wait', True):
+                    listening.append(self.listen(job))
+            job = self.jobs.submit(request['args'], request['cwd'],
+                                   request.get('priority', 0), on_queued)
+            events = listening[0] if listening else None
+            send({'event': 'queued', 'job': job})
+            if events is None:
+                return
+            try:
+                while True:
+                    event = events.get()
+                    send(event)
+                    if event['event'] in ('done', 'failed'):
+                        return
+            finally:
+                self.unlisten(job, events)
+        elif request['op'] == 'shutdown':
+            send({'event': 'shutdown'})
+            threading.Thread(target=self.server.shutdown).start()
+        else:
+            send({'error': f"unknown op {request['op']}"})
+
+def request(message:dict, path:str=SOCKET):
+    """
+    Send one request to the daemon and yield its replies.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall((json.dumps(message) + "\n").encode('utf-8'))
+        with sock.makefile('r') as replies:
+            for line in replies:
+                yield json.loads(line)
+
+def submit(argv:list, priority:int=0, wait:bool=True, path:str=SOCKET):
+    """
+    Parse an `apply.py` command line and submit it as a job, yielding the
+    daemon's events for it.
+    """
+    from metaprompt import apply, utils
+    args = apply.build_parser().parse_args(argv)
+    utils.resolve_core(args)
+    args.core = utils.find_core(args.core) or args.core
+    if not args.prompt:
+        raise SystemExit("Jobs need a --prompt.")
+    yield from request({'op': 'submit', 'args': vars(args), 'cwd': os.getcwd(),
+                        'priority': priority, 'wait': wait}, path)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run apply jobs on a long-lived daemon.')
+    parser.add_argument('--socket', default=SOCKET, help='Unix socket of the daemon')
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve = commands.add_parser('serve', help='Run the daemon')
+    serve.add_argument('--workers', type=int, default=2, help='Jobs run at once')
+    serve.add_argument('--queue', default="database/jobs.sqlite", help='File location of the job queue')
+    serve.add_argument('--rpm', type=float, default=None, help='Requests per minute, shared by all jobs')
+    serve.add_argument('--tpm', type=float, default=None, help='Estimated tokens per minute, shared by all jobs')
+    serve.add_argument('--concurrency', type=int, default=None, help='Requests in flight at once, shared by all jobs')
+    serve.add_argument('--max_retries', type=int, default=5, help='Retries of a throttled or transient failure')
+    serve.add_argument('--index_path', default="database/search.sqlite", help='Full-text search index updated by all jobs (empty to disable)')
+    serve.add_argument('--trace', default=None, help='Append the telemetry of all jobs to this JSONL file')
+    submit_parser = commands.add_parser('submit', help='Queue an apply.py command line (after --) and stream its results')
+    submit_parser.add_argument('--priority', type=int, default=0, help='Higher priorities run first')
+    submit_parser.add_argument('--no-wait', dest='wait', action='store_false', help='Return once the job is queued')
+    submit_parser.add_argument('apply_args', nargs=argparse.REMAINDER, help='apply.py arguments')
+    status = commands.add_parser('status', help='Show recent jobs')
+    status.add_argument('job', type=int, nargs='?', default=None)
+    commands.add_parser('shutdown', help='Stop the daemon')
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        from metaprompt import ratelimit, search, telemetry
+        telemetry.configure(args.trace)
+        ratelimit.configure(rpm=args.rpm, tpm=args.tpm,
+                            concurrency=args.concurrency,
+                            max_retries=args.max_retries)
+        search.configure(args.index_path or None)
+        Daemon(args.queue, args.workers).serve(args.socket)
+        return
+    if args.command == 'submit':
+        apply_args = args.apply_args[1:] if args.apply_args[:1] == ['--'] else args.apply_args
+        failed = False
+        for event in submit(apply_args, args.priority, args.wait, args.socket):
+            if event['event'] == 'file':
+                print(f"done {event['file']}")
+            elif event['event'] == 'failed':
+                print(f"job {event['job']} failed: {event['error']}", file=sys.stderr)
+                failed = True
+            else:
+                print(json.dumps(event))
+        return 1 if failed else 0
+    if args.command == 'status':
+        for job in next(request({'op': 'status', 'job': args.job}, args.socket))['jobs']:
+            print(json.dumps(job))
+        return 0
+    if args.command == 'shutdown':
+        list(request({'op': 'shutdown'}, args.socket))
+        return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
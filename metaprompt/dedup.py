@@ -0,0 +1,263 @@
+"""
+Duplicate and near-duplicate input detection.
+
+Corpora of reviews or emails repeat themselves: exact copies, and near
+copies differing in a signature or a templated line. A pre-pass over the
+expanded file list groups inputs into clusters, so only the first file of
+each cluster, its representative, is sent to the model:
+
+- exact duplicates share the SHA-256 of their content,
+- near duplicates (`mode='near'`) have MinHash signatures of their word
+  shingles agreeing on at least `threshold` of their slots, an estimate of
+  the Jaccard similarity. Candidates are found with banded locality
+  sensitive hashing rather than by comparing every pair.
+
+A duplicate whose representative is done is written from the
+representative's output and checkpointed under a record pointing at the
+representative's turns, see `fan_out`. Near duplicates can instead be
+flagged for review: interactively, the representative's response is shown
+for approval in place of a request.
+"""
+import hashlib
+import json
+import random
+import re
+from metaprompt import checkpoint, chunking, sinks, telemetry
+
+MODES = ('off', 'exact', 'near')
+
+# modulus of the MinHash permutations, a Mersenne prime
+PRIME = (1 << 61) - 1
+
+def shingles(text:str, k:int=5)->set:
+    """
+    Hashes of the lower-cased word `k`-grams of `text`.
+    """
+    words = re.findall(r'\w+', text.lower())
+    grams = ([" ".join(words[i:i + k]) for i in range(len(words) - k + 1)]
+             if len(words) > k else [" ".join(words)])
+    return {int.from_bytes(hashlib.blake2b(gram.encode('utf-8'),
+                                           digest_size=8).digest(), 'little')
+            for gram in grams}
+
+def bands_for(threshold:float, num_perm:int)->int:
+    """
+    Number of LSH bands for `num_perm` slots: the fewest whose similarity
+    threshold, about (1/bands)**(1/rows), is at most `threshold`, so that
+    pairs above it are rarely missed.
+    """
+    for bands in sorted(b for b in range(1, num_perm + 1) if num_perm % b == 0):
+        rows = num_perm // bands
+        if (1 / bands) ** (1 / rows) <= threshold:
+            return bands
+    return num_perm
+
+class MinHasher:
+    """
+    MinHash signatures of `num_perm` slots, one random hash permutation
+    `(a * h + b) mod PRIME` per slot.
+    """
+
+    def __init__(self, num_perm:int=128, seed:int=1):
+        rng = random.Random(seed)
+        self.permutations = [(rng.randrange(1, PRIME), rng.randrange(PRIME))
+                             for _ in range(num_perm)]
+
+    def signature(self, text:str)->tuple:
+        hashes = shingles(text)
+        return tuple(min((a * h + b) % PRIME for h in hashes)
+                     for a, b in self.permutations)
+
+def similarity(a:tuple, b:tuple)->float:
+    """
+    Estimated Jaccard similarity of two signatures.
+    """
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+class Deduplicator:
+    """
+    Assign inputs, in order, to clusters: `add` returns the representative
+    an input duplicates, or None if it starts a cluster of its own.
+
+    Inputs
+    ------
+    near : bool
+        also match near duplicates, not only exact ones
+    threshold : float
+        estimated Jaccard similarity at which inputs are near duplicates
+    num_perm : int
+        slots of the MinHash signatures
+    """
+
+    def __init__(self, near:bool=True, threshold:float=0.9, num_perm:int=128,
+                 seed:int=1):
+        self.near = near
+        self.threshold = threshold
+        self.hasher = MinHasher(num_perm, seed)
+        self.bands = bands_for(threshold, num_perm)
+        self.rows = num_perm // self.bands
+        self.exact = {}
+        self.signatures = {}
+        self.buckets = [{} for _ in range(self.bands)]
+
+    def band_keys(self, signature:tuple):
+        for band in range(self.bands):
+            yield band, signature[band * self.rows:(band + 1) * self.rows]
+
+    def add(self, key:str, text:str):
+        """
+        Returns
+        -------
+        None if `key` is a new representative, otherwise
+        `(representative, similarity)`; the similarity is 1.0 for exact
+        duplicates and for near duplicates with identical signatures
+        """
+        digest = hashlib.sha256(text.encode('utf-8')).digest()
+        if digest in self.exact:
+            return self.exact[digest], 1.0
+        self.exact[digest] = key
+        if not self.near:
+            return None
+        signature = self.hasher.signature(text)
+        candidates = {rep for band, rows in self.band_keys(signature)
+                      for rep in self.buckets[band].get(rows, ())}
+        best = max(((similarity(signature, self.signatures[rep]), rep)
+                    for rep in candidates), default=(0.0, None))
+        if best[0] >= self.threshold:
+            # later exact copies join the same cluster directly
+            self.exact[digest] = best[1]
+            return best[1], best[0]
+        self.signatures[key] = signature
+        for band, rows in self.band_keys(signature):
+            self.buckets[band].setdefault(rows, []).append(key)
+        return None
+
+class DedupPlan:
+    """
+    The clusters found by `plan`, and what became of their duplicates.
+
+    `members` maps each duplicate to `(representative, similarity)`.
+    """
+
+    def __init__(self):
+        self.members = {}
+        self.sizes = {}
+        self.prompts = {}
+        self.deferred = []
+        self.outcomes = {}
+        self.files = 0
+
+    def __contains__(self, key:str):
+        return key in self.members
+
+    def done(self, representative:str, prompt:str):
+        """
+        Note that `representative` was processed in this run with `prompt`.
+        """
+        self.prompts[representative] = prompt
+
+    def source(self, key:str, prompt:str, store:checkpoint.CheckpointStore):
+        """
+        The `(representative, similarity)` to reuse for `key`, or None if it
+        is not a duplicate, or its representative is not finalized or was
+        processed with another prompt in this run.
+        """
+        if key not in self.members:
+            return None
+        representative, similarity = self.members[key]
+        if self.prompts.get(representative, prompt) != prompt:
+            return None
+        if not store.get(representative, {}).get('final'):
+            return None
+        return representative, similarity
+
+    def defer(self, text_files):
+        """
+        Pass on the files that are not duplicates, setting the duplicates
+        aside in `deferred` until their representatives are done.
+        """
+        for text_file in text_files:
+            if text_file in self.members:
+                self.deferred.append(text_file)
+            else:
+                yield text_file
+
+    def record(self, key:str, outcome:str):
+        """
+        `outcome` is 'copied', 'reviewed' (both without a request) or 'sent'.
+        """
+        self.outcomes[key] = outcome
+
+    def report(self)->str:
+        exact = sum(s == 1.0 for _, s in self.members.values())
+        avoided = [k for k, o in self.outcomes.items() if o != 'sent']
+        tokens = sum(self.sizes[k] for k in avoided) // chunking.CHARS_PER_TOKEN
+        sent = len(self.outcomes) - len(avoided)
+        return (f"Dedup: {self.files} files in {self.files - len(self.members)} "
+                f"clusters ({exact} exact, {len(self.members) - exact} near "
+                f"duplicates); {len(avoided)} requests avoided "
+                f"(~{tokens} input tokens), {sent} duplicates sent")
+
+    def write_report(self, path:str):
+        """
+        One JSON line per duplicate: its representative, similarity and
+        outcome, with near duplicates copied without review flagged.
+        """
+        with open(path, 'w') as f:
+            for key, (representative, similarity) in self.members.items():
+                outcome = self.outcomes.get(key)
+                f.write(json.dumps({'file': key, 'representative': representative,
+                                    'similarity': round(similarity, 4),
+                                    'outcome': outcome,
+                                    'review': outcome == 'copied' and similarity < 1.0})
+                        + "\n")
+
+def plan(text_files, mode:str='exact', threshold:float=0.9,
+         chunk_tokens:int=None):
+    """
+    Read every file once and cluster them. Files large enough to be chunked
+    are left out.
+
+    Returns
+    -------
+    text_files : list
+        the files, in their original order
+    plan : DedupPlan
+        the duplicates found
+    """
+    deduplicator = Deduplicator(near=mode == 'near', threshold=threshold)
+    result = DedupPlan()
+    files = []
+    with telemetry.phase('dedup'):
+        for text_file in text_files:
+            files.append(text_file)
+            if chunking.needs_chunking(text_file, chunk_tokens):
+                continue
+            with open(text_file, 'r', errors='replace') as f:
+                text = f.read()
+            match = deduplicator.add(text_file, text)
+            if match is not None:
+                result.members[text_file] = match
+                result.sizes[text_file] = len(text)
+    result.files = len(files)
+    return files, result
+
+def output_text(store:checkpoint.CheckpointStore, representative:str)->str:
+    """
+    The last response recorded for `representative`.
+    """
+    stop = store[representative]['output_index'].stop
+    return store.texts(stop - 1, stop)[0][2]
+
+def fan_out(args, store:checkpoint.CheckpointStore, representative:str,
+            key:str)->str:
+    """
+    Finalize `key` with the turns of `representative`, without new turns or
+    requests, and write its output to the store's sink (see `sinks`).
+    Returns the output filename.
+    """
+    rec = store[representative]
+    start, stop = rec['input_index'].start, rec['output_index'].stop
+    store.put(key, start, stop, final=True)
+    return sinks.of(store).write(key, args, store.texts(start, stop),
+                                 copied_from=representative)
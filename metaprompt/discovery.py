@@ -0,0 +1,162 @@
+"""
+Lazy, filterable file discovery.
+
+`iter_files` walks folders with `os.scandir` and yields files as they are
+found, so processing can start before the walk is done and the full listing
+never has to be held in memory. Version control folders, ignored paths,
+oversized files and files that do not decode as text are skipped on the way.
+"""
+import codecs
+import fnmatch
+import os
+
+DEFAULT_EXCLUDE = ('.git', '.hg', '.svn', '__pycache__')
+IGNORE_FILES = ('.gitignore', '.metapromptignore')
+SNIFF_BYTES = 8192
+
+def read_ignore_file(path:str)->list:
+    """
+    Read the rules of a gitignore-style file as `(base, pattern, dir_only,
+    anchored)` tuples. Negated (`!`) patterns are not supported and skipped.
+    """
+    rules = []
+    base = os.path.dirname(path)
+    with open(path, 'r', errors='replace') as f:
+        for line in f:
+            pattern = line.strip()
+            if not pattern or pattern.startswith(('#', '!')):
+                continue
+            dir_only = pattern.endswith('/')
+            pattern = pattern.rstrip('/')
+            anchored = '/' in pattern
+            rules.append((base, pattern.lstrip('/'), dir_only, anchored))
+    return rules
+
+def is_ignored(rules:list, path:str, is_dir:bool)->bool:
+    name = os.path.basename(path)
+    for base, pattern, dir_only, anchored in rules:
+        if dir_only and not is_dir:
+            continue
+        target = os.path.relpath(path, base) if anchored else name
+        if fnmatch.fnmatch(target, pattern):
+            return True
+    return False
+
+def matches(globs, path:str, top:str)->bool:
+    """
+    True if any glob matches the file name or its path relative to `top`.
+    """
+    name, rel = os.path.basename(path), os.path.relpath(path, top)
+    return any(fnmatch.fnmatch(name, g) or fnmatch.fnmatch(rel, g)
+               for g in globs)
+
+def is_text(path:str, encoding:str='utf-8')->bool:
+    """
+    Sniff the start of a file: no NUL bytes, and it decodes with `encoding`.
+    """
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(SNIFF_BYTES)
+    except OSError:
+        return False
+    if b'\0' in head:
+        return False
+    try: # not final, a multi-byte character may be cut at the end
+        codecs.getincrementaldecoder(encoding)().decode(head, final=False)
+    except (UnicodeDecodeError, LookupError):
+        return False
+    return True
+
+def sort_order(sort):
+    """
+    Map the `--sort` values onto None (unsorted), False (forward) or True
+    (reverse).
+    """
+    if sort == "acc" or sort == "forward" or sort == True:
+        return False
+    elif sort == "dec" or sort == "rev" or sort == "reverse":
+        return True
+    return None
+
+def walk(top:str, include=None, exclude=DEFAULT_EXCLUDE, max_bytes:int=None,
+         binary:bool=False, encoding:str='utf-8', ignore_files=IGNORE_FILES,
+         sort=None):
+    """
+    Yield the files under `top` that pass the filters, depth first.
+
+    Sorting is per directory listing, so it only ever holds one directory in
+    memory; the order is deterministic but not a global sort of the paths.
+    """
+    reverse = sort_order(sort)
+    stack = [(top, [])]
+    while stack:
+        directory, rules = stack.pop()
+        rules = rules + [rule for name in ignore_files or ()
+                         if os.path.isfile(os.path.join(directory, name))
+                         for rule in read_ignore_file(os.path.join(directory, name))]
+        subdirs = []
+        try:
+            with os.scandir(directory) as it:
+                entries = it if reverse is None else \
+                          sorted(it, key=lambda e: e.name, reverse=reverse)
+                for entry in entries:
+                    if exclude and matches(exclude, entry.path, top):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        if not is_ignored(rules, entry.path, True):
+                            subdirs.append(entry.path)
+                        continue
+                    if not entry.is_file() or is_ignored(rules, entry.path, False):
+                        continue
+                    if include and not matches(include, entry.path, top):
+                        continue
+                    if max_bytes is not None and entry.stat().st_size > max_bytes:
+                        continue
+                    if not binary and not is_text(entry.path, encoding):
+                        continue
+                    yield entry.path
+        except OSError:
+            continue
+        stack.extend((subdir, rules) for subdir in reversed(subdirs))
+
+def accepts(path:str, top:str, include=None, exclude=DEFAULT_EXCLUDE,
+            max_bytes:int=None, binary:bool=False, encoding:str='utf-8',
+            ignore_files=IGNORE_FILES)->bool:
+    """
+    True if `walk(top)` would yield the file `path`, checked on its own,
+    e.g. for a file that just changed.
+    """
+    rel = os.path.relpath(path, top)
+    if rel.startswith(os.pardir) or not os.path.isfile(path):
+        return False
+    rules, directory = [], top
+    for name in rel.split(os.sep)[:-1]:
+        rules += [rule for ignore in ignore_files or ()
+                  if os.path.isfile(os.path.join(directory, ignore))
+                  for rule in read_ignore_file(os.path.join(directory, ignore))]
+        directory = os.path.join(directory, name)
+        if (exclude and matches(exclude, directory, top)) \
+                or is_ignored(rules, directory, True):
+            return False
+    rules += [rule for ignore in ignore_files or ()
+              if os.path.isfile(os.path.join(directory, ignore))
+              for rule in read_ignore_file(os.path.join(directory, ignore))]
+    if (exclude and matches(exclude, path, top)) or is_ignored(rules, path, False):
+        return False
+    if include and not matches(include, path, top):
+        return False
+    if max_bytes is not None and os.path.getsize(path) > max_bytes:
+        return False
+    return binary or is_text(path, encoding)
+
+def iter_files(paths, sort=None, **filters):
+    """
+    Lazily expand a list of files and folders. Files given explicitly are
+    yielded as they are; folders are walked with `walk`, see there for the
+    `filters`.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            yield from walk(path, sort=sort, **filters)
+        else:
+            yield path
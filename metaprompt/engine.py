@@ -0,0 +1,288 @@
+"""
+Concurrent, non-interactive batch engine for `apply.py --yes`.
+
+Every file is sent on its own chat, forked from the core history returned by
+the core script, so requests never depend on one another and can run on a
+worker pool. Finished files are handed back to the calling thread in
+completion order, and only that thread touches the checkpoint and the output
+files.
+"""
+import concurrent.futures
+import os
+import time
+from rich import print
+from metaprompt import utils, checkpoint, cache, chunking, sinks, telemetry
+
+
+def format_message(text:str, inst:str='user_request',
+                   file_content:str=None)->str:
+    """
+    Build a message of the interactive loop in `apply.py`: `text` wrapped in
+    an `inst` tag, after the file's content on the first turn.
+    """
+    return (
+       f"""
+               {f'<content>{file_content}</content>' if file_content is not None else ''}
+               """
+       f'<{inst}>{text}</{inst}>\n'
+       )
+
+def format_first_message(file_content:str, prompt:str)->str:
+    """
+    Build the opening message for a file, identical to the one sent by the
+    interactive loop in `apply.py`.
+    """
+    return format_message(prompt, 'user_request', file_content)
+
+def read_text_file(text_file:str)->str:
+    with open(text_file, 'r') as f:
+        return f.read()
+
+def send_forked(model, core_history:list, content:str, prompt:str,
+                response_cache:cache.ResponseCache=None, fingerprint:str=None,
+                stream_to:str=None):
+    """
+    Send `content` with `prompt` on a chat forked from the core history. With
+    a `response_cache`, `fingerprint` is the `cache.core_fingerprint` of the
+    core history and model. With `stream_to`, the response is streamed into
+    that (output) file as it is generated.
+
+    Returns
+    -------
+    turns : list
+        the new turns (user message and model response)
+    response : GenerateContentResponse
+        the raw response
+    """
+    chat = model.start_chat(history=core_history)
+    key = (cache.cache_key(fingerprint, prompt, content)
+           if response_cache is not None else None)
+    message = format_first_message(content, prompt)
+    if stream_to is None:
+        response = utils.send_message(chat, message, key=key,
+                                      response_cache=response_cache)
+    else:
+        if os.path.dirname(stream_to):
+            os.makedirs(os.path.dirname(stream_to), exist_ok=True)
+        with open(stream_to, 'w') as out_f:
+            response = utils.send_message(chat, message, key=key,
+                                          response_cache=response_cache,
+                                          stream=True, out_f=out_f, echo=False)
+    return chat.history[len(core_history):], response
+
+def process_file(model, core_history:list, text_file:str, prompt:str,
+                 response_cache:cache.ResponseCache=None, fingerprint:str=None,
+                 stream_to:str=None):
+    """
+    Send a single file on a chat forked from the core history, see
+    `send_forked`.
+
+    Returns
+    -------
+    text_file : str
+        the processed file
+    turns : list
+        the new turns (user message and model response)
+    response : GenerateContentResponse
+        the raw response
+    """
+    turns, response = send_forked(model, core_history,
+                                  read_text_file(text_file), prompt,
+                                  response_cache, fingerprint, stream_to)
+    return text_file, turns, response
+
+def timed(function, *args, **kwargs):
+    """
+    Call `function`, e.g. on a worker, returning its result and the seconds
+    the call took.
+    """
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def record_turns(args, chat_session, key:str, turns:list,
+                 store:checkpoint.CheckpointStore=None,
+                 history:list=None)->int:
+    """
+    Splice the turns of a forked chat onto the log, `chat_session.history`
+    unless a `history` is given, and checkpoint them under `key`. Returns the
+    index of the first spliced turn.
+    """
+    history = chat_session.history if history is None else history
+    start_index = len(history)
+    history.extend(turns)
+    utils.persist_text_file_conversation(args, chat_session, key, start_index,
+                                         is_final=True, store=store,
+                                         history=history)
+    return start_index
+
+def run_chunked(args, model, core_history:list, chat_session, text_file:str,
+                store:checkpoint.CheckpointStore=None,
+                response_cache:cache.ResponseCache=None,
+                fingerprint:str=None, history:list=None, review=None)->str:
+    """
+    Map-reduce a file too large for one request.
+
+    The file is split lazily with `chunking.iter_chunks`, and each chunk is
+    sent with the prompt on a chat forked from the core history, up to
+    `args.concurrency` at a time. Every chunk is checkpointed under its own
+    key as it completes, so a crash resumes mid-file from the chunks that
+    are done. The chunk outputs are then concatenated, or merged by one more
+    request with `args.reduce == 'model'`, and written to the output file.
+    Turns go to the log `history`, `chat_session.history` by default.
+
+    `review`, if given, is called with the file and its merged output before
+    the file is finalized, and returns False to leave it unfinalized; its
+    chunks stay checkpointed.
+
+    Returns the output filename, see `sinks`, or None if the review
+    rejected the output.
+    """
+    if store is None:
+        with checkpoint.open_store(args.persist) as store:
+            return run_chunked(args, model, core_history, chat_session,
+                               text_file, store, response_cache, fingerprint,
+                               history, review)
+    start = time.perf_counter()
+    history = chat_session.history if history is None else history
+    concurrency = max(args.concurrency, 1)
+    outputs = {}
+    def complete(futures):
+        for future in futures:
+            index, key = in_flight.pop(future)
+            turns, _ = future.result()
+            record_turns(args, chat_session, key, turns, store, history)
+            outputs[index] = turns[-1].parts[0].text
+    chunks = chunking.iter_chunks(text_file, args.chunk_tokens,
+                                  args.chunk_overlap, use_mmap=args.mmap)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        in_flight = {}
+        for index, chunk in enumerate(chunks):
+            key = chunking.chunk_key(text_file, index, args)
+            if store.get(key, {}).get('final'):
+                outputs[index] = store.file_turns(key)[-1].parts[0].text
+                continue
+            in_flight[pool.submit(send_forked, model, core_history, chunk,
+                                  chunking.chunk_prompt(args.prompt, index),
+                                  response_cache, fingerprint)] = (index, key)
+            if len(in_flight) >= 2 * concurrency:
+                complete(concurrent.futures.wait(
+                    in_flight, return_when=concurrent.futures.FIRST_COMPLETED)[0])
+        complete(concurrent.futures.wait(in_flight)[0])
+    outputs = [outputs[index] for index in range(len(outputs))]
+    print(f"[green]Processed {text_file} in {len(outputs)} chunks[/green]")
+
+    if args.reduce == 'model':
+        turns, _ = send_forked(model, core_history,
+                               chunking.merge_content(outputs),
+                               chunking.REDUCE_PROMPT.format(prompt=args.prompt),
+                               response_cache, fingerprint)
+        merged = turns[-1].parts[0].text
+    else:
+        merged = chunking.concat(outputs)
+    if review is not None and not review(text_file, merged):
+        return None
+    if args.reduce == 'model':
+        start_index = record_turns(args, chat_session, text_file, turns, store,
+                                   history)
+        turns = [(start_index + i, turn.role, turn.parts[0].text)
+                 for i, turn in enumerate(turns)]
+    else:
+        store.put(text_file, len(history), len(history), final=True)
+        turns = []
+    seconds = time.perf_counter() - start
+    output = sinks.of(store).write(text_file, args, turns, output=merged,
+                                   seconds=seconds)
+    telemetry.record_file(text_file, seconds)
+    return output
+
+def run_concurrent(args, model, core_history:list, chat_session,
+                   text_files:list, concurrency:int=None,
+                   store:checkpoint.CheckpointStore=None,
+                   response_cache:cache.ResponseCache=None)->dict:
+    """
+    Process `text_files` on a pool of `concurrency` workers.
+
+    Completed files are appended to `chat_session.history` in the order they
+    finish, then checkpointed and written out before the next completion is
+    handled. At most `2 * concurrency` requests are kept in flight.
+
+    Inputs
+    ------
+    args : argparse.Namespace
+        The command line arguments.
+    model : GenerativeModel
+        the model built by the core script
+    core_history : list
+        the core conversation every file chat is forked from
+    chat_session : ChatSession
+        the session holding the combined (checkpointed) history
+    text_files : list
+        the files to process, see `utils.plan_resume`
+    concurrency : int
+        number of workers, defaults to args.concurrency
+    store : CheckpointStore
+        an open checkpoint store, opened per file if not given
+    response_cache : ResponseCache
+        replay first-turn responses from this cache when given
+
+    Returns
+    -------
+    dict of counts for 'done' and 'failed' files
+    """
+    concurrency = concurrency or args.concurrency
+    counts = {'done': 0, 'failed': 0}
+    todo = iter(text_files)
+    fingerprint = (cache.core_fingerprint(core_history, model)
+                   if response_cache is not None else None)
+    def stream_output(text_file):
+        # bulk sinks get the output once it is complete
+        if getattr(args, 'stream', False) and sinks.of(store) is sinks.FILES:
+            return utils.create_output_filename(text_file, args)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        def submit(n):
+            submitted = {}
+            for text_file in todo:
+                if chunking.needs_chunking(text_file,
+                                           getattr(args, 'chunk_tokens', None)):
+                    # large files fan out over their own chunks
+                    try:
+                        run_chunked(args, model, core_history, chat_session,
+                                    text_file, store, response_cache,
+                                    fingerprint)
+                        counts['done'] += 1
+                    except Exception as e:
+                        print(f"[red]Failed {text_file}: {e}[/red]")
+                        counts['failed'] += 1
+                    continue
+                submitted[pool.submit(timed, process_file, model, core_history,
+                                      text_file, args.prompt, response_cache,
+                                      fingerprint,
+                                      stream_output(text_file))] = text_file
+                if len(submitted) == n:
+                    break
+            return submitted
+        in_flight = submit(2 * concurrency)
+        while in_flight:
+            finished, _ = concurrent.futures.wait(
+                in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                text_file = in_flight.pop(future)
+                try:
+                    (_, turns, response), seconds = future.result()
+                except Exception as e:
+                    print(f"[red]Failed {text_file}: {e}[/red]")
+                    counts['failed'] += 1
+                    continue
+                start_index = record_turns(args, chat_session, text_file,
+                                           turns, store)
+                utils.write_output(text_file, args, chat_session.history,
+                                   start_index, store, seconds=seconds,
+                                   **sinks.usage(response))
+                telemetry.record_file(text_file, seconds)
+                tokens = utils.token_counts(response)
+                print(f"[green]Processed {text_file}"
+                      f"{f' ({tokens})' if tokens else ''}[/green]")
+                counts['done'] += 1
+            in_flight.update(submit(len(finished)))
+    return counts
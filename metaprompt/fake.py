@@ -0,0 +1,218 @@
+"""
+Deterministic local stand-in for `genai.GenerativeModel` and `ChatSession`.
+
+Used by the benchmarks in `benchmarks/` and by the tests to drive the
+`apply.py` pipeline without network access. Latency, response length,
+failure rate and throttling are configurable, and responses are a
+deterministic function of the message and the seed.
+"""
+import datetime
+import hashlib
+import itertools
+import random
+import re
+import threading
+import time
+from types import SimpleNamespace
+from google.api_core import exceptions
+from google.generativeai import protos
+from google.generativeai.types import content_types
+
+CHARS_PER_TOKEN = 4
+
+# the content blocks of a packed request, see `packing`
+PACKED_CONTENT = re.compile(r'<content id="(\d+)">(.*?)</content>', re.S)
+
+class FakeResponse:
+    """
+    Mimics `GenerateContentResponse`: `parts`, `text` and `usage_metadata`,
+    and iteration over chunks when streamed.
+    """
+
+    def __init__(self, text:str, prompt_tokens:int, chunk_chars:int=None,
+                 on_done=None, cached_tokens:int=0):
+        self.text = text
+        self.parts = [protos.Part(text=text)]
+        candidates = -(-len(text) // CHARS_PER_TOKEN)
+        self.usage_metadata = SimpleNamespace(
+            prompt_token_count=prompt_tokens,
+            cached_content_token_count=cached_tokens,
+            candidates_token_count=candidates,
+            total_token_count=prompt_tokens + candidates)
+        self.chunk_chars = chunk_chars or max(len(text), 1)
+        self.on_done = on_done
+
+    def __iter__(self):
+        for i in range(0, len(self.text), self.chunk_chars):
+            yield SimpleNamespace(text=self.text[i:i + self.chunk_chars])
+        if self.on_done is not None:
+            self.on_done()
+            self.on_done = None
+
+class FakeChatSession:
+
+    def __init__(self, model, history=None):
+        self.model = model
+        self.history = content_types.to_contents(history or [])
+
+    def send_message(self, content, stream:bool=False, **kwargs):
+        message = content_types.to_content(content)
+        if not message.role:
+            message.role = 'user'
+        response = self.model.generate(self.history + [message], stream)
+        turns = [message, protos.Content(role='model', parts=[protos.Part(text=response.text)])]
+        if stream: # like the SDK, the history is complete once iterated
+            response.on_done = lambda: self.history.extend(turns)
+        else:
+            self.history.extend(turns)
+        return response
+
+class FakeCachedContent:
+    """
+    Mimics `caching.CachedContent`, keeping the cached contents in process.
+    """
+    caches = {}
+    ids = itertools.count()
+
+    def __init__(self, model:str, contents:list, system_instruction=None,
+                 ttl:datetime.timedelta=None, display_name:str=None):
+        self.name = f"cachedContents/fake-{next(self.ids)}"
+        self.model = model
+        self.display_name = display_name
+        self.contents = content_types.to_contents(contents or [])
+        self.system_instruction = system_instruction
+        self.update(ttl=ttl)
+        tokens = sum(len(part.text) for content in self.contents
+                     for part in content.parts) // CHARS_PER_TOKEN
+        self.usage_metadata = SimpleNamespace(total_token_count=tokens)
+
+    @classmethod
+    def create(cls, model:str, **kwargs)->'FakeCachedContent':
+        cached = cls(model, **kwargs)
+        cls.caches[cached.name] = cached
+        return cached
+
+    @classmethod
+    def get(cls, name:str)->'FakeCachedContent':
+        cached = cls.caches.get(name)
+        if cached is None or cached.expire_time.timestamp() < time.time():
+            raise exceptions.NotFound(f"{name} not found")
+        return cached
+
+    def update(self, ttl:datetime.timedelta=None):
+        ttl = ttl or datetime.timedelta(hours=1)
+        self.expire_time = datetime.datetime.now(datetime.timezone.utc) + ttl
+
+    def delete(self):
+        self.caches.pop(self.name, None)
+
+class FakeGenerativeModel:
+    """
+    Inputs
+    ------
+    model_name : str
+        reported like the SDK model name
+    latency : float
+        seconds per request, before the first chunk when streamed
+    jitter : float
+        extra uniform random latency, in seconds
+    response_tokens : int
+        approximate length of each response
+    failure_rate : float
+        probability that a request raises a 503 `ServiceUnavailable`
+    throttle_rate : float
+        probability that a request raises a 429 `ResourceExhausted`
+    quota : int
+        requests allowed in flight at once; any more raise a 429
+    stream_chunks : int
+        number of chunks a streamed response is split into
+    seed : int
+        seed of the response text, jitter and failures
+    cached_content : FakeCachedContent
+        context cache the requests are sent with, see `from_cached_content`
+    """
+    cached_content_type = FakeCachedContent
+
+    def __init__(self, model_name:str="models/fake", generation_config=None,
+                 system_instruction:str=None, latency:float=0.0,
+                 jitter:float=0.0, response_tokens:int=64,
+                 failure_rate:float=0.0, throttle_rate:float=0.0,
+                 quota:int=None, stream_chunks:int=8, seed:int=0,
+                 cached_content:FakeCachedContent=None, **kwargs):
+        self.model_name = model_name
+        self._generation_config = generation_config or {}
+        self._system_instruction = (content_types.to_content(system_instruction)
+                                    if system_instruction else None)
+        self._safety_settings = kwargs.get('safety_settings')
+        self.latency = latency
+        self.jitter = jitter
+        self.response_tokens = response_tokens
+        self.failure_rate = failure_rate
+        self.throttle_rate = throttle_rate
+        self.quota = quota
+        self.stream_chunks = stream_chunks
+        self.seed = seed
+        self.cached_content = cached_content
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.in_flight = 0
+        self.throttled = 0
+
+    def from_cached_content(self, cached_content:FakeCachedContent,
+                            generation_config=None, safety_settings=None):
+        """
+        A model like this one sending `cached_content` ahead of every request,
+        like `GenerativeModel.from_cached_content`.
+        """
+        return FakeGenerativeModel(
+            cached_content.model, generation_config, latency=self.latency,
+            jitter=self.jitter, response_tokens=self.response_tokens,
+            failure_rate=self.failure_rate, throttle_rate=self.throttle_rate,
+            quota=self.quota, stream_chunks=self.stream_chunks, seed=self.seed,
+            cached_content=cached_content, safety_settings=safety_settings)
+
+    def start_chat(self, history=None, **kwargs)->FakeChatSession:
+        return FakeChatSession(self, history)
+
+    def respond(self, text:str)->str:
+        """
+        Deterministic response text for a message. A packed request is
+        answered block by block.
+        """
+        if '<answer id=' in text:
+            return "".join(f'<answer id="{i}">{self.respond(content)}</answer>\n'
+                           for i, content in PACKED_CONTENT.findall(text))
+        digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        words = (digest[i:i + 6] for i in range(0, 60, 6))
+        body = " ".join(words)
+        n = self.response_tokens * CHARS_PER_TOKEN
+        return (f"Response {digest[:8]}: " + body * (n // len(body) + 1))[:n]
+
+    def generate(self, contents:list, stream:bool=False)->FakeResponse:
+        with self.lock:
+            self.calls += 1
+            self.in_flight += 1
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            failed = self.random.random() < self.failure_rate
+            throttled = (self.random.random() < self.throttle_rate or
+                         (self.quota is not None and self.in_flight > self.quota))
+            self.throttled += throttled
+        try:
+            prompt_chars = sum(len(part.text) for content in contents
+                               for part in content.parts)
+            cached_tokens = (self.cached_content.usage_metadata.total_token_count
+                             if self.cached_content is not None else 0)
+            time.sleep(delay)
+            if throttled:
+                raise exceptions.ResourceExhausted("fake model quota exceeded")
+            if failed:
+                raise exceptions.ServiceUnavailable("fake model failure")
+            text = self.respond(contents[-1].parts[0].text)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+        return FakeResponse(text, prompt_chars // CHARS_PER_TOKEN + cached_tokens,
+                            chunk_chars=(-(-len(text) // self.stream_chunks)
+                                         if stream else None),
+                            cached_tokens=cached_tokens)
@@ -0,0 +1,177 @@
+"""
+Multi-document request packing for `apply.py --yes`.
+
+Short inputs cost less than the request around them: the round trip and the
+core history resent with every file. With a token budget, small files are
+grouped into packs sent as one request, each file in its own
+`<content id="N">` block, and the model is asked to answer each block in a
+matching `<answer id="N">` block.
+
+The answers are split back per file. Each file is checkpointed and written as
+if it had been sent alone: its turns are the message an unpacked run would
+send and its own answer. Files whose answer is missing, empty or repeated
+are sent one by one. Files over the budget, and files to be chunked, are
+sent alone from the start. The files of a pack share its request time and
+token counts evenly in their records, see `sinks`.
+"""
+import concurrent.futures
+import os
+import re
+from rich import print
+from metaprompt import cache, chunking, engine, sinks, telemetry, utils
+
+PACK_REQUEST = ("{prompt}\nDo this for each <content id=...> block above on its "
+                "own. Answer each block in an <answer id=\"...\"> block with the "
+                "same id, one answer per block, and write nothing outside them.")
+
+ANSWER = re.compile(r'<answer id="?(\d+)"?>(.*?)</answer>', re.S)
+
+def format_pack(contents:list, prompt:str)->str:
+    blocks = "".join(f'<content id="{i}">{content}</content>\n'
+                     for i, content in enumerate(contents, 1))
+    return blocks + f"<user_request>{PACK_REQUEST.format(prompt=prompt)}</user_request>\n"
+
+def parse_answers(text:str, n:int)->dict:
+    """
+    The answers of a pack of `n` files by id, 1 to `n`, keeping only ids
+    answered exactly once with something.
+    """
+    answers, repeated = {}, set()
+    for match in ANSWER.finditer(text):
+        i = int(match.group(1))
+        if i in answers:
+            repeated.add(i)
+        answers[i] = match.group(2).strip()
+    return {i: answer for i, answer in answers.items()
+            if 1 <= i <= n and i not in repeated and answer}
+
+def iter_packs(text_files, max_tokens:int, max_files:int=20,
+               chunk_tokens:int=None):
+    """
+    Group `text_files` into packs of estimated `max_tokens` of content and at
+    most `max_files` files, in order. Files that fit no pack come as packs of
+    one.
+    """
+    pack, tokens = [], 0
+    for text_file in text_files:
+        size = -(-os.path.getsize(text_file) // chunking.CHARS_PER_TOKEN)
+        if size > max_tokens or chunking.needs_chunking(text_file, chunk_tokens):
+            yield [text_file]
+            continue
+        if pack and (tokens + size > max_tokens or len(pack) >= max_files):
+            yield pack
+            pack, tokens = [], 0
+        pack.append(text_file)
+        tokens += size
+    if pack:
+        yield pack
+
+def send_pack(model, core_history:list, text_files:list, prompt:str,
+              response_cache:cache.ResponseCache=None, fingerprint:str=None):
+    """
+    Send a pack on a chat forked from the core history.
+
+    Returns
+    -------
+    contents : list
+        the content of each file
+    answers : dict
+        the answers parsed by id, see `parse_answers`
+    response : GenerateContentResponse
+        the raw response
+    """
+    contents = [engine.read_text_file(text_file) for text_file in text_files]
+    message = format_pack(contents, prompt)
+    key = (cache.cache_key(fingerprint, prompt, message)
+           if response_cache is not None else None)
+    chat = model.start_chat(history=core_history)
+    response = utils.send_message(chat, message, key=key,
+                                  response_cache=response_cache)
+    return contents, parse_answers(response.parts[0].text, len(text_files)), response
+
+def file_turns(content:str, prompt:str, answer:str)->list:
+    """
+    The turns of a file answered in a pack, as if it had been sent alone.
+    """
+    from google.generativeai import protos
+    return [protos.Content(role=role, parts=[protos.Part(text=text)]) for role, text in
+            (('user', engine.format_first_message(content, prompt)), ('model', answer))]
+
+def share(meta:dict, n:int)->dict:
+    """
+    A file's even share of the timing and token counts of a pack of `n`.
+    """
+    return {key: None if value is None else
+                 value / n if key == 'seconds' else round(value / n)
+            for key, value in meta.items()}
+
+def run_packed(args, model, core_history:list, chat_session, text_files,
+               concurrency:int=None, store=None,
+               response_cache:cache.ResponseCache=None)->dict:
+    """
+    Process `text_files` in packs of `args.pack_tokens` estimated tokens and
+    at most `args.pack_files` files, on a pool of `concurrency` workers.
+    Files that were not answered cleanly, and files sent alone, go through
+    `engine.run_concurrent`. Arguments as for `engine.run_concurrent`.
+
+    Returns
+    -------
+    dict of counts for 'done' and 'failed' files
+    """
+    concurrency = concurrency or max(args.concurrency, 1)
+    counts = {'done': 0, 'failed': 0}
+    stats = {'packs': 0, 'packed': 0}
+    alone = []
+    fingerprint = (cache.core_fingerprint(core_history, model)
+                   if response_cache is not None else None)
+    packs = iter_packs(text_files, args.pack_tokens, args.pack_files,
+                       getattr(args, 'chunk_tokens', None))
+    def complete(future):
+        pack = in_flight.pop(future)
+        try:
+            (contents, answers, response), seconds = future.result()
+        except Exception as e:
+            print(f"[red]Pack of {len(pack)} files failed, sending them one by one: {e}[/red]")
+            alone.extend(pack)
+            return
+        stats['packs'] += 1
+        meta = share({'seconds': seconds, **sinks.usage(response)}, len(pack))
+        for i, (text_file, content) in enumerate(zip(pack, contents), 1):
+            if i not in answers:
+                alone.append(text_file)
+                continue
+            turns = file_turns(content, args.prompt, answers[i])
+            start_index = engine.record_turns(args, chat_session, text_file,
+                                              turns, store)
+            utils.write_output(text_file, args, chat_session.history,
+                               start_index, store, **meta)
+            telemetry.record_file(text_file, meta['seconds'])
+            stats['packed'] += 1
+            counts['done'] += 1
+        if len(answers) < len(pack):
+            print(f"[yellow]{len(pack) - len(answers)} of {len(pack)} answers "
+                  f"of a pack could not be parsed, sending those files one "
+                  f"by one[/yellow]")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        in_flight = {}
+        for pack in packs:
+            if len(pack) == 1:
+                alone.extend(pack)
+                continue
+            in_flight[pool.submit(engine.timed, send_pack, model,
+                                  core_history, pack, args.prompt,
+                                  response_cache, fingerprint)] = pack
+            if len(in_flight) >= 2 * concurrency:
+                done, _ = concurrent.futures.wait(
+                    in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    complete(future)
+        for future in concurrent.futures.as_completed(list(in_flight)):
+            complete(future)
+    print(f"[yellow]Packing: {stats['packed']} files answered in "
+          f"{stats['packs']} requests, {len(alone)} sent alone[/yellow]")
+    if alone:
+        more = engine.run_concurrent(args, model, core_history, chat_session,
+                                     alone, concurrency, store, response_cache)
+        counts = {k: counts[k] + more[k] for k in counts}
+    return counts
@@ -0,0 +1,123 @@
+"""
+Lookahead for the interactive loop.
+
+While the reviewer reads, edits or answers the y/m/c/q prompt for one file,
+`Prefetcher` sends the first turn of the next `depth` files in the
+background. Each is sent on a chat forked from a snapshot of the context at
+the time, so a prefetched file does not see the files reviewed after it was
+sent. When its turn comes, the loop splices the prefetched user message and
+response into the session in place of a request, and the file is then
+reviewed, checkpointed and written like any other, in input order.
+
+Prefetched responses are tied to the prompt they were sent with and are
+dropped if the prompt has changed.
+"""
+import collections
+import concurrent.futures
+from rich import print
+from metaprompt import engine, chunking
+
+class Prefetcher:
+    """
+    Inputs
+    ------
+    text_files : iterable
+        the files to process, read lazily as the lookahead needs them
+    depth : int
+        number of upcoming files to prefetch
+    args : argparse.Namespace
+        the command line arguments; `args.prompt` is read at submission
+    model : GenerativeModel
+        the model built by the core script
+    snapshot : callable
+        returns the turns to fork each prefetch from
+    response_cache : ResponseCache
+        replay first-turn responses from this cache when given
+    fingerprint : str
+        the `cache.core_fingerprint` for the response cache
+    skip : callable
+        files for which it returns True are not prefetched, e.g. duplicates
+        answered from their representative (see `dedup`)
+    """
+
+    def __init__(self, text_files, depth:int, args, model, snapshot,
+                 response_cache=None, fingerprint:str=None, skip=None):
+        self.text_files = iter(text_files)
+        self.depth = depth
+        self.args = args
+        self.model = model
+        self.snapshot = snapshot
+        self.response_cache = response_cache
+        self.fingerprint = fingerprint
+        self.skip = skip
+        self.upcoming = collections.deque()
+        self.pending = {}
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(depth, 1))
+
+    def __iter__(self):
+        while True:
+            text_file = (self.upcoming.popleft() if self.upcoming
+                         else next(self.text_files, None))
+            if text_file is None:
+                return
+            self.fill()
+            yield text_file
+
+    def fill(self):
+        """
+        Read ahead up to `depth` files after the current one and send any
+        that are not in flight yet.
+        """
+        while len(self.upcoming) < self.depth:
+            text_file = next(self.text_files, None)
+            if text_file is None:
+                break
+            self.upcoming.append(text_file)
+        if not self.args.prompt:
+            return
+        for text_file in self.upcoming:
+            if text_file not in self.pending:
+                self.submit(text_file)
+
+    def submit(self, text_file:str):
+        if chunking.needs_chunking(text_file, getattr(self.args, 'chunk_tokens', None)):
+            return
+        if self.skip is not None and self.skip(text_file):
+            return
+        prompt = self.args.prompt
+        content = engine.read_text_file(text_file)
+        future = self.pool.submit(engine.send_forked, self.model,
+                                  self.snapshot(), content, prompt,
+                                  self.response_cache, self.fingerprint)
+        self.pending[text_file] = (prompt, future)
+
+    def take(self, text_file:str, prompt:str):
+        """
+        The prefetched response for `text_file`, waiting for it if it is in
+        flight. None if it was not prefetched, was sent with another prompt,
+        or failed.
+        """
+        prompt_sent, future = self.pending.pop(text_file, (None, None))
+        if future is None:
+            return None
+        if prompt_sent != prompt:
+            future.cancel()
+            return None
+        try:
+            _, response = future.result()
+        except Exception as e:
+            print(f"[red]Prefetch of {text_file} failed, sending again: {e}[/red]")
+            return None
+        return response
+
+    def invalidate(self):
+        """
+        Drop everything prefetched, e.g. after the prompt changed.
+        """
+        for _, future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+
+    def close(self):
+        self.invalidate()
+        self.pool.shutdown(wait=False, cancel_futures=True)
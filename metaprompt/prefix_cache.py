@@ -0,0 +1,208 @@
+"""
+Server-side context cache for the core conversation.
+
+Every request resends the core history and system instruction of the core
+script ahead of the file. `PrefixCache` registers that prefix once with the
+SDK's context caching (`caching.CachedContent`) and `PrefixCachedModel`
+stands in for the model: chats keep their full history, so checkpoint
+indices and context policies are unaffected, but requests whose contents
+start with the core history are sent without it to a model built on the
+cache. Anything else goes to the original model.
+
+Caches outlive a run. A registry file maps each core script to its cache
+and the hash of the script and model settings it was created from; a
+changed script deletes the old cache and creates a new one, and the TTL is
+extended whenever less than half of it is left. Models that bring their own
+cache class as `cached_content_type`, like `fake.FakeGenerativeModel`, are
+cached with it instead of the SDK's.
+"""
+import datetime
+import hashlib
+import json
+import os
+import threading
+import time
+from rich import print
+from metaprompt import cache
+
+def script_fingerprint(core:str, core_history:list, model)->str:
+    """
+    Hash of the core script's content and of what is cached from it.
+    """
+    digest = hashlib.sha256(cache.core_fingerprint(core_history, model).encode('utf-8'))
+    if core and os.path.isfile(core):
+        with open(core, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+def expires_at(handle)->float:
+    expire_time = getattr(handle, 'expire_time', None)
+    return expire_time.timestamp() if expire_time is not None else 0.0
+
+class PrefixCache:
+    """
+    Inputs
+    ------
+    model : GenerativeModel
+        the model built by the core script
+    core_history : list
+        the core conversation, cached with the model's system instruction
+    core : str
+        path of the core script, the registry key
+    registry : str
+        JSON file recording the cache of each core script
+    ttl : float
+        seconds a cache lives without being refreshed
+    """
+
+    def __init__(self, model, core_history:list, core:str,
+                 registry:str="database/prefix_cache.json", ttl:float=3600):
+        from google.generativeai.types import content_types
+        self.model = model
+        # as the chats hold them, whatever form the core script wrote
+        self.core_history = content_types.to_contents(list(core_history))
+        self.core = os.path.abspath(core) if core else None
+        self.registry = registry
+        self.ttl = ttl
+        self.fingerprint = script_fingerprint(core, self.core_history, model)
+        self.backend = getattr(model, 'cached_content_type', None)
+        if self.backend is None:
+            from google.generativeai import caching
+            self.backend = caching.CachedContent
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.tokens_saved = 0
+        self.handle = self.load() or self.create()
+        self.write_registry()
+        self.expires = expires_at(self.handle)
+        self.cached_model = model.from_cached_content(
+            self.handle, generation_config=getattr(model, '_generation_config', None),
+            safety_settings=getattr(model, '_safety_settings', None))
+
+    def read_registry(self)->dict:
+        if not os.path.exists(self.registry):
+            return {}
+        with open(self.registry) as f:
+            return json.load(f)
+
+    def write_registry(self):
+        entries = self.read_registry()
+        entries[self.core] = {'fingerprint': self.fingerprint,
+                              'name': self.handle.name,
+                              'expires': expires_at(self.handle)}
+        if os.path.dirname(self.registry):
+            os.makedirs(os.path.dirname(self.registry), exist_ok=True)
+        with open(self.registry, 'w') as f:
+            json.dump(entries, f, indent=1)
+
+    def load(self):
+        """
+        The registered cache of this core script if it is current, deleting
+        it if the script has changed.
+        """
+        entry = self.read_registry().get(self.core)
+        if entry is None:
+            return None
+        try:
+            handle = self.backend.get(entry['name'])
+        except Exception: # expired or deleted on the server
+            return None
+        if entry['fingerprint'] != self.fingerprint:
+            print(f"[yellow]Core script changed, replacing its context cache "
+                  f"{entry['name']}[/yellow]")
+            try:
+                handle.delete()
+            except Exception as e:
+                print(f"[red]Could not delete {entry['name']}: {e}[/red]")
+            return None
+        return handle
+
+    def create(self):
+        handle = self.backend.create(
+            model=self.model.model_name, display_name="metaprompt core",
+            system_instruction=getattr(self.model, '_system_instruction', None),
+            contents=self.core_history,
+            ttl=datetime.timedelta(seconds=self.ttl))
+        print(f"[yellow]Created context cache {handle.name} for the core "
+              f"history[/yellow]")
+        return handle
+
+    def refresh(self):
+        """
+        Extend the TTL once less than half of it is left.
+        """
+        if self.expires - time.time() > self.ttl / 2:
+            return
+        with self.lock:
+            if self.expires - time.time() > self.ttl / 2:
+                return
+            self.handle.update(ttl=datetime.timedelta(seconds=self.ttl))
+            self.expires = expires_at(self.handle)
+            self.write_registry()
+
+    def strip(self, contents:list):
+        """
+        `contents` without the cached prefix, or None if they do not start
+        with it.
+        """
+        n = len(self.core_history)
+        if len(contents) < n:
+            return None
+        for sent, cached in zip(contents, self.core_history):
+            if sent is not cached and sent != cached:
+                return None
+        return list(contents[n:])
+
+    def count(self, response):
+        usage = getattr(response, 'usage_metadata', None)
+        with self.lock:
+            self.requests += 1
+            self.tokens_saved += getattr(usage, 'cached_content_token_count', 0) or 0
+
+    def report(self)->str:
+        return (f"Prefix cache {self.handle.name}: {self.requests} requests, "
+                f"{self.tokens_saved} prompt tokens served from the cache")
+
+    def wrap(self, model=None)->'PrefixCachedModel':
+        return PrefixCachedModel(model or self.model, self)
+
+class PrefixCachedModel:
+    """
+    Stand-in for the core script's model that sends the core prefix through
+    the context cache. Anything but starting chats and generating is
+    delegated to the original model.
+    """
+
+    def __init__(self, model, prefix_cache:PrefixCache):
+        self.model = model
+        self.prefix_cache = prefix_cache
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def start_chat(self, history=None, **kwargs):
+        chat = self.model.start_chat(history=history, **kwargs)
+        chat.model = self # requests go through generate_content below
+        return chat
+
+    def route(self, contents):
+        stripped = self.prefix_cache.strip(contents)
+        if not stripped:
+            return self.model, contents
+        self.prefix_cache.refresh()
+        return self.prefix_cache.cached_model, stripped
+
+    def generate_content(self, contents, **kwargs):
+        model, contents = self.route(contents)
+        response = model.generate_content(contents=contents, **kwargs)
+        if model is not self.model:
+            self.prefix_cache.count(response)
+        return response
+
+    def generate(self, contents, stream:bool=False):
+        # the request method of `fake.FakeChatSession`
+        model, contents = self.route(contents)
+        response = model.generate(contents, stream)
+        if model is not self.model:
+            self.prefix_cache.count(response)
+        return response
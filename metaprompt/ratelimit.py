@@ -0,0 +1,210 @@
+"""
+Request scheduling around model calls.
+
+Every request made through `utils.send_message` goes through the current
+`Scheduler`, which
+
+- waits on token buckets for requests and tokens per minute,
+- holds one of an adaptive number of concurrency slots: the limit grows by
+  one per window of successful requests and halves when the service
+  throttles (AIMD),
+- retries throttled (429) and transient (5xx, deadline) failures with
+  jittered exponential backoff.
+
+The module keeps one current `Scheduler`; `configure` replaces it, like
+`telemetry.configure`.
+"""
+import random
+import threading
+import time
+from metaprompt import telemetry
+
+class RateLimiter:
+    """
+    Token bucket: on average at most `rate` units per second, with bursts of
+    up to `burst`. A `rate` of None or 0 disables the limit.
+    """
+
+    def __init__(self, rate:float=None, burst:float=1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount:float=1)->float:
+        """
+        Block until `amount` units may be spent, then spend them. An amount
+        over the burst waits for a full bucket and leaves it in debt. Returns
+        the seconds waited.
+        """
+        if not self.rate:
+            return 0.0
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= min(amount, self.burst):
+                    self.tokens -= amount
+                    return waited
+                delay = (min(amount, self.burst) - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def charge(self, amount:float):
+        """
+        Spend (or refund, if negative) units without waiting, e.g. to correct
+        an estimate once the actual cost is known.
+        """
+        if not self.rate:
+            return
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.burst, self.tokens - amount)
+
+class AdaptiveConcurrency:
+    """
+    Concurrency limit adjusted by additive increase, multiplicative decrease:
+    +1 after `limit` consecutive successes, halved on a throttled request, at
+    most once per `cooldown` seconds so one burst of 429s counts once.
+    """
+
+    def __init__(self, limit:int, minimum:int=1, maximum:int=None,
+                 cooldown:float=1.0):
+        self.maximum = maximum or limit
+        self.minimum = min(minimum, self.maximum)
+        self.limit = float(min(max(limit, self.minimum), self.maximum))
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.decreased = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled:bool=False):
+        with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                if now - self.decreased >= self.cooldown:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self.decreased = now
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+def is_throttled(error:Exception)->bool:
+    from google.api_core import exceptions
+    return isinstance(error, exceptions.TooManyRequests)
+
+def is_retryable(error:Exception)->bool:
+    from google.api_core import exceptions
+    return isinstance(error, (exceptions.TooManyRequests,
+                              exceptions.InternalServerError,
+                              exceptions.ServiceUnavailable,
+                              exceptions.GatewayTimeout,
+                              exceptions.DeadlineExceeded))
+
+class Scheduler:
+    """
+    Inputs
+    ------
+    rpm : float
+        requests per minute, None for no limit
+    tpm : float
+        tokens per minute, None for no limit; requests are charged an
+        estimate up front and corrected from their usage metadata
+    concurrency : int
+        initial and maximum number of requests in flight, None for no limit
+    max_retries : int
+        retries of a throttled or transient failure before giving up
+    backoff : float
+        base of the exponential backoff, in seconds
+    max_backoff : float
+        cap of a single backoff delay, in seconds
+    seed : int
+        seed of the backoff jitter
+    """
+
+    def __init__(self, rpm:float=None, tpm:float=None, concurrency:int=None,
+                 max_retries:int=5, backoff:float=1.0, max_backoff:float=60.0,
+                 seed:int=None):
+        # buckets hold ten seconds of quota
+        self.requests = RateLimiter(rpm / 60 if rpm else None,
+                                    burst=rpm / 6 if rpm else 1)
+        self.tokens = RateLimiter(tpm / 60 if tpm else None,
+                                  burst=tpm / 6 if tpm else 1)
+        self.concurrency = (AdaptiveConcurrency(concurrency)
+                            if concurrency else None)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.random = random.Random(seed)
+
+    def delay(self, attempt:int)->float:
+        """
+        Full jitter: uniform up to the capped exponential backoff.
+        """
+        return self.random.uniform(0, min(self.max_backoff,
+                                          self.backoff * 2**attempt))
+
+    def call(self, send, tokens=None, on_failure=None):
+        """
+        Run `send()` under the limits, retrying throttled and transient
+        failures. `tokens` is a callable estimating the request's tokens,
+        only called when tokens are limited. `on_failure(error)` is called
+        after every failed attempt, before the retry or the raise, to undo
+        what the attempt left behind.
+        """
+        attempt = 0
+        while True:
+            self.requests.acquire()
+            estimate = tokens() if tokens is not None and self.tokens.rate else 0
+            self.tokens.acquire(estimate)
+            if self.concurrency is not None:
+                self.concurrency.acquire()
+            try:
+                result = send()
+            except Exception as e:
+                throttled = is_throttled(e)
+                if self.concurrency is not None:
+                    self.concurrency.release(throttled)
+                if on_failure is not None:
+                    on_failure(e)
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                delay = self.delay(attempt)
+                telemetry.current().emit({'event': 'retry', 'attempt': attempt + 1,
+                                          'throttled': throttled, 'delay': delay,
+                                          'error': type(e).__name__})
+                time.sleep(delay)
+                attempt += 1
+                continue
+            if self.concurrency is not None:
+                self.concurrency.release()
+            usage = getattr(result, 'usage_metadata', None)
+            if estimate and getattr(usage, 'total_token_count', None):
+                self.tokens.charge(usage.total_token_count - estimate)
+            return result
+
+_current = Scheduler()
+
+def configure(**settings)->Scheduler:
+    """
+    Replace the current scheduler, see `Scheduler` for the `settings`.
+    """
+    global _current
+    _current = Scheduler(**settings)
+    return _current
+
+def current()->Scheduler:
+    return _current
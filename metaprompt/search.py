@@ -0,0 +1,224 @@
+"""
+Full-text search over checkpoint stores.
+
+One SQLite FTS5 index holds the inputs and outputs of every checkpoint store,
+one row per turn keyed by store, file and turn index. The index remembers how
+many turns of each store it has seen, so `SearchIndex.update` only reads the
+turns appended since; checkpoint stores call it after every commit, so it
+never runs ahead of what a crash would keep, and the search CLI catches up
+on stores written without it. Results are ranked by BM25 and come with a snippet around the
+matched terms.
+
+    python -m metaprompt.search "refund policy" --role model
+"""
+import argparse
+import bisect
+import glob
+import os
+import re
+import sqlite3
+import threading
+from rich import print
+from metaprompt import checkpoint
+
+SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS turns USING fts5(
+    text, store UNINDEXED, file UNINDEXED, idx UNINDEXED, role UNINDEXED,
+    tokenize = 'porter unicode61'
+);
+CREATE TABLE IF NOT EXISTS stores (
+    store TEXT PRIMARY KEY,
+    turns INTEGER NOT NULL
+);
+"""
+
+# snippet markers, replaced by markup once the text is escaped
+MATCH_START, MATCH_END = '\x02', '\x03'
+
+def quote(query:str)->str:
+    """
+    Turn free text into an FTS5 query matching all of its words.
+    """
+    return " ".join('"' + word.replace('"', '""') + '"'
+                    for word in re.findall(r'\w+', query))
+
+class SearchIndex:
+
+    def __init__(self, path:str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        # shared by the jobs of a daemon, see `daemon`
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        try:
+            self.connection.executescript(SCHEMA)
+        except sqlite3.OperationalError as e:
+            raise RuntimeError("The search index needs SQLite built with FTS5") from e
+
+    def indexed(self, store:str)->int:
+        row = self.connection.execute(
+            "SELECT turns FROM stores WHERE store = ?", (store,)).fetchone()
+        return row[0] if row else 0
+
+    def update(self, store:checkpoint.CheckpointStore)->int:
+        """
+        Index the turns of `store` appended since the last update, each under
+        the file record it belongs to; a store shorter than indexed was
+        recreated and is indexed again. Returns the number of turns indexed.
+        """
+        with self.lock:
+            return self._update(store)
+
+    def _update(self, store:checkpoint.CheckpointStore)->int:
+        name = os.path.abspath(store.path)
+        since = self.indexed(name)
+        if since > len(store):
+            # the store was recreated: its old turns are gone
+            with self.connection:
+                self.connection.execute("DELETE FROM turns WHERE store = ?", (name,))
+                self.connection.execute("DELETE FROM stores WHERE store = ?", (name,))
+            since = 0
+        if since >= len(store):
+            return 0
+        ranges = store.file_ranges(since)
+        starts = [start for _, start, _ in ranges]
+        def file_of(idx):
+            i = bisect.bisect_right(starts, idx) - 1
+            if i >= 0 and idx < ranges[i][2]:
+                return ranges[i][0]
+            return None
+        rows = [(text, name, file_of(idx), idx, role)
+                for idx, role, text in store.texts(since, len(store))]
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO turns (text, store, file, idx, role) VALUES (?, ?, ?, ?, ?)",
+                rows)
+            self.connection.execute(
+                "INSERT INTO stores (store, turns) VALUES (?, ?) "
+                "ON CONFLICT(store) DO UPDATE SET turns = excluded.turns",
+                (name, len(store)))
+        return len(rows)
+
+    def search(self, query:str, limit:int=10, role:str=None, store:str=None,
+               raw:bool=False, snippet_tokens:int=16)->list:
+        """
+        Ranked matches of `query`, all of its words unless `raw`, which
+        passes FTS5 query syntax through. `store` is a glob over store paths.
+
+        Returns
+        -------
+        list of dicts with 'store', 'file', 'idx', 'role', 'score' (BM25,
+        lower is better) and 'snippet'
+        """
+        match = query if raw else quote(query)
+        if not match:
+            return []
+        rows = self.connection.execute(
+            "SELECT store, file, idx, role, bm25(turns), "
+            f"snippet(turns, 0, ?, ?, '…', ?) FROM turns WHERE turns MATCH ? "
+            "AND (? IS NULL OR role = ?) AND (? IS NULL OR store GLOB ?) "
+            "ORDER BY bm25(turns) LIMIT ?",
+            (MATCH_START, MATCH_END, snippet_tokens, match, role, role,
+             store, store, limit)).fetchall()
+        return [{'store': s, 'file': f, 'idx': i, 'role': r, 'score': score,
+                 'snippet': snippet} for s, f, i, r, score, snippet in rows]
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def find_stores(paths)->list:
+    """
+    Checkpoint stores among `paths`, searching folders recursively. Legacy
+    shelve checkpoints not converted yet are skipped with a message, as
+    searching must not write next to them.
+    """
+    stores = []
+    skipped = set()
+    for path in paths:
+        candidates = ([path] if not os.path.isdir(path) else
+                      glob.glob(os.path.join(path, '**', '*.sqlite'), recursive=True)
+                      + glob.glob(os.path.join(path, '**', '*.shelve*'), recursive=True))
+        for candidate in candidates:
+            if not candidate.endswith('.sqlite') and '.shelve' in candidate:
+                # x.shelve, x.shelve.db, x.shelve.dat...: converted to x.sqlite
+                persist = candidate[:candidate.index('.shelve')] + '.shelve'
+                candidate = checkpoint.store_path(persist)
+                if not os.path.exists(candidate):
+                    if persist not in skipped:
+                        skipped.add(persist)
+                        print(f"[yellow]Skipping the shelve checkpoint {persist}; "
+                              f"convert it with python -m metaprompt.checkpoint "
+                              f"{persist}[/yellow]")
+                    continue
+            if candidate not in stores and checkpoint.is_store(candidate):
+                stores.append(candidate)
+    return stores
+
+def update_all(index:SearchIndex, paths)->int:
+    """
+    Bring the index up to date with every store found under `paths`.
+    """
+    total = 0
+    for path in find_stores(paths):
+        with checkpoint.CheckpointStore(path, readonly=True) as store:
+            total += index.update(store)
+    return total
+
+_current = None
+
+def configure(path:str=None)->SearchIndex:
+    """
+    Open the index that checkpoint writes update, or stop updating with
+    None.
+    """
+    global _current
+    if _current is not None:
+        _current.close()
+    _current = SearchIndex(path) if path else None
+    return _current
+
+def update(store:checkpoint.CheckpointStore)->int:
+    if _current is None:
+        return 0
+    return _current.update(store)
+
+def highlight(snippet:str)->str:
+    from rich.markup import escape
+    return (escape(snippet).replace(MATCH_START, "[bold yellow]")
+                           .replace(MATCH_END, "[/bold yellow]"))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Search the inputs and outputs of checkpoint stores.')
+    parser.add_argument('query', help='Words to search for (all must match)')
+    parser.add_argument('--index', default="database/search.sqlite", help='File location of the search index')
+    parser.add_argument('--update', nargs='*', default=["database"], help='Stores or folders of stores to catch up on first (none to skip)')
+    parser.add_argument('--limit', type=int, default=10, help='Number of results')
+    parser.add_argument('--role', choices=['user', 'model'], default=None, help='Only search inputs (user) or outputs (model)')
+    parser.add_argument('--store', default=None, help='Only search stores whose path matches this glob')
+    parser.add_argument('--raw', action='store_true', help='Pass the query through as FTS5 syntax (OR, NEAR, prefix*)')
+    args = parser.parse_args(argv)
+
+    with SearchIndex(args.index) as index:
+        if args.update:
+            update_all(index, args.update)
+        results = index.search(args.query, args.limit, args.role, args.store,
+                               args.raw)
+    for result in results:
+        print(f"[cyan]{os.path.basename(result['store'])}[/cyan] "
+              f"{result['file']} #{result['idx']} ({result['role']}, "
+              f"{result['score']:.2f})")
+        print("    " + highlight(result['snippet']).replace("\n", " "))
+    if not results:
+        print("No matches.")
+    return results
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+"""
+Deterministic sharding of a run, and merging of shard checkpoints.
+
+`apply.py --shard i/N` processes the files of shard `i` of `N` (0-based)
+only. A file's shard is a hash of its path as the run names it, so it does
+not depend on the other files: adding or removing files never moves a file
+to another shard, and every worker given the same inputs agrees on the
+split without talking to the others. Each shard checkpoints to a store of
+its own next to the usual one, e.g. `database/core.shard0-of-4.sqlite`, so
+workers on one machine or several never write to the same file.
+
+`merge` combines shard stores into one. The turns a source shares with the
+target from the start, the core history, are kept once; the rest of its
+turns are appended and its records moved with them, so no turn is lost.
+A final record is never replaced by a non-final one. Merging a store again
+only adds what it gained since, so shards can be merged while they run.
+
+    python -m metaprompt.sharding database/core.shard*.sqlite --into database/core.sqlite
+"""
+import argparse
+import hashlib
+import os
+import sqlite3
+from metaprompt import checkpoint
+
+def parse_shard(spec:str)->tuple:
+    """
+    `(index, count)` of a `--shard i/N` value.
+    """
+    try:
+        index, count = (int(n) for n in spec.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"takes i/N, e.g. 0/4, not {spec!r}") from None
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"{spec}: i must be from 0 to N - 1")
+    return index, count
+
+def shard_of(key:str, count:int)->int:
+    digest = hashlib.blake2b(os.path.normpath(key).encode('utf-8'), digest_size=8)
+    return int.from_bytes(digest.digest(), 'big') % count
+
+def select(text_files, shard:tuple):
+    """
+    Lazily keep the files of `shard`, an `(index, count)` pair.
+    """
+    index, count = shard
+    for text_file in text_files:
+        if shard_of(text_file, count) == index:
+            yield text_file
+
+def persist_path(args)->str:
+    """
+    Path of the store of a run: `args.persist` with placeholders substituted,
+    its shard's with `args.shard`.
+    """
+    from metaprompt import utils
+    path = checkpoint.store_path(os.path.abspath(
+        utils.string_substitute(args.persist, args)))
+    if getattr(args, 'shard', None):
+        index, count = args.shard
+        path = f"{os.path.splitext(path)[0]}.shard{index}-of-{count}.sqlite"
+    return path
+
+def shared_prefix(connection:sqlite3.Connection)->int:
+    """
+    Number of leading turns of the attached `src` store identical to those
+    of the main one.
+    """
+    first = connection.execute(
+        "SELECT MIN(s.idx) FROM src.turns s LEFT JOIN main.turns t "
+        "ON t.idx = s.idx WHERE t.idx IS NULL OR t.role IS NOT s.role "
+        "OR t.text IS NOT s.text OR t.content IS NOT s.content").fetchone()[0]
+    if first is None:
+        first = connection.execute("SELECT COUNT(*) FROM src.turns").fetchone()[0]
+    return first
+
+MERGES = """
+CREATE TABLE IF NOT EXISTS merges (
+    source TEXT NOT NULL,
+    start  INTEGER NOT NULL,
+    stop   INTEGER NOT NULL,
+    offset INTEGER NOT NULL
+);
+"""
+
+def merge_store(target:checkpoint.CheckpointStore, source:str)->dict:
+    """
+    Merge the store at `source` into `target`. The `merges` table of the
+    target records where each `[start, stop)` segment of turns of a source,
+    by file name, went (`idx + offset`), so merging a source again only
+    appends the turns it gained since.
+
+    Returns
+    -------
+    dict of counts of the 'turns' appended and the records 'added' and
+    'kept' (the target's, being final or the source's not)
+    """
+    # bring the source to the current format, with a digests table
+    checkpoint.CheckpointStore(source).close()
+    name = os.path.basename(source)
+    connection = target.connection
+    connection.executescript(MERGES)
+    connection.execute("ATTACH DATABASE ? AS src", (source,))
+    try:
+        records = connection.execute(
+            "SELECT key, start, stop, final FROM src.files ORDER BY start").fetchall()
+        segments = connection.execute(
+            "SELECT start, stop, offset FROM merges WHERE source = ? ORDER BY rowid",
+            (name,)).fetchall()
+        if segments:
+            merged = max(stop for _, stop, _ in segments)
+        else:
+            merged = shared_prefix(connection)
+            segments = [(0, merged, 0)]
+            connection.execute("INSERT INTO merges VALUES (?, ?, ?, ?)",
+                               (name, *segments[0]))
+        # records straddling the turns merged are moved whole
+        straddling = [start for _, start, stop, _ in records if start < merged < stop]
+        while straddling:
+            merged = min(straddling)
+            straddling = [start for _, start, stop, _ in records
+                          if start < merged < stop]
+        length = connection.execute("SELECT COUNT(*) FROM src.turns").fetchone()[0]
+        appended = 0
+        if length > merged:
+            segments.append((merged, length, len(target) - merged))
+            connection.execute("INSERT INTO merges VALUES (?, ?, ?, ?)",
+                               (name, *segments[-1]))
+            appended = connection.execute(
+                "INSERT INTO main.turns (idx, role, text, content) "
+                "SELECT idx + ?, role, text, content FROM src.turns "
+                "WHERE idx >= ? ORDER BY idx", (segments[-1][2], merged)).rowcount
+            target._length += appended
+        counts = {'turns': appended, 'added': 0, 'kept': 0}
+        for key, start, stop, final in records:
+            current = target.get(key)
+            if current is not None and (current['final'] or not final):
+                counts['kept'] += 1
+                continue
+            # the latest segment holding the record's turns
+            offset = next(offset for first, last, offset in reversed(segments)
+                          if first <= start and stop <= last)
+            connection.execute(
+                "INSERT OR REPLACE INTO main.files (key, start, stop, final) "
+                "VALUES (?, ?, ?, ?)", (key, start + offset, stop + offset, final))
+            connection.execute(
+                "INSERT OR REPLACE INTO main.digests "
+                "SELECT * FROM src.digests WHERE key = ?", (key,))
+            counts['added'] += 1
+        connection.commit()
+    finally:
+        connection.rollback()
+        connection.execute("DETACH DATABASE src")
+    return counts
+
+def merge(sources:list, into:str)->dict:
+    """
+    Merge the stores `sources` into the store `into`, in order, creating it
+    if needed. Returns the summed counts of `merge_store`.
+    """
+    totals = {'turns': 0, 'added': 0, 'kept': 0}
+    with checkpoint.CheckpointStore(into) as target:
+        for source in sources:
+            if os.path.abspath(source) == os.path.abspath(into):
+                continue
+            counts = merge_store(target, source)
+            totals = {k: totals[k] + counts[k] for k in totals}
+    return totals
+
+def main(argv=None):
+    from rich import print
+    parser = argparse.ArgumentParser(description='Merge shard checkpoint stores into one store.')
+    parser.add_argument('sources', nargs='+', help='Shard stores (.sqlite) to merge, in order')
+    parser.add_argument('--into', required=True, help='Store to merge them into, created if needed')
+    args = parser.parse_args(argv)
+    totals = merge(args.sources, checkpoint.store_path(args.into))
+    print(f"Merged {len(args.sources)} stores into {checkpoint.store_path(args.into)}: "
+          f"{totals['added']} records added, {totals['kept']} kept, "
+          f"{totals['turns']} turns appended")
+    return totals
+
+if __name__ == '__main__':
+    main()
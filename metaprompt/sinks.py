@@ -0,0 +1,213 @@
+"""
+Output sinks: where the output of each processed file goes.
+
+- `FileSink`, the default: one output file per input, named by
+  `utils.create_output_filename`.
+- `JsonlSink`: one JSON line per file in a single file.
+- `ParquetSink`: the same records as a columnar Parquet dataset, a folder of
+  part files (needs `pyarrow`).
+
+A record holds the source path, the prompt, the turns (`idx`, `role`,
+`text`), the output text, token counts and timings, when known.
+
+The bulk sinks buffer records and are flushed with the checkpoint: attached
+to a store (`attach`), the store commits every `--sink_flush` records
+instead of after each one, and writes the buffered records first, so a crash loses the
+outputs and the checkpoint records since the last commit together and those
+files are processed again. A JSONL batch is appended with a single write and
+fsync'ed, and a torn last line is dropped when the file is opened again; a
+Parquet batch is written to a temporary file and renamed into place. Only a
+crash between a batch and its commit can leave a file's record in the sink
+twice, the later one being current.
+"""
+import json
+import os
+import time
+from metaprompt import telemetry
+
+KINDS = ('files', 'jsonl', 'parquet')
+
+def record(text_file:str, args, turns:list, output:str=None, **meta)->dict:
+    """
+    The record of a file's output; `turns` are `(idx, role, text)` and the
+    output defaults to the text of the last one.
+    """
+    if output is None:
+        output = turns[-1][2] if turns else ""
+    return {'source': text_file, 'prompt': args.prompt,
+            'turns': [{'idx': idx, 'role': role, 'text': text}
+                      for idx, role, text in turns],
+            'output': output,
+            'prompt_tokens': meta.get('prompt_tokens'),
+            'response_tokens': meta.get('response_tokens'),
+            'seconds': meta.get('seconds'),
+            'copied_from': meta.get('copied_from'),
+            'time': time.time()}
+
+class FileSink:
+    """
+    One output file per input: the turns, each after a divider, or the
+    `output` text when given (e.g. merged chunks).
+    """
+
+    def write(self, text_file:str, args, turns:list, output:str=None, **meta)->str:
+        from metaprompt import utils
+        with telemetry.phase('output'), utils.open_output(text_file, args) as out_f:
+            out_f.write(output if output is not None else
+                        "".join(utils.divider(idx) + text for idx, _, text in turns))
+        return out_f.name
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+class JsonlSink:
+    """
+    Buffered JSON lines in the file `path`.
+    """
+
+    def __init__(self, path:str):
+        self.path = path
+        self.buffer = []
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.repair()
+
+    def repair(self):
+        """
+        Drop a partly written last line, left by a crash mid-write.
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb+') as f:
+            end = f.seek(0, os.SEEK_END)
+            position = end
+            while position > 0:
+                start = max(position - 8192, 0)
+                f.seek(start)
+                block = f.read(position - start)
+                if position == end and block.endswith(b"\n"):
+                    return
+                newline = block.rfind(b"\n")
+                if newline >= 0:
+                    f.truncate(start + newline + 1)
+                    return
+                position = start
+            f.truncate(0)
+
+    def write(self, text_file:str, args, turns:list, output:str=None, **meta)->str:
+        self.buffer.append(json.dumps(record(text_file, args, turns, output, **meta))
+                           + "\n")
+        return self.path
+
+    def flush(self):
+        if not self.buffer:
+            return
+        data = "".join(self.buffer).encode('utf-8')
+        with telemetry.phase('output'):
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view):]
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self.buffer.clear()
+
+    def close(self):
+        self.flush()
+
+class ParquetSink:
+    """
+    Buffered records written as one Parquet part file per flush into the
+    folder `path`; read them back with e.g. `pandas.read_parquet(path)`.
+    """
+
+    def __init__(self, path:str):
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError("--sink parquet needs pyarrow: "
+                              "pip install metaprompt[parquet]") from None
+        self.path = path
+        self.buffer = []
+        os.makedirs(path, exist_ok=True)
+        self.parts = sum(name.endswith('.parquet') for name in os.listdir(path))
+        turn = pyarrow.struct([('idx', pyarrow.int64()), ('role', pyarrow.string()),
+                               ('text', pyarrow.string())])
+        self.schema = pyarrow.schema([
+            ('source', pyarrow.string()), ('prompt', pyarrow.string()),
+            ('turns', pyarrow.list_(turn)), ('output', pyarrow.string()),
+            ('prompt_tokens', pyarrow.int64()), ('response_tokens', pyarrow.int64()),
+            ('seconds', pyarrow.float64()), ('copied_from', pyarrow.string()),
+            ('time', pyarrow.float64())])
+
+    def write(self, text_file:str, args, turns:list, output:str=None, **meta)->str:
+        self.buffer.append(record(text_file, args, turns, output, **meta))
+        return self.path
+
+    def flush(self):
+        if not self.buffer:
+            return
+        import pyarrow
+        from pyarrow import parquet
+        table = pyarrow.Table.from_pylist(self.buffer, schema=self.schema)
+        name = f"part-{self.parts:05d}-{time.time_ns()}.parquet"
+        # readers skip dot files, such as one left by a crash mid-write
+        temporary = os.path.join(self.path, f".{name}.tmp")
+        with telemetry.phase('output'):
+            parquet.write_table(table, temporary)
+            os.replace(temporary, os.path.join(self.path, name))
+        self.parts += 1
+        self.buffer.clear()
+
+    def close(self):
+        self.flush()
+
+FILES = FileSink()
+
+def usage(response)->dict:
+    """
+    The token counts of a response, for the record of its file.
+    """
+    metadata = getattr(response, 'usage_metadata', None)
+    return {'prompt_tokens': getattr(metadata, 'prompt_token_count', None),
+            'response_tokens': getattr(metadata, 'candidates_token_count', None)}
+
+def of(store)->FileSink:
+    """
+    The sink attached to `store`, the per-file layout if none is.
+    """
+    return getattr(store, 'sink', None) or FILES
+
+def default_path(args)->str:
+    return f"outputs/{os.path.splitext(os.path.basename(args.core))[0]}.{args.sink}"
+
+def sink_path(args)->str:
+    """
+    `args.sink_path` with placeholders substituted, by default
+    `outputs/<core>.jsonl` or `outputs/<core>.parquet`, and with `args.shard`
+    a path of the shard's own.
+    """
+    from metaprompt import utils
+    path = (utils.string_substitute(args.sink_path, args) if args.sink_path
+            else default_path(args))
+    if getattr(args, 'shard', None):
+        index, count = args.shard
+        base, ext = os.path.splitext(path)
+        path = f"{base}.shard{index}-of-{count}{ext}"
+    return path
+
+def attach(store, args):
+    """
+    Attach the sink chosen by `args.sink` to `store`, committing the store
+    every `args.sink_flush` records.
+    """
+    if args.sink == 'files':
+        return
+    path = sink_path(args)
+    store.sink = JsonlSink(path) if args.sink == 'jsonl' else ParquetSink(path)
+    store.commit_every = max(args.sink_flush, 1)
@@ -0,0 +1,184 @@
+"""
+Per-phase timing and token telemetry.
+
+A run records timed phases (core script startup, history loading, file
+discovery, checkpointing, output writing, the editor and the human review
+prompt), every request with its latency, time to first token and token
+counts, every retry, and every finished file. Events are kept as aggregates for the
+end-of-run summary and, with a trace path, appended to a JSONL trace.
+
+The module keeps one current `Telemetry`; `configure` replaces it, and the
+module level helpers record to it so call sites need not pass it around.
+"""
+import contextlib
+import json
+import threading
+import time
+
+class Telemetry:
+    """
+    Collects the events of a run: `phase` timings, `request` latencies and
+    token counts, `retry` attempts and finished `file`s. It aggregates them for
+    `summary` and passes each one to its subscribers.
+
+    Inputs
+    ------
+    trace_path : str
+        JSONL file each event is appended to, one line per event with its
+        time `t`; None keeps the aggregates only
+    """
+
+    def __init__(self, trace_path:str=None):
+        self.trace_path = trace_path
+        self.trace = open(trace_path, 'a') if trace_path else None
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.phases = {}
+        self.requests = []
+        self.files = 0
+        self.retries = []
+        self.listeners = []
+
+    def subscribe(self, listener):
+        """
+        Call `listener(event)` with every event, on the emitting thread.
+        """
+        self.listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        self.listeners.remove(listener)
+
+    def emit(self, event:dict):
+        event = {'t': round(time.time(), 6), **event}
+        with self.lock:
+            if event['event'] == 'phase':
+                self.phases.setdefault(event['name'], []).append(event['seconds'])
+            elif event['event'] == 'request':
+                self.requests.append(event)
+            elif event['event'] == 'file':
+                self.files += 1
+            elif event['event'] == 'retry':
+                self.retries.append(event)
+            if self.trace is not None:
+                self.trace.write(json.dumps(event, default=str) + "\n")
+        for listener in self.listeners:
+            listener(event)
+
+    @contextlib.contextmanager
+    def phase(self, name:str, **fields):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.emit({'event': 'phase', 'name': name,
+                       'seconds': time.perf_counter() - start, **fields})
+
+    def timed(self, iterable, name:str):
+        """
+        Wrap a lazy iterable, recording the time spent producing its items as
+        one phase once it is exhausted.
+        """
+        seconds, count = 0.0, 0
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                seconds += time.perf_counter() - start
+            count += 1
+            yield item
+        self.emit({'event': 'phase', 'name': name, 'seconds': seconds,
+                   'items': count})
+
+    def record_request(self, response, latency:float, **fields):
+        usage = getattr(response, 'usage_metadata', None)
+        self.emit({'event': 'request', 'latency': latency,
+                   'time_to_first_token': getattr(response, 'time_to_first_token', None),
+                   'cached': getattr(response, 'cached', False),
+                   'prompt_tokens': getattr(usage, 'prompt_token_count', None),
+                   'candidates_tokens': getattr(usage, 'candidates_token_count', None),
+                   'total_tokens': getattr(usage, 'total_token_count', None),
+                   **fields})
+
+    def record_file(self, text_file:str, seconds:float=None):
+        self.emit({'event': 'file', 'file': text_file, 'seconds': seconds})
+
+    def summary(self)->str:
+        wall = time.time() - self.started
+        lines = [f"{'phase':<14}{'count':>7}{'total s':>10}"
+                 f"{'p50 s':>9}{'p90 s':>9}{'p99 s':>9}"]
+        for name, seconds in self.phases.items():
+            lines.append(f"{name:<14}{len(seconds):>7}{sum(seconds):>10.2f}"
+                         + "".join(f"{percentile(seconds, q):>9.3f}"
+                                   for q in (50, 90, 99)))
+        sent = [r for r in self.requests if not r['cached']]
+        if self.requests:
+            latency = [r['latency'] for r in sent]
+            ttft = [r['time_to_first_token'] for r in sent
+                    if r['time_to_first_token'] is not None]
+            tokens = {key: sum(r[key] or 0 for r in sent) for key in
+                      ('prompt_tokens', 'candidates_tokens', 'total_tokens')}
+            lines.append(f"requests: {len(sent)} sent, "
+                         f"{len(self.requests) - len(sent)} cached")
+            if latency:
+                lines.append("latency s: " + describe(latency))
+            if ttft:
+                lines.append("time to first token s: " + describe(ttft))
+            lines.append(f"tokens: {tokens['prompt_tokens']} prompt, "
+                         f"{tokens['candidates_tokens']} candidates, "
+                         f"{tokens['total_tokens']} total")
+            if sum(latency):
+                lines.append(f"tokens/s: "
+                             f"{tokens['candidates_tokens'] / sum(latency):.1f} "
+                             f"generated per request-second")
+        if self.retries:
+            throttled = sum(r['throttled'] for r in self.retries)
+            lines.append(f"retries: {len(self.retries)}, {throttled} throttled, "
+                         f"{sum(r['delay'] for r in self.retries):.1f}s backing off")
+        lines.append(f"files: {self.files} in {wall:.1f}s, "
+                     f"{60 * self.files / wall if wall else 0:.1f} files/min")
+        return "\n".join(lines)
+
+    def close(self):
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
+
+def percentile(values:list, q:float)->float:
+    """
+    Nearest-rank percentile.
+    """
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    rank = max(int(-(-q * len(values) // 100)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+def describe(values:list)->str:
+    return ", ".join(f"p{q} {percentile(values, q):.3f}" for q in (50, 90, 99))
+
+_current = Telemetry()
+
+def configure(trace_path:str=None)->Telemetry:
+    global _current
+    _current.close()
+    _current = Telemetry(trace_path)
+    return _current
+
+def current()->Telemetry:
+    return _current
+
+def phase(name:str, **fields):
+    return _current.phase(name, **fields)
+
+def timed(iterable, name:str):
+    return _current.timed(iterable, name)
+
+def record_request(response, latency:float, **fields):
+    _current.record_request(response, latency, **fields)
+
+def record_file(text_file:str, seconds:float=None):
+    _current.record_file(text_file, seconds)
@@ -1,10 +1,14 @@
+import contextlib
 import os
-import shelve
 import subprocess
 import tempfile
-from google.generativeai.generative_models import ChatSession
+import time
+import typing
 from rich import print
 import argparse
+from metaprompt import checkpoint, discovery, ratelimit, sinks, telemetry
+if typing.TYPE_CHECKING: # google.generativeai takes about a second to import
+    from google.generativeai.generative_models import ChatSession
 
 folder = os.path.dirname(__file__)
 corefolder = os.path.abspath(os.path.join(folder, '..', 'core'))
@@ -27,37 +31,68 @@ def get_core_script(args):
 
     return file_contents
 
-def run_core_script(args):
+CORE_NAMES = ('model', 'chat_session', 'history')
+
+def find_core(core:str)->str:
+    """
+    Path of a core script: as given if absolute, else in `./core`, else in
+    the `core` folder next to the package. None if there is none.
     """
-    runs core script using IPython run -i 
+    paths = ((core,) if os.path.isabs(core) else
+             (os.path.join('core', core), os.path.join(corefolder, core)))
+    for path in paths:
+        if os.path.isfile(path):
+            return os.path.abspath(path)
+    return None
 
-    and then place the variables into globals()
+def resolve_core(args, inputs:str='text_files'):
     """
-    from IPython import get_ipython
-    core = os.path.join(corefolder, args.core)
-    if not os.path.exists(core):
-        raise FileNotFoundError(f"Core script {core} not found.")
-    try:
-        ipython = get_ipython()
-        ipython.run_line_magic(f'run', f'-i "{core}"')
-        assert 'chat_session' in ipython.user_ns, f"chat_session not found in core script {core}"
-        for var in ipython.user_ns:
-            globals()[var] = ipython.user_ns[var]
-    except Exception as e:
-        try:
-            exec(open(core).read())
-            assert 'chat_session' in locals(), f"chat_session not found in core script {core}"
-            for var in locals():
-                globals()[var] = locals()[var]
-        except Exception as e:
-            raise e
+    Settle `args.core`. The greedy `inputs` positional swallows the optional
+    core positional after it, so take it back when the last input names a
+    core script; otherwise default to `core/default.py` or
+    `core/core_example.py`.
+    """
+    paths = getattr(args, inputs)
+    if (args.core is None and len(paths) > 1
+            and os.path.basename(paths[-1]) == paths[-1]
+            and find_core(paths[-1]) is not None):
+        args.core = paths.pop()
+    if args.core is None:
+        args.core = ("core/default.py" if os.path.exists("core/default.py") else
+                     "core/core_example.py")
+        # follow links
+        args.core = os.path.realpath(args.core)
+    return args.core
+
+def run_core_script(args)->dict:
+    """
+    Run the core script in an isolated namespace.
+
+    Returns
+    -------
+    dict
+        only `model`, `chat_session` and `history` from the script; `history`
+        defaults to the history of `chat_session`
+    """
+    core = find_core(args.core)
+    if core is None:
+        raise FileNotFoundError(f"Core script {args.core} not found.")
+    namespace = {'__file__': core, '__name__': '__main__'}
+    with open(core) as f:
+        exec(compile(f.read(), core, 'exec'), namespace)
+    for name in ('model', 'chat_session'):
+        if name not in namespace:
+            raise ValueError(f"{name} not found in core script {core}")
+    namespace.setdefault('history', namespace['chat_session'].history)
+    return {name: namespace[name] for name in CORE_NAMES}
 
 def load_and_combine_history(args, 
                 history:list=[], 
                 append:bool=False, 
-                prepend:bool=False)->list:
+                prepend:bool=False,
+                store:checkpoint.CheckpointStore=None)->list:
     """
-    Load and combine the history from the shelve file with 
+    Load and combine the history from the checkpoint store with 
     the core/current history.
 
     Inputs
@@ -70,6 +105,8 @@ def load_and_combine_history(args,
         append the history to the existing history
     prepend : bool
         prepend the history to the existing history
+    store : CheckpointStore
+        the open store at `args.persist`, read instead of opening it
 
     Notes
     -----
@@ -77,20 +114,18 @@ def load_and_combine_history(args,
     if append and prepend are both False, the longer history takes precedence
     """
     args.persist = string_substitute(args.persist, args)
-    args.persist = ".".join(args.persist.split('.')[:-1]) + '.shelve'
-    args.persist = os.path.abspath(args.persist)
+    args.persist = checkpoint.store_path(os.path.abspath(args.persist))
     if os.path.dirname(args.persist) and not os.path.exists(os.path.dirname(args.persist)): 
         os.makedirs(os.path.dirname(args.persist))
-    with shelve.open(args.persist) as shelf:
-        import google.ai # used in unpickling
-        if 'history' in shelf:
+    with (contextlib.nullcontext(store) if store is not None
+          else checkpoint.open_store(args.persist)) as store:
+        if len(store):
             if append:
-                history = shelf['history'] + history
+                history = store.history() + history
             elif prepend:
-                history = history + shelf['history']
-            else: # accept the longer history
-                shelf_has_more_history = len(shelf['history']) > len(history)
-                history = shelf['history'] if shelf_has_more_history else history
+                history = history + store.history()
+            elif len(store) > len(history): # accept the longer history
+                history = store.history()
     return history
 
 def edit_content_with_editor(prompt, response, editor):
@@ -101,7 +136,8 @@ def edit_content_with_editor(prompt, response, editor):
         tmpfile.write(f"# {prompt}\n\n{response}".encode('utf-8'))
         tmpfile_path = tmpfile.name
 
-    subprocess.run([editor, tmpfile_path])
+    with telemetry.phase('editor'):
+        subprocess.run([editor, tmpfile_path])
 
     with open(tmpfile_path, 'r') as tmpfile:
         edited_content = "".join([line for line in tmpfile if not line.startswith("#")])
@@ -109,26 +145,18 @@ def edit_content_with_editor(prompt, response, editor):
     os.remove(tmpfile_path)
     return edited_content
 
-def expand_folders(text_files, sort=None):
+def expand_folders(text_files, sort=None, **filters):
     """
     Expand any folders in the list of files of args.text_files.
 
-    If a folder is folder, use os.walk to get all files in the folder
+    Folders are walked with `discovery.iter_files`, which yields files lazily
+    and applies the `filters`; this collects them into a list and sorts the
+    whole list. Prefer `discovery.iter_files` for large trees.
     """
-    expanded_files = []
-    for text_file in text_files:
-        if os.path.isdir(text_file):
-            for root, _, files in os.walk(text_file):
-                for file in files:
-                    expanded_files.append(os.path.join(root, file))
-        else:
-            expanded_files.append(text_file)
-    if sort == "acc" or sort == "forward" or sort == True:
-        expanded_files = sorted(expanded_files)
-    elif sort == "dec" or sort == "rev" or sort == "reverse":
-        expanded_files = sorted(expanded_files, reverse=True)
-    else:
-        pass
+    expanded_files = list(discovery.iter_files(text_files, **filters))
+    reverse = discovery.sort_order(sort)
+    if reverse is not None:
+        expanded_files = sorted(expanded_files, reverse=reverse)
     return expanded_files
 
 def create_output_filename(text_file, args):
@@ -141,9 +169,34 @@ def create_output_filename(text_file, args):
     output_filename = string_substitute(output_filename, args)
     return output_filename
 
+def divider(i:int)->str:
+    return "\n"+(35*"-")+str(i)+35*"-"+"\n"
+
+def open_output(text_file:str, args):
+    """
+    Open the output file named by `create_output_filename` for writing,
+    creating its folder if needed.
+    """
+    output_filename = create_output_filename(text_file, args)
+    if os.path.dirname(output_filename):
+        os.makedirs(os.path.dirname(output_filename), exist_ok=True)
+    return open(output_filename, 'w')
+
+def write_output(text_file:str, args, history:list, start_index:int,
+                 store:checkpoint.CheckpointStore=None, **meta)->str:
+    """
+    Write the turns of `history` from `start_index` onwards as the output of
+    `text_file`: to the sink attached to `store` (see `sinks`), by default to
+    the file named by `create_output_filename`. `meta` holds the token counts
+    and timings kept by the bulk sinks.
+    """
+    turns = [(i, turn.role, turn.parts[0].text)
+             for i, turn in enumerate(history[start_index:], start_index)]
+    return sinks.of(store).write(text_file, args, turns, **meta)
+
 def string_substitute(string:str, args)->str:
     """
-    Substitute the string with the globals() values. Can swap the following:
+    Substitute placeholders in the string. Can swap the following:
     {CORE} -> args.core
     {DATE} -> datetime.datetime.now
 
@@ -168,39 +221,199 @@ def string_substitute(string:str, args)->str:
     return string
 
 def shelf(args):
-    return shelve.open(args.persist)
+    return checkpoint.open_store(args.persist)
 
 def persist_text_file_conversation(args:argparse.Namespace,
-                                   chat_session:ChatSession, 
+                                   chat_session:'ChatSession', 
                                    text_file:str,
                                    start_index:int,
-                                   is_final:bool=False):
-    """
-    Persist the text file conversation to a shelve file.
-    """
-    with shelve.open(args.persist) as shelf:
-        input_indices = slice(start_index, len(chat_session.history) - 2, 2)
-        output_indices = slice(start_index + 1, len(chat_session.history) - 1, 2)
-        slice_len = (output_indices.stop - 
-                     output_indices.start)
-        if slice_len < 0:
-            # TODO: add an option where when this occurs, users can open a
-            # file dialog to select a file to save the output
-            import warnings
-            warnings.warn("No conversation to save to shelve with slice={}".format(output_indices))
+                                   is_final:bool=False,
+                                   store:checkpoint.CheckpointStore=None,
+                                   history:list=None):
+    """
+    Persist the text file conversation to the checkpoint store. Only the turns
+    not yet in the store are written. Pass an open `store` to reuse its
+    handle, otherwise the store at `args.persist` is opened for this call.
+
+    `history` is the log to checkpoint, `chat_session.history` by default;
+    see `context.ContextPolicy` for when the two differ.
+    """
+    if store is None:
+        with checkpoint.open_store(args.persist) as store:
+            return persist_text_file_conversation(args, chat_session, text_file,
+                                                  start_index, is_final, store,
+                                                  history)
+    history = chat_session.history if history is None else history
+    output_indices = slice(start_index + 1, len(history), 2)
+    slice_len = (output_indices.stop - 
+                 output_indices.start)
+    if slice_len < 0:
+        # TODO: add an option where when this occurs, users can open a
+        # file dialog to select a file to save the output
+        import warnings
+        warnings.warn("No conversation to save to checkpoint with slice={}".format(output_indices))
+    else:
+        print("Saving to checkpoint...")
+        with telemetry.phase('checkpoint'):
+            store.append_history(history)
+            store.put(text_file, start_index, len(history), final=is_final)
+
+
+def append_turns(chat_session:'ChatSession', *texts:str):
+    """
+    Append alternating user/model turns to the chat history without sending
+    a request, e.g. to replay a cached response.
+    """
+    from google.generativeai import protos
+    roles = ('user', 'model')
+    chat_session.history.extend(
+        protos.Content(role=roles[i % 2], parts=[protos.Part(text=text)])
+        for i, text in enumerate(texts))
+
+def send_message(chat_session:'ChatSession', message:str, key:str=None,
+                 response_cache=None, stream:bool=False, out_f=None,
+                 echo:bool=True):
+    """
+    Send `message` on the chat session. When a `response_cache` and a cache
+    `key` are given, a hit is replayed into the history without a request
+    and a miss is stored after the request.
+
+    With `stream`, chunks are rendered as they arrive (if `echo`) and written
+    to the open output file `out_f`, and the time to first token is kept on
+    the response. The history ends up the same as for a non-streamed call.
+
+    Requests go through the current `ratelimit.Scheduler`, which limits and
+    retries them. A failed attempt leaves nothing behind, neither in the
+    history nor in `out_f`.
+    """
+    start = time.perf_counter()
+    if response_cache is not None and key is not None:
+        cached = response_cache.get(key)
+        if cached is not None:
+            append_turns(chat_session, message, cached.text)
+            telemetry.record_request(cached, time.perf_counter() - start)
+            return cached
+    index = len(chat_session.history)
+    position = out_f.tell() if out_f is not None else None
+    def attempt():
+        response = chat_session.send_message(message, stream=stream)
+        if stream:
+            if out_f is not None:
+                out_f.write(divider(index) + message + divider(index + 1))
+            response.time_to_first_token = stream_response(response, start,
+                                                           out_f, echo)
+        return response
+    def discard(error):
+        drop_partial_turn(chat_session, index)
+        if out_f is not None:
+            out_f.seek(position)
+            out_f.truncate()
+    response = ratelimit.current().call(
+        attempt, tokens=lambda: estimate_tokens(chat_session, message),
+        on_failure=discard)
+    telemetry.record_request(response, time.perf_counter() - start)
+    if response_cache is not None and key is not None:
+        response_cache.put(key, response.parts[0].text,
+                           response.usage_metadata.candidates_token_count)
+    return response
+
+def drop_partial_turn(chat_session:'ChatSession', index:int):
+    """
+    Cut the history back to `index` after a failed send. A stream that broke
+    off leaves a pending turn that the history property refuses to fold in;
+    `rewind` drops it.
+    """
+    try:
+        history = chat_session.history
+    except Exception:
+        chat_session.rewind()
+        history = chat_session.history
+    del history[index:]
+
+def estimate_tokens(chat_session:'ChatSession', message:str)->int:
+    """
+    Rough token count of the history plus `message`, at 4 characters a token.
+    """
+    chars = len(message) + sum(len(part.text) for content in chat_session.history
+                               for part in content.parts)
+    return chars // 4
+
+def stream_response(response, start:float, out_f=None, echo:bool=True)->float:
+    """
+    Consume a streamed response, rendering each chunk through the rich console
+    and writing it to `out_f`. Returns the seconds from `start` to the first
+    chunk.
+    """
+    from rich.console import Console
+    console = Console()
+    time_to_first_token = None
+    for chunk in response:
+        if time_to_first_token is None:
+            time_to_first_token = time.perf_counter() - start
+        if echo:
+            console.print(chunk.text, end="", style="green",
+                          markup=False, highlight=False)
+        if out_f is not None:
+            out_f.write(chunk.text)
+            out_f.flush()
+    if echo:
+        console.print()
+    return time_to_first_token
+
+def plan_resume(args, store:checkpoint.CheckpointStore, text_files):
+    """
+    Filter the work list for a run: drop the first `args.skipN` files and
+    every file finalized in the checkpoint. The finalized keys are fetched in
+    a single query up front, and `text_files` may be a lazy iterator (see
+    `discovery.iter_files`); files are passed on as they are discovered.
+
+    Unless `args.quiet_resume` is set, the finalized conversations are echoed
+    from their per-file records; either way a summary line is printed once
+    the work list is exhausted.
+    """
+    finalized = set() if args.ignore_checkpoint else store.finalized()
+    counts = {'skipped': 0, 'done': 0, 'todo': 0}
+    for i, text_file in enumerate(text_files):
+        if i < args.skipN:
+            counts['skipped'] += 1
+        elif text_file in finalized:
+            counts['done'] += 1
+            turns = ([] if getattr(args, 'quiet_resume', False)
+                     else store.file_turns(text_file))
+            if turns: # chunked files merged by concatenation have no turns
+                print(f"[yellow]Processing {text_file}[/yellow]")
+                print(f"Input: {turns[0].parts[0].text}")
+                print(f"Output: {turns[-1].parts[0].text}")
+                print(f"[yellow]Skipping {text_file} as it has already been processed.[/yellow]")
         else:
-            print("Saving to shelve...")
-            shelf['history'] = chat_session.history
-            shelf[text_file] = {'input_index':  input_indices,
-                                'output_index': output_indices}
-            shelf[text_file]['final'] = is_final
+            counts['todo'] += 1
+            yield text_file
+    print(f"[yellow]Resume: {counts['done']} files already processed, "
+          f"{counts['skipped']} skipped, {counts['todo']} to process.[/yellow]")
 
+def token_counts(response)->str:
+    """
+    "N prompt, M response tokens" for a response, leaving out the counts that
+    are unknown, e.g. for a cache hit stored without them.
+    """
+    usage = response.usage_metadata
+    counts = [f"{n} {name}" for n, name in ((usage.prompt_token_count, 'prompt'),
+                                            (usage.candidates_token_count, 'response'))
+              if n is not None]
+    return f"{', '.join(counts)} tokens" if counts else ""
 
-def print_message(response):
+def print_message(response, show_text:bool=True):
     from rich.markdown import Markdown
     from rich.console import Console
     response_text = response.parts[0].text
     with Console() as console:
-        console.print(f"[blue]Token count: {response.usage_metadata.candidates_token_count}[/blue]")
+        # counts are unknown for some stand-ins, e.g. a near duplicate's output
+        if response.usage_metadata.candidates_token_count is not None:
+            console.print(f"[blue]Token count: {response.usage_metadata.candidates_token_count}[/blue]")
+        if response.usage_metadata.prompt_token_count is not None:
+            console.print(f"[blue]Prompt tokens: {response.usage_metadata.prompt_token_count}[/blue]")
         # print(f"[blue]Token cost: {response.usage_metadata.candidates_token_count}[/blue]")
-        console.print(f"[green]{response_text}[/green]")
+        if getattr(response, 'time_to_first_token', None) is not None:
+            console.print(f"[blue]Time to first token: {response.time_to_first_token:.2f}s[/blue]")
+        if show_text: # streamed responses were already rendered
+            console.print(f"[green]{response_text}[/green]")
@@ -0,0 +1,217 @@
+"""
+Content-keyed resume and watch mode.
+
+Checkpoint records are keyed by path, so an edited file still counts as done
+and a renamed one is sent again. With `--key_by content`, records also carry
+the SHA-256 of the content they were made from and a fingerprint of the core
+and prompt they were made with (`setup_fingerprint`), and `plan_resume`:
+
+- skips files whose content and setup match their record, without reading
+  them while their size and modification time are unchanged,
+- copies the output of a file with the same content and setup to a file seen
+  under a new path (a rename or a copy), without a request,
+- sends files that changed, or were done with another core or prompt, again.
+
+`watch` keeps a run going after its first pass: files created, modified or
+moved under the inputs are collected with watchdog and, once `debounce`
+seconds pass without another change, run as one batch through the same
+plan, so saving a file several times costs one request.
+"""
+import copy
+import hashlib
+import os
+import threading
+import time
+from rich import print
+from metaprompt import checkpoint, dedup, discovery, telemetry
+
+def setup_fingerprint(core_fingerprint:str, prompt:str)->str:
+    """
+    Hash of what a file's output depends on besides its content: the
+    `cache.core_fingerprint` of the core history and model, and the prompt.
+    """
+    return hashlib.sha256(f"{core_fingerprint}\0{prompt}".encode('utf-8')).hexdigest()
+
+def file_digest(path:str)->str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def plan_resume(args, store:checkpoint.CheckpointStore, text_files):
+    """
+    `utils.plan_resume` by content: drop the first `args.skipN` files, and
+    the files whose record matches their content and `store.setup`; copy
+    outputs to renamed files. The digests of the files passed on are
+    recorded when they are finalized, see `CheckpointStore.expect`.
+    """
+    counts = {'skipped': 0, 'done': 0, 'copied': 0, 'changed': 0, 'todo': 0}
+    for i, text_file in enumerate(text_files):
+        if i < args.skipN:
+            counts['skipped'] += 1
+            continue
+        stat = os.stat(text_file)
+        size, mtime = stat.st_size, stat.st_mtime_ns
+        final = (not args.ignore_checkpoint
+                 and store.get(text_file, {}).get('final', False))
+        known = store.digest(text_file)
+        if final and known is not None and known[1:] == (store.setup, size, mtime):
+            counts['done'] += 1
+            continue
+        with telemetry.phase('digest'):
+            digest = file_digest(text_file)
+        if final and (known is None or known[:2] == (digest, store.setup)):
+            # unchanged but touched, or recorded before digests were
+            store.set_digest(text_file, digest, size, mtime)
+            counts['done'] += 1
+            continue
+        source = None if args.ignore_checkpoint else store.find_content(digest)
+        if source is not None:
+            store.expect(text_file, digest, size, mtime)
+            dedup.fan_out(args, store, source, text_file)
+            print(f"[green]{text_file} has the content of {source}, output copied[/green]")
+            telemetry.record_file(text_file)
+            counts['copied'] += 1
+            continue
+        if final:
+            store.invalidate(text_file)
+            counts['changed'] += 1
+        store.expect(text_file, digest, size, mtime)
+        counts['todo'] += 1
+        yield text_file
+    print(f"[yellow]Resume: {counts['done']} files unchanged, {counts['copied']} "
+          f"copied from files with the same content, {counts['changed']} "
+          f"changed, {counts['skipped']} skipped, {counts['todo']} to "
+          f"process.[/yellow]")
+
+class ChangeCollector:
+    """
+    watchdog event handler collecting the files created, modified or moved
+    into the watched folders, handed out by `batch`.
+
+    Inputs
+    ------
+    debounce : float
+        seconds without a change before a batch is handed out
+    max_wait : float
+        seconds a change waits at most while changes keep coming, by default
+        ten times `debounce`
+    """
+
+    def __init__(self, debounce:float=2.0, max_wait:float=None):
+        self.debounce = debounce
+        self.max_wait = 10 * debounce if max_wait is None else max_wait
+        self.changed = {}
+        self.last = 0.0
+        self.condition = threading.Condition()
+
+    def add(self, path:str):
+        with self.condition:
+            now = time.monotonic()
+            self.changed.setdefault(path, now)
+            self.last = now
+            self.condition.notify()
+
+    def dispatch(self, event):
+        if event.is_directory:
+            return
+        if event.event_type in ('created', 'modified', 'closed'):
+            self.add(os.fsdecode(event.src_path))
+        elif event.event_type == 'moved':
+            self.add(os.fsdecode(event.dest_path))
+
+    def batch(self, timeout:float=None)->list:
+        """
+        Wait for changes and return the files changed, in the order first
+        seen, once `debounce` seconds pass without another. Returns an empty
+        list if nothing changed within `timeout` seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                if self.changed:
+                    due = min(self.last + self.debounce,
+                              min(self.changed.values()) + self.max_wait)
+                    if now >= due:
+                        batch = list(self.changed)
+                        self.changed.clear()
+                        return batch
+                    wait = due - now
+                elif deadline is not None and now >= deadline:
+                    return []
+                else:
+                    wait = None if deadline is None else deadline - now
+                self.condition.wait(wait)
+
+def is_output(path:str, args)->bool:
+    """
+    True if `path` is named like an output file, e.g. one written into a
+    watched folder.
+    """
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return bool(args.append) and stem.endswith(args.append)
+
+def select(args, changed:list, paths:list)->list:
+    """
+    The files among `changed` (absolute paths) that a run over the inputs
+    `paths` would process, named as the run would name them.
+    """
+    filters = dict(include=args.include, exclude=args.exclude,
+                   max_bytes=args.max_bytes, binary=args.binary,
+                   encoding=args.encoding,
+                   ignore_files=() if args.no_ignore_files else discovery.IGNORE_FILES)
+    selected = []
+    for path in changed:
+        if is_output(path, args) or not os.path.isfile(path):
+            continue
+        for top in paths:
+            if os.path.isdir(top):
+                name = os.path.join(top, os.path.relpath(path, os.path.abspath(top)))
+                if discovery.accepts(path, os.path.abspath(top), **filters):
+                    selected.append(name)
+                    break
+            elif os.path.abspath(top) == path:
+                selected.append(top)
+                break
+    return selected
+
+def watch(args, paths:list, run, core:dict, timeout:float=None):
+    """
+    Process the files created or changed under the inputs `paths` in
+    debounced batches, with `run(args, core)` as `apply.run`, until
+    interrupted, or until nothing changed for `timeout` seconds.
+
+    Returns the summed `{'done', 'failed'}` counts of the batches.
+    """
+    from watchdog.observers import Observer
+    collector = ChangeCollector(args.watch_debounce)
+    observer = Observer()
+    folders = {os.path.abspath(path) if os.path.isdir(path)
+               else os.path.dirname(os.path.abspath(path)) for path in paths}
+    for folder in folders:
+        observer.schedule(collector, folder, recursive=True)
+    observer.start()
+    counts = {'done': 0, 'failed': 0}
+    print(f"[yellow]Watching {', '.join(paths)} for changes, Ctrl-C to stop[/yellow]")
+    try:
+        while True:
+            changed = collector.batch(timeout)
+            if not changed:
+                break
+            batch = select(args, changed, paths)
+            if not batch:
+                continue
+            print(f"[yellow]{len(batch)} files changed[/yellow]")
+            batch_args = copy.copy(args)
+            batch_args.text_files = batch
+            batch_args.skipN = 0
+            more = run(batch_args, core)
+            counts = {k: counts[k] + more[k] for k in counts}
+    except KeyboardInterrupt:
+        print("[yellow]Stopped watching[/yellow]")
+    finally:
+        observer.stop()
+        observer.join()
+    return counts
@@ -0,0 +1,23 @@
+import pytest
+
+@pytest.fixture
+def corpus(tmp_path):
+    folder = tmp_path / "corpus"
+    folder.mkdir()
+    for i in range(3):
+        (folder / f"text{i}.txt").write_text(f"text number {i}\n")
+    return folder
+
+@pytest.fixture
+def run_apply(tmp_path, monkeypatch):
+    """
+    `apply.main` on the corpus from `tmp_path`, non-interactive and without
+    the response cache or search index, with extra options.
+    """
+    from metaprompt import apply
+    monkeypatch.chdir(tmp_path)
+    def main(*options):
+        return apply.main(["corpus", "fake_core.py", "--prompt", "summarise",
+                           "--yes", "--no-cache", "--no-index", "--quiet_resume",
+                           *options])
+    return main
@@ -0,0 +1,39 @@
+import argparse
+import io
+import json
+from metaprompt import batch_prompt
+from metaprompt.fake import FakeGenerativeModel
+
+def test_deduplicator_collapses_exact_and_near_duplicates(tmp_path):
+    with batch_prompt.SampleStore(str(tmp_path / "batch.sqlite")) as store:
+        dedup = batch_prompt.Deduplicator(store, similarity=0.9)
+        first, similarity = dedup.match("cell", "A short answer about foxes.")
+        assert similarity is None
+        assert dedup.match("cell", "a short  answer about foxes.") == (first, 1.0)
+        near, similarity = dedup.match("cell", "A short answer about foxes!")
+        assert near == first and 0.9 <= similarity < 1
+        assert dedup.match("cell", "Something else entirely.")[1] is None
+        assert dedup.match("other", "A short answer about foxes.")[1] is None
+
+def test_run_batch_streams_and_resumes(tmp_path):
+    corpus = tmp_path / "corpus"
+    corpus.mkdir()
+    for i in range(2):
+        (corpus / f"text{i}.txt").write_text(f"text number {i}\n")
+    text_files = sorted(str(p) for p in corpus.iterdir())
+    model = FakeGenerativeModel()
+    args = argparse.Namespace(samples=3, concurrency=2, similarity=0.9)
+    out_f = io.StringIO()
+    with batch_prompt.SampleStore(str(tmp_path / "batch.sqlite")) as store:
+        counts = batch_prompt.run_batch(args, model, [], text_files,
+                                        ["summarise", "critique"], store, out_f)
+        # the fake model answers a message the same way every time
+        assert counts == {'unique': 4, 'duplicate': 8, 'failed': 0}
+        records = [json.loads(line) for line in out_f.getvalue().splitlines()]
+        assert len(records) == 12 and sum('text' in r for r in records) == 4
+
+        args.samples = 4
+        calls = model.calls
+        counts = batch_prompt.run_batch(args, model, [], text_files,
+                                        ["summarise", "critique"], store, out_f)
+        assert counts['duplicate'] == 4 and model.calls == calls + 4
@@ -0,0 +1,40 @@
+import time
+from metaprompt import cache
+
+def test_hit_and_miss_counts(tmp_path):
+    with cache.ResponseCache(str(tmp_path / "cache.sqlite")) as response_cache:
+        key = cache.cache_key("core", "summarise", "file content")
+        assert response_cache.get(key) is None
+        response_cache.put(key, "summary", tokens=3)
+        hit = response_cache.get(key)
+        assert hit.parts[0].text == "summary"
+        assert hit.usage_metadata.candidates_token_count == 3
+        assert (response_cache.hits, response_cache.misses) == (1, 1)
+        assert key != cache.cache_key("core", "summarise", "other content")
+
+def test_evicts_old_and_least_recently_used(tmp_path):
+    response_cache = cache.ResponseCache(str(tmp_path / "cache.sqlite"),
+                                         max_bytes=10, max_age=60)
+    response_cache.put("a", "x" * 6)
+    response_cache.put("b", "y" * 6)
+    response_cache.connection.execute(
+        "UPDATE responses SET accessed = accessed - 1 WHERE key = 'a'")
+    assert response_cache.evict() == 1
+    assert response_cache.get("a") is None and response_cache.get("b")
+    response_cache.connection.execute(
+        "UPDATE responses SET created = ?", (time.time() - 120,))
+    assert response_cache.evict() == 1
+    response_cache.close()
+
+def test_unknown_token_count_is_not_printed(capsys):
+    from metaprompt import utils
+    utils.print_message(cache.cached_response("hello", tokens=3))
+    assert "Token count: 3" in capsys.readouterr().out
+    utils.print_message(cache.cached_response("hello"))
+    assert "Token count" not in capsys.readouterr().out
+
+def test_token_counts_leave_out_unknowns():
+    from metaprompt import utils
+    assert utils.token_counts(cache.cached_response("hi", tokens=3)) == \
+        "0 prompt, 3 response tokens"
+    assert utils.token_counts(cache.cached_response("hi")) == "0 prompt tokens"
@@ -0,0 +1,83 @@
+import shelve
+from google.generativeai import protos
+from metaprompt import checkpoint
+
+def turn(role, text):
+    return protos.Content(role=role, parts=[protos.Part(text=text)])
+
+def test_append_history_writes_only_new_turns(tmp_path):
+    persist = str(tmp_path / "core.py")
+    history = [turn('user', 'a'), turn('model', 'b')]
+    with checkpoint.open_store(persist) as store:
+        assert store.append_history(history) == 2
+        store.put('a.txt', 0, 2, final=True)
+        history += [turn('user', 'c'), turn('model', 'd')]
+        assert store.append_history(history) == 2
+        store.put('c.txt', 2, 4)
+    with checkpoint.open_store(persist) as store:
+        assert len(store) == 4
+        assert store['a.txt']['final'] and not store['c.txt']['final']
+        assert [t.parts[0].text for t in store.file_turns('c.txt')] == ['c', 'd']
+        assert [t.parts[0].text for t in store.history()] == ['a', 'b', 'c', 'd']
+        assert store.keys() == ['a.txt', 'c.txt']
+
+def test_migrates_shelve_once(tmp_path):
+    with shelve.open(str(tmp_path / "core.shelve")) as shelf:
+        shelf['history'] = [turn('user', 'a'), turn('model', 'b')]
+        shelf['a.txt'] = {'input_index': slice(0, 0, 2),
+                          'output_index': slice(1, 1, 2), 'final': True}
+    with checkpoint.open_store(str(tmp_path / "core.py")) as store:
+        assert len(store) == 2
+        assert store['a.txt']['output_index'] == slice(1, 2, 2)
+
+def test_finalized_keys(tmp_path):
+    with checkpoint.open_store(str(tmp_path / "core.py")) as store:
+        store.put('a.txt', 0, 2, final=True)
+        store.put('b.txt', 2, 4, final=False)
+        assert store.finalized() == {'a.txt'}
+
+def test_pages_and_texts_read_only(tmp_path):
+    persist = str(tmp_path / "core.py")
+    with checkpoint.open_store(persist) as store:
+        for i in range(5):
+            store.append_history([turn('user', f"q{j // 2}") if j % 2 == 0 else
+                                  turn('model', f"a{j // 2}") for j in range(2 * i + 2)])
+            store.put(f"dir/{i}.txt", 2 * i, 2 * i + 2, final=True)
+    with checkpoint.open_store(persist, readonly=True) as store:
+        assert store.count() == 5 and store.count("*/3.txt") == 1
+        assert [row[0] for row in store.page(1, 2)] == ["dir/1.txt", "dir/2.txt"]
+        assert store.page(0, 10, "*/4.txt") == [("dir/4.txt", 8, 10, 1)]
+        assert store.texts(2, 4) == [(2, 'user', 'q1'), (3, 'model', 'a1')]
+
+def test_turns_stored_without_pickles(tmp_path):
+    path = str(tmp_path / "core.sqlite")
+    multipart = protos.Content(role='model', parts=[protos.Part(text='x'),
+                                                    protos.Part(text='y')])
+    with checkpoint.CheckpointStore(path) as store:
+        store.append_history([turn('user', 'a'), multipart])
+        store.put('a.txt', 0, 2, final=True)
+        contents = [row[0] for row in store.connection.execute(
+            "SELECT content FROM turns ORDER BY idx")]
+        assert contents[0] is None and contents[1] == protos.Content.serialize(multipart)
+        assert store.history() == [turn('user', 'a'), multipart]
+        assert [t.parts[0].text for t in store.file_turns('a.txt')] == ['a', 'xy']
+
+def test_upgrades_pickled_store(tmp_path):
+    import pickle
+    import sqlite3
+    path = str(tmp_path / "core.sqlite")
+    connection = sqlite3.connect(path)
+    connection.executescript(checkpoint.SCHEMA)
+    connection.executemany("INSERT INTO turns VALUES (?, ?, ?, ?)",
+                           [(i, t.role, t.parts[0].text, pickle.dumps(t)) for i, t in
+                            enumerate([turn('user', 'a'), turn('model', 'b')])])
+    connection.commit()
+    connection.close()
+    with checkpoint.CheckpointStore(path, readonly=True) as store:
+        assert store.format == 0 and store.history()[1] == turn('model', 'b')
+    checkpoint.main([str(tmp_path)])
+    with checkpoint.CheckpointStore(path, readonly=True) as store:
+        assert store.format == checkpoint.FORMAT
+        assert store.connection.execute(
+            "SELECT COUNT(*) FROM turns WHERE content IS NOT NULL").fetchone() == (0,)
+        assert store.history() == [turn('user', 'a'), turn('model', 'b')]
@@ -0,0 +1,31 @@
+from metaprompt import chunking
+
+def test_chunks_respect_budget_and_overlap(tmp_path):
+    path = tmp_path / "big.log"
+    lines = [f"line {i:04d}\n" for i in range(200)] # 10 chars each
+    path.write_text("".join(lines))
+    chunks = list(chunking.iter_chunks(str(path), max_tokens=50,
+                                       overlap_tokens=5))
+    assert all(len(chunk) <= 200 for chunk in chunks)
+    assert chunks[0].splitlines()[-2:] == chunks[1].splitlines()[:2]
+    assert chunks == list(chunking.iter_chunks(str(path), max_tokens=50,
+                                               overlap_tokens=5, use_mmap=True))
+    covered = {line for chunk in chunks for line in chunk.splitlines(True)}
+    assert covered == set(lines)
+
+def test_long_lines_are_cut(tmp_path):
+    path = tmp_path / "one.txt"
+    path.write_text("x" * 1000)
+    chunks = list(chunking.iter_chunks(str(path), max_tokens=100))
+    assert [len(chunk) for chunk in chunks] == [400, 400, 200]
+    assert chunking.needs_chunking(str(path), 100)
+    assert not chunking.needs_chunking(str(path), None)
+
+def test_overlap_never_exceeds_budget(tmp_path):
+    path = tmp_path / "g.txt"
+    path.write_text("".join(f"{i:03d}" + "y" * (37 * i % 390) + "\n"
+                            for i in range(100)))
+    chunks = list(chunking.iter_chunks(str(path), max_tokens=100,
+                                       overlap_tokens=50))
+    assert all(len(chunk) <= 100 * chunking.CHARS_PER_TOKEN for chunk in chunks)
+    assert sum(chunk.count("\n") for chunk in chunks) > 100 # some overlap
@@ -0,0 +1,61 @@
+import google.generativeai as genai
+from metaprompt import context
+
+def texts(turns):
+    return [turn.parts[0].text for turn in turns]
+
+def run_file(policy, chat, name):
+    start = policy.begin(chat)
+    chat.history.extend(genai.protos.Content(role=role, parts=[{'text': name}])
+                        for role in ('user', 'model'))
+    return policy.end(chat, start)
+
+def test_window_keeps_last_files_and_full_log():
+    core = [{'role': 'user', 'parts': ['core']}, {'role': 'model', 'parts': ['ok']}]
+    chat = genai.GenerativeModel('model').start_chat(history=core)
+    policy = context.ContextPolicy('window', None, chat.history, chat, window=1)
+    assert [run_file(policy, chat, name) for name in 'abc'] == [2, 4, 6]
+    assert texts(policy.log) == ['core', 'ok', 'a', 'a', 'b', 'b', 'c', 'c']
+    policy.begin(chat)
+    assert texts(chat.history) == ['core', 'ok', 'c', 'c']
+
+def test_reset_sends_core_only():
+    chat = genai.GenerativeModel('model').start_chat(history=[])
+    policy = context.ContextPolicy('reset', None, [], chat)
+    run_file(policy, chat, 'a')
+    assert policy.begin(chat) == 0 and len(policy.log) == 2
+
+def test_compact_resume_rebuilds_summary():
+    from metaprompt import fake
+    model = fake.FakeGenerativeModel()
+    chat = model.start_chat(history=[])
+    policy = context.ContextPolicy('compact', model, [], chat, window=1)
+    for name in 'abc':
+        run_file(policy, chat, name)
+    resumed_chat = model.start_chat(history=policy.log)
+    resumed = context.ContextPolicy('compact', model, [], resumed_chat, window=1,
+                                    ranges=[(0, 2), (2, 4), (4, 6)])
+    assert resumed.evicted == [(0, 2), (2, 4)]
+    resumed.begin(resumed_chat)
+    assert resumed.summary and not resumed.evicted
+    history = resumed_chat.history
+    assert history[:2] == context.summary_turns(resumed.summary)
+    assert texts(history[2:]) == ['c', 'c']
+
+def test_compact_keeps_evicted_files_until_summarized():
+    from metaprompt import fake
+    model = fake.FakeGenerativeModel()
+    chat = model.start_chat(history=[])
+    policy = context.ContextPolicy('compact', model, [], chat, window=3)
+    for name in 'abcd':
+        run_file(policy, chat, name)
+    policy.begin(chat)
+    assert policy.summary is None
+    assert texts(chat.history) == ['a', 'a', 'b', 'b', 'c', 'c', 'd', 'd']
+    for name in 'efg':
+        run_file(policy, chat, name)
+    policy.begin(chat)
+    # a, b and c were summarized when c fell out, d waits for two more
+    assert policy.summary and len(policy.evicted) == 1
+    assert chat.history[:2] == context.summary_turns(policy.summary)
+    assert texts(chat.history[2:]) == ['d', 'd', 'e', 'e', 'f', 'f', 'g', 'g']
@@ -0,0 +1,99 @@
+import argparse
+import os
+import threading
+import time
+from metaprompt import daemon
+
+def test_queue_order_and_requeue(tmp_path):
+    jobs = daemon.JobQueue(str(tmp_path / "jobs.sqlite"))
+    low = jobs.submit({'n': 1}, "/", priority=0)
+    high = jobs.submit({'n': 2}, "/", priority=5)
+    assert jobs.claim(timeout=0)[0] == high
+    assert jobs.requeue() == 1
+    assert [jobs.claim(timeout=0)[0] for _ in range(2)] == [high, low]
+    assert jobs.claim(timeout=0) is None
+    jobs.finish(high, {'done': 1})
+    assert jobs.jobs(high)[0]['status'] == 'done'
+
+def test_localize_only_foreign_paths(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    args = argparse.Namespace(text_files=["a.txt"], persist="database/x",
+                              cache_path="database/cache.sqlite")
+    assert daemon.localize(args, str(tmp_path)).text_files == ["a.txt"]
+    args = daemon.localize(args, "/elsewhere")
+    assert args.text_files == ["/elsewhere/a.txt"]
+    assert args.persist == "/elsewhere/database/x"
+    args = argparse.Namespace(text_files=["a.txt"], persist="database/x",
+                              core="/cores/fake_core.py", sink='jsonl',
+                              sink_path=None)
+    assert daemon.localize(args, "/elsewhere").sink_path == \
+        "/elsewhere/outputs/fake_core.jsonl"
+
+def test_jobs_sharing_a_sink_share_a_lock(tmp_path):
+    server = daemon.Daemon(str(tmp_path / "queue.sqlite"), workers=1)
+    def job(persist, sink_path):
+        return argparse.Namespace(persist=persist, core="fake_core.py",
+                                  sink='jsonl', sink_path=sink_path, shard=None)
+    try:
+        a = server.store_locks_for(job(str(tmp_path / "a"), str(tmp_path / "out.jsonl")))
+        b = server.store_locks_for(job(str(tmp_path / "b"), str(tmp_path / "out.jsonl")))
+        assert len(a) == 2 and set(a) & set(b)
+    finally:
+        server.telemetry.unsubscribe(server.on_event)
+        server.jobs.close()
+
+def test_stores_stay_open_between_jobs(tmp_path):
+    from google.generativeai import protos
+    from metaprompt import checkpoint
+    def turn(text):
+        return protos.Content(role='user', parts=[protos.Part(text=text)])
+    server = daemon.Daemon(str(tmp_path / "queue.sqlite"), workers=1)
+    args = argparse.Namespace(persist=str(tmp_path / "database" / "core.py"),
+                              shard=None)
+    try:
+        store = server.store(args)
+        store.append_history([turn('a'), turn('b')])
+        store.put('a.txt', 0, 2, final=True)
+        store.release()
+        assert len(store.history()) == 2 and len(store.kept) == 2
+        assert server.store(args) is store
+
+        # another process appends: the store is opened again
+        with checkpoint.open_store(store.path) as other:
+            other.append_history(other.history() + [turn('c')])
+        fresh = server.store(args)
+        assert fresh is not store
+        assert [t.parts[0].text for t in fresh.history()] == ['a', 'b', 'c']
+    finally:
+        server.telemetry.unsubscribe(server.on_event)
+        server.jobs.close()
+        for store in server.stores.values():
+            store.close()
+
+def test_jobs_stream_results_and_reuse_cores(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "corpus").mkdir()
+    for i in range(2):
+        (tmp_path / "corpus" / f"t{i}.txt").write_text(f"text {i}\n")
+    sock = str(tmp_path / "d.sock")
+    server = daemon.Daemon(str(tmp_path / "jobs.sqlite"), workers=2)
+    threading.Thread(target=server.serve, args=(sock,), daemon=True).start()
+    while not os.path.exists(sock):
+        time.sleep(0.01)
+    try:
+        argv = ["corpus", "fake_core.py", "--prompt", "summarise", "--no-cache"]
+        events = list(daemon.submit(argv, path=sock))
+        assert events[0]['event'] == 'queued' and events[-1]['event'] == 'done'
+        assert sorted(e['file'] for e in events if e['event'] == 'file') == \
+            [os.path.join("corpus", "t0.txt"), os.path.join("corpus", "t1.txt")]
+        assert events[-1]['counts'] == {'done': 2, 'failed': 0}
+
+        events = list(daemon.submit(argv + ["--ignore_checkpoint", "--concurrency", "2"],
+                                    path=sock))
+        assert events[-1]['counts'] == {'done': 2, 'failed': 0}
+        assert len(server.cores) == 1 and len(server.stores) == 1
+        assert len(os.listdir(tmp_path / "outputs" / "corpus")) == 2
+        status = next(daemon.request({'op': 'status'}, sock))['jobs']
+        assert [job['status'] for job in status] == ['done', 'done']
+    finally:
+        list(daemon.request({'op': 'shutdown'}, sock))
@@ -0,0 +1,37 @@
+from metaprompt import dedup
+
+REVIEW = ("I ordered the blue kettle last week and it arrived with a cracked lid. "
+          "Customer service was quick to answer and sent a replacement that "
+          "works fine, though the whistle is quieter than I expected.")
+
+def test_exact_and_near_duplicates_join_clusters():
+    deduplicator = dedup.Deduplicator(threshold=0.8)
+    assert deduplicator.add('a', REVIEW) is None
+    assert deduplicator.add('b', REVIEW) == ('a', 1.0)
+    representative, similarity = deduplicator.add('c', REVIEW + " Sent from my phone")
+    assert representative == 'a' and 0.8 <= similarity < 1.0
+    assert deduplicator.add('d', "Completely different text about shipping delays "
+                                 "and a parcel that never showed up at all.") is None
+
+    exact_only = dedup.Deduplicator(near=False)
+    exact_only.add('a', REVIEW)
+    assert exact_only.add('c', REVIEW + " Sent from my phone") is None
+
+def test_bands_stay_below_threshold():
+    for threshold in (0.5, 0.8, 0.9, 0.95):
+        bands = dedup.bands_for(threshold, 128)
+        assert (1 / bands) ** (bands / 128) <= threshold
+
+def test_plan_and_report(tmp_path):
+    paths = []
+    for i, text in enumerate([REVIEW, REVIEW, "unrelated"]):
+        path = tmp_path / f"{i}.txt"
+        path.write_text(text)
+        paths.append(str(path))
+    files, plan = dedup.plan(iter(paths))
+    assert files == paths and plan.members == {paths[1]: (paths[0], 1.0)}
+    assert list(plan.defer(files)) == [paths[0], paths[2]]
+    assert plan.deferred == [paths[1]]
+    plan.record(paths[1], 'copied')
+    assert "3 files in 2 clusters" in plan.report()
+    assert "1 requests avoided" in plan.report()
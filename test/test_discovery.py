@@ -0,0 +1,44 @@
+import os
+from metaprompt import discovery
+
+def make_tree(root):
+    files = {'a.txt': b'a', 'b.md': b'b', 'big.txt': b'x' * 100,
+             'image.bin': b'\x89PNG\0\0', 'sub/c.txt': b'c',
+             'sub/skip.log': b'log', 'build/d.txt': b'd', '.git/HEAD': b'ref',
+             '.gitignore': b'build/\n*.log\n'}
+    for name, content in files.items():
+        path = os.path.join(root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+
+def names(files, root):
+    return [os.path.relpath(f, root) for f in files]
+
+def test_walk_filters_and_orders(tmp_path):
+    make_tree(tmp_path)
+    found = names(discovery.iter_files([str(tmp_path)], sort='forward',
+                                       include=['*.txt'], max_bytes=50),
+                  tmp_path)
+    assert found == ['a.txt', os.path.join('sub', 'c.txt')]
+    found = names(discovery.iter_files([str(tmp_path)], sort='reverse'),
+                  tmp_path)
+    assert found == ['big.txt', 'b.md', 'a.txt', '.gitignore',
+                     os.path.join('sub', 'c.txt')]
+
+def test_walk_is_lazy(tmp_path):
+    make_tree(tmp_path)
+    files = discovery.iter_files([str(tmp_path)], sort='forward')
+    assert os.path.basename(next(files)) == '.gitignore'
+
+def test_explicit_files_pass_through(tmp_path):
+    assert list(discovery.iter_files(['missing.bin'])) == ['missing.bin']
+
+def test_accepts_matches_walk(tmp_path):
+    make_tree(tmp_path)
+    walked = set(discovery.iter_files([str(tmp_path)]))
+    for root, _, files in os.walk(tmp_path):
+        for name in files:
+            path = os.path.join(root, name)
+            assert discovery.accepts(path, str(tmp_path)) == (path in walked), path
+    assert not discovery.accepts(str(tmp_path / 'a.txt'), str(tmp_path / 'sub'))
@@ -0,0 +1,22 @@
+from metaprompt import packing
+
+def test_parse_answers_keeps_clean_ones():
+    text = ('<answer id="1">one</answer>\n<answer id="2"></answer>'
+            '<answer id="3">three</answer><answer id="3">again</answer>'
+            '<answer id=4>four</answer><answer id="9">stray</answer>')
+    assert packing.parse_answers(text, 4) == {1: 'one', 4: 'four'}
+    assert packing.parse_answers("no tags at all", 2) == {}
+
+def test_packs_respect_budget(tmp_path):
+    sizes = [40, 40, 40, 400, 40]
+    paths = []
+    for i, size in enumerate(sizes):
+        path = tmp_path / f"{i}.txt"
+        path.write_text("x" * size)
+        paths.append(str(path))
+    packs = list(packing.iter_packs(paths, max_tokens=25))
+    assert packs == [paths[:2], [paths[3]], [paths[2], paths[4]]]
+    assert list(packing.iter_packs(paths, max_tokens=1000, max_files=2)) == \
+        [paths[:2], paths[2:4], paths[4:]]
+    message = packing.format_pack(["a", "b"], "Summarise")
+    assert '<content id="2">b</content>' in message and "Summarise" in message
@@ -0,0 +1,43 @@
+from metaprompt import prefix_cache
+from metaprompt.fake import FakeGenerativeModel
+
+CORE = [{'role': 'user', 'parts': ["<content>x</content><user_request>Describe.</user_request>"]},
+        {'role': 'model', 'parts': ["A variable named x."]}]
+
+def test_requests_reference_the_cached_prefix(tmp_path):
+    core = tmp_path / "core.py"
+    core.write_text("history = []\n")
+    registry = str(tmp_path / "prefix_cache.json")
+    model = FakeGenerativeModel(system_instruction="Be brief.")
+    prefix = prefix_cache.PrefixCache(model, CORE, str(core), registry, ttl=60)
+    wrapped = prefix.wrap()
+    chat = wrapped.start_chat(history=CORE)
+    plain = model.start_chat(history=CORE).send_message("hello")
+    response = chat.send_message("hello")
+    assert response.text == plain.text and len(chat.history) == 4
+    assert response.usage_metadata.cached_content_token_count > 0
+    assert prefix.requests == 1 and prefix.tokens_saved > 0
+
+    # requests not starting with the core history are sent as they are
+    model.start_chat().send_message("other")
+    wrapped.start_chat().send_message("other")
+    assert prefix.requests == 1
+
+    # a later run reuses the cache until the core script changes
+    again = prefix_cache.PrefixCache(model, CORE, str(core), registry, ttl=60)
+    assert again.handle.name == prefix.handle.name
+    core.write_text("history = [] # edited\n")
+    changed = prefix_cache.PrefixCache(model, CORE, str(core), registry, ttl=60)
+    assert changed.handle.name != prefix.handle.name
+    assert prefix.handle.name not in prefix.backend.caches
+
+def test_ttl_refreshed_when_half_gone(tmp_path):
+    model = FakeGenerativeModel()
+    prefix = prefix_cache.PrefixCache(model, CORE, None,
+                                      str(tmp_path / "registry.json"), ttl=60)
+    expires = prefix.expires
+    prefix.refresh()
+    assert prefix.expires == expires
+    prefix.expires -= 40
+    prefix.refresh()
+    assert prefix.expires >= expires
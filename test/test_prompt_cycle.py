@@ -1,7 +1,143 @@
-# TODO: fix this test, and add more tests utilizing @fixture
-from prompt_cycle import main
+import os
+import subprocess
+import sys
+import pytest
 
-def test_prompt_cycle():
-    main('data/text.txt', 'core_example.py', '--prompt "generate a response to this text"', '--yes')
-    assert True
-    return
+repo = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+def apply(tmp_path, folder, *options, answers=None, **env):
+    env = dict(os.environ, PYTHONPATH=repo, **env)
+    return subprocess.run([sys.executable, os.path.join(repo, 'apply.py'), folder,
+                           'fake_core.py', '--prompt', 'summarise',
+                           *(['--yes'] if answers is None else []),
+                           '--quiet_resume', '--no-cache', *options],
+                          cwd=tmp_path, env=env, capture_output=True, text=True,
+                          input=answers)
+
+def test_prompt_cycle(tmp_path, corpus):
+    run = apply(tmp_path, "corpus")
+    assert run.returncode == 0, run.stdout + run.stderr
+    outputs = sorted(os.listdir(tmp_path / "outputs" / "corpus"))
+    assert outputs == [f"text{i}_work.txt" for i in range(3)]
+    assert "Response" in (tmp_path / "outputs" / "corpus" / "text0_work.txt").read_text()
+
+    # a second run resumes from the checkpoint without sending anything
+    run = apply(tmp_path, "corpus")
+    assert run.returncode == 0, run.stdout + run.stderr
+    assert "3 files already processed, 0 skipped, 0 to process" in run.stdout
+    assert "requests:" not in run.stdout
+
+def test_concurrent_failures_are_counted(tmp_path, corpus):
+    run = apply(tmp_path, "corpus", "--concurrency", "2", "--max_retries", "0",
+                METAPROMPT_FAKE_FAILURE_RATE="1")
+    assert run.returncode == 0, run.stdout + run.stderr
+    assert "0 output files created, 3 failed" in run.stdout
+
+def test_sequential_failures_are_counted(tmp_path, corpus):
+    run = apply(tmp_path, "corpus", "--max_retries", "0",
+                METAPROMPT_FAKE_FAILURE_RATE="1")
+    assert run.returncode == 0, run.stdout + run.stderr
+    assert "0 output files created, 3 failed" in run.stdout
+    assert not (tmp_path / "outputs" / "corpus").exists() or \
+        not os.listdir(tmp_path / "outputs" / "corpus")
+
+def test_concurrency_must_be_positive(capsys):
+    from metaprompt import apply
+    for value in ("0", "-2"):
+        with pytest.raises(SystemExit):
+            apply.build_parser().parse_args(["corpus", "--concurrency", value])
+        assert "must be at least 1" in capsys.readouterr().err
+
+def test_main_in_process(tmp_path, corpus, monkeypatch):
+    from metaprompt import apply, utils
+    monkeypatch.chdir(tmp_path)
+    args = apply.build_parser().parse_args(["corpus"])
+    args.core = "fake_core.py"
+    core = utils.run_core_script(args)
+    assert sorted(core) == ["chat_session", "history", "model"]
+    counts = apply.main(["corpus", "fake_core.py", "--prompt", "summarise",
+                         "--yes", "--no-cache", "--concurrency", "2"])
+    assert counts == {'done': 3, 'failed': 0}
+
+def test_prefetch_keeps_input_order(tmp_path, corpus):
+    from metaprompt import checkpoint
+    run = apply(tmp_path, "corpus", "--prefetch", "2", "--sort", "forward",
+                answers="y\n" * 3)
+    assert run.returncode == 0, run.stdout + run.stderr
+    with checkpoint.open_store(str(tmp_path / "database" / "fake_core.sqlite"),
+                               readonly=True) as store:
+        keys = sorted(store.keys(), key=lambda k: store[k]['input_index'].start)
+        assert keys == [f"corpus/text{i}.txt" for i in range(3)]
+        for i, key in enumerate(keys):
+            turns = store.file_turns(key)
+            assert f"text number {i}" in turns[0].parts[0].text
+
+def test_duplicates_reuse_representative_output(tmp_path, corpus):
+    (corpus / "text3.txt").write_text("text number 0\n")
+    for options in ([], ["--concurrency", "2"]):
+        run = apply(tmp_path, "corpus", "--dedup", "exact", "--sort", "forward",
+                    "--ignore_checkpoint", *options)
+        assert run.returncode == 0, run.stdout + run.stderr
+        assert "1 requests avoided" in run.stdout
+        assert "requests: 3" in run.stdout
+        outputs = tmp_path / "outputs" / "corpus"
+        assert (outputs / "text3_work.txt").read_text() == \
+            (outputs / "text0_work.txt").read_text()
+
+def test_packed_files_get_their_own_outputs(tmp_path, corpus):
+    from metaprompt import checkpoint
+    (corpus / "big.txt").write_text("word " * 400)
+    run = apply(tmp_path, "corpus", "--pack_tokens", "100", "--sort", "forward")
+    assert run.returncode == 0, run.stdout + run.stderr
+    assert "3 files answered in 1 requests, 1 sent alone" in run.stdout
+    assert "requests: 2" in run.stdout
+    outputs = tmp_path / "outputs" / "corpus"
+    assert len(os.listdir(outputs)) == 4
+    assert "<answer" not in (outputs / "text1_work.txt").read_text()
+    with checkpoint.open_store(str(tmp_path / "database" / "fake_core.sqlite"),
+                               readonly=True) as store:
+        first, answer = store.file_turns(os.path.join("corpus", "text1.txt"))
+        assert "text number 1" in first.parts[0].text
+        assert answer.parts[0].text.startswith("Response")
+
+def test_packing_needs_yes(tmp_path, corpus):
+    run = apply(tmp_path, "corpus", "--pack_tokens", "100", answers="")
+    assert run.returncode == 2
+    assert "--pack_tokens needs --yes" in run.stderr
+    assert not (tmp_path / "outputs").exists()
+
+def test_unparsed_pack_answers_fall_back(tmp_path, corpus, monkeypatch):
+    from metaprompt import apply, fake
+    respond = fake.FakeGenerativeModel.respond
+    def drop_second(self, text):
+        return respond(self, text).replace('<answer id="2">', '<answer id="x">')
+    monkeypatch.setattr(fake.FakeGenerativeModel, 'respond', drop_second)
+    monkeypatch.chdir(tmp_path)
+    counts = apply.main(["corpus", "fake_core.py", "--prompt", "summarise",
+                         "--yes", "--no-cache", "--pack_tokens", "100"])
+    assert counts == {'done': 3, 'failed': 0}
+    outputs = tmp_path / "outputs" / "corpus"
+    assert all("<answer" not in (outputs / name).read_text()
+               for name in os.listdir(outputs))
+
+def test_interactive_chunked_files_are_reviewed(tmp_path):
+    folder = tmp_path / "big"
+    folder.mkdir()
+    (folder / "long.txt").write_text("word " * 400)
+    output = tmp_path / "outputs" / "big" / "long_work.txt"
+    run = apply(tmp_path, "big", "--chunk_tokens", "100", answers="s\n")
+    assert run.returncode == 0, run.stdout + run.stderr
+    assert "Merged output of big/long.txt" in run.stdout
+    assert not output.exists()
+    run = apply(tmp_path, "big", "--chunk_tokens", "100", answers="y\n")
+    assert run.returncode == 0, run.stdout + run.stderr
+    assert output.exists()
+
+def test_interactive_chunk_failures_are_counted(tmp_path):
+    folder = tmp_path / "big"
+    folder.mkdir()
+    (folder / "long.txt").write_text("word " * 400)
+    run = apply(tmp_path, "big", "--chunk_tokens", "100", "--max_retries", "0",
+                answers="", METAPROMPT_FAKE_FAILURE_RATE="1")
+    assert run.returncode == 0, run.stdout + run.stderr
+    assert "Failed big/long.txt" in run.stdout
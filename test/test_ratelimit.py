@@ -0,0 +1,78 @@
+import io
+import time
+import pytest
+from google.api_core import exceptions
+from metaprompt import ratelimit, utils
+from metaprompt.fake import FakeGenerativeModel
+
+@pytest.fixture
+def scheduler():
+    scheduler = ratelimit.configure(max_retries=3, backoff=0)
+    yield scheduler
+    ratelimit.configure()
+
+def flaky(model, failures:int, after_chunks:int=None):
+    """
+    Make the next `failures` requests of the fake model throttle, up front
+    or, with `after_chunks`, partway through a streamed response.
+    """
+    generate = model.generate
+    left = [failures]
+    def wrapped(contents, stream=False):
+        response = generate(contents, stream)
+        if left[0] <= 0:
+            return response
+        left[0] -= 1
+        if after_chunks is None:
+            raise exceptions.ResourceExhausted("throttled")
+        chunks = list(response)[:after_chunks]
+        def broken():
+            yield from chunks
+            raise exceptions.ResourceExhausted("throttled mid-stream")
+        response.__class__ = type('Broken', (type(response),),
+                                  {'__iter__': lambda self: broken()})
+        return response
+    model.generate = wrapped
+
+def test_retries_leave_no_partial_turns(scheduler):
+    model = FakeGenerativeModel()
+    flaky(model, 2)
+    chat = model.start_chat()
+    response = utils.send_message(chat, "hello")
+    assert len(chat.history) == 2
+    assert chat.history[1].parts[0].text == response.parts[0].text
+
+    flaky(model, 1, after_chunks=2)
+    out_f = io.StringIO()
+    utils.send_message(chat, "again", stream=True, out_f=out_f, echo=False)
+    assert len(chat.history) == 4
+    assert out_f.getvalue().count("again") == 1
+
+def test_gives_up_after_max_retries(scheduler):
+    model = FakeGenerativeModel(failure_rate=1)
+    chat = model.start_chat()
+    with pytest.raises(exceptions.ServiceUnavailable):
+        utils.send_message(chat, "hello")
+    assert model.calls == 4 and len(chat.history) == 0
+
+def test_adaptive_concurrency_aimd():
+    concurrency = ratelimit.AdaptiveConcurrency(8, cooldown=60)
+    concurrency.acquire()
+    concurrency.release(throttled=True)
+    assert concurrency.limit == 4
+    concurrency.acquire()
+    concurrency.release(throttled=True) # within the cooldown, counted once
+    assert concurrency.limit == 4
+    for _ in range(4):
+        concurrency.acquire()
+        concurrency.release()
+    assert 4.9 < concurrency.limit < 5.1
+
+def test_token_bucket_paces_requests():
+    limiter = ratelimit.RateLimiter(rate=50, burst=1)
+    start = time.monotonic()
+    for _ in range(6):
+        limiter.acquire()
+    assert time.monotonic() - start >= 0.09
+    limiter.charge(-10) # refunds never overfill the bucket
+    assert limiter.tokens <= limiter.burst
@@ -0,0 +1,72 @@
+import os
+from google.generativeai import protos
+from metaprompt import checkpoint, search
+
+def turn(role, text):
+    return protos.Content(role=role, parts=[protos.Part(text=text)])
+
+def test_incremental_index_and_ranking(tmp_path):
+    persist = str(tmp_path / "core.py")
+    history = [turn('user', 'core instructions'), turn('model', 'ok'),
+               turn('user', 'the refund policy of shop a'),
+               turn('model', 'refunds are accepted within 30 days')]
+    with checkpoint.open_store(persist) as store, \
+            search.SearchIndex(str(tmp_path / "search.sqlite")) as index:
+        store.append_history(history)
+        store.put('a.txt', 2, 4, final=True)
+        assert index.update(store) == 4
+        assert index.update(store) == 0
+
+        history += [turn('user', 'shipping times'),
+                    turn('model', 'shipping takes a week; no refund on shipping')]
+        store.append_history(history)
+        store.put('b.txt', 4, 6)
+        assert index.update(store) == 2
+
+        results = index.search("refund")
+        assert sorted((r['file'], r['idx']) for r in results) == \
+            [('a.txt', 2), ('a.txt', 3), ('b.txt', 5)]
+        assert results[0]['score'] <= results[-1]['score']
+        assert search.MATCH_START in results[0]['snippet']
+
+        outputs = index.search("shipping", role='model')
+        assert [(r['file'], r['idx']) for r in outputs] == [('b.txt', 5)]
+        assert index.search("instructions")[0]['file'] is None
+        assert index.search("refund OR weekly", raw=True)
+
+def test_cli_catches_up_on_stores(tmp_path):
+    folder = tmp_path / "database"
+    folder.mkdir()
+    with checkpoint.open_store(str(folder / "core.py")) as store:
+        store.append_history([turn('user', 'alpha beta'), turn('model', 'gamma')])
+        store.put('x.txt', 0, 2, final=True)
+    (folder / "notes.sqlite").write_bytes(b"")
+    index = str(tmp_path / "search.sqlite")
+    results = search.main(["gamma", "--index", index, "--update", str(folder)])
+    assert [(r['file'], r['role']) for r in results] == [('x.txt', 'model')]
+    assert search.main(["alpha", "--index", index, "--update"])[0]['idx'] == 0
+
+def test_shelve_checkpoints_are_skipped(tmp_path, capsys):
+    import shelve
+    with shelve.open(str(tmp_path / "old.shelve")) as shelf:
+        shelf['history'] = [turn('user', 'a'), turn('model', 'b')]
+    before = sorted(p.name for p in tmp_path.iterdir())
+    assert search.find_stores([str(tmp_path)]) == []
+    assert sorted(p.name for p in tmp_path.iterdir()) == before
+    assert "python -m metaprompt.checkpoint" in capsys.readouterr().out
+    checkpoint.main([str(tmp_path)])
+    assert search.find_stores([str(tmp_path)]) == [str(tmp_path / "old.sqlite")]
+
+def test_recreated_store_is_indexed_again(tmp_path):
+    path = str(tmp_path / "core.sqlite")
+    with search.SearchIndex(str(tmp_path / "search.sqlite")) as index:
+        with checkpoint.CheckpointStore(path) as store:
+            store.append_history([turn('user', 'old words'), turn('model', 'old')])
+            index.update(store)
+        os.remove(path)
+        with checkpoint.CheckpointStore(path) as store:
+            store.append_history([turn('user', 'new words')])
+            assert index.update(store) == 1
+        assert index.indexed(path) == 1
+        assert index.search("old") == []
+        assert [r['idx'] for r in index.search("words")] == [0]
@@ -0,0 +1,41 @@
+import argparse
+import pytest
+from metaprompt import checkpoint, sharding
+
+def test_shards_are_stable_under_insertions():
+    files = [f"corpus/text{i}.txt" for i in range(200)]
+    shards = [set(sharding.select(files, (i, 4))) for i in range(4)]
+    assert set().union(*shards) == set(files)
+    assert sum(map(len, shards)) == len(files)
+    assert all(30 < len(shard) < 70 for shard in shards)
+    more = [f"corpus/new{i}.txt" for i in range(50)] + files
+    assert all(shard <= set(sharding.select(more, (i, 4)))
+               for i, shard in enumerate(shards))
+    with pytest.raises(argparse.ArgumentTypeError):
+        sharding.parse_shard("4/4")
+
+def test_merged_shards_resume_as_one(tmp_path, corpus, run_apply):
+    for i in range(3, 6):
+        (corpus / f"text{i}.txt").write_text(f"text number {i}\n")
+    done = [run_apply("--shard", f"{i}/2")['done'] for i in range(2)]
+    assert sum(done) == 6 and all(done)
+    shards = [str(tmp_path / "database" / f"fake_core.shard{i}-of-2.sqlite")
+              for i in range(2)]
+    into = str(tmp_path / "database" / "fake_core.sqlite")
+    totals = sharding.main([*shards, "--into", into])
+    assert totals['added'] == 6 and totals['kept'] == 0
+    with checkpoint.open_store(into, readonly=True) as store, \
+            checkpoint.open_store(shards[0], readonly=True) as shard:
+        core = len(store) - 2 * 6
+        assert len(store.finalized()) == 6
+        for key in store.finalized():
+            assert open(key).read() in store.file_turns(key)[0].parts[0].text
+        assert store.texts(0, core) == shard.texts(0, core)
+    assert sharding.merge(shards, into) == {'turns': 0, 'added': 0, 'kept': 6}
+
+    # shards merged again bring only what they gained
+    for i in range(6, 10):
+        (corpus / f"text{i}.txt").write_text(f"text number {i}\n")
+    assert sum(run_apply("--shard", f"{i}/2")['done'] for i in range(2)) == 4
+    assert sharding.merge(shards, into) == {'turns': 8, 'added': 4, 'kept': 6}
+    assert run_apply() == {'done': 0, 'failed': 0}
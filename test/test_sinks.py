@@ -0,0 +1,144 @@
+import argparse
+import functools
+import json
+import os
+import sys
+import pytest
+from google.generativeai import protos
+from metaprompt import checkpoint, search, sinks
+
+def turn(role, text):
+    return protos.Content(role=role, parts=[protos.Part(text=text)])
+
+def lines(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+def test_jsonl_sink_run(tmp_path, corpus, run_apply):
+    main = functools.partial(run_apply, "--sink", "jsonl", "--sink_flush", "2")
+    assert main("--concurrency", "2") == {'done': 3, 'failed': 0}
+    records = lines(tmp_path / "outputs" / "fake_core.jsonl")
+    assert sorted(r['source'] for r in records) == \
+        [f"corpus/text{i}.txt" for i in range(3)]
+    assert all(r['prompt'] == 'summarise' and r['output'] == r['turns'][-1]['text']
+               and r['response_tokens'] and r['seconds'] is not None
+               for r in records)
+    assert not (tmp_path / "outputs" / "corpus").exists()
+    assert main() == {'done': 0, 'failed': 0}
+    assert len(lines(tmp_path / "outputs" / "fake_core.jsonl")) == 3
+
+def test_packed_records_share_usage(tmp_path, corpus, run_apply):
+    assert run_apply("--sink", "jsonl", "--pack_tokens", "100") == \
+        {'done': 3, 'failed': 0}
+    records = lines(tmp_path / "outputs" / "fake_core.jsonl")
+    assert len(records) == 3
+    assert all(r['prompt_tokens'] and r['response_tokens']
+               and r['seconds'] is not None for r in records)
+
+def test_crash_keeps_sink_and_checkpoint_in_step(tmp_path):
+    args = argparse.Namespace(prompt="p")
+    path = str(tmp_path / "out.jsonl")
+    store = checkpoint.CheckpointStore(str(tmp_path / "store.sqlite"))
+    store.sink, store.commit_every = sinks.JsonlSink(path), 2
+    index = search.configure(str(tmp_path / "search.sqlite"))
+    try:
+        history = [turn('user', 'core')]
+        for key in "abc":
+            history += [turn('user', key), turn('model', key.upper())]
+            store.append_history(history)
+            store.put(key, len(history) - 2, len(history), final=True)
+            store.sink.write(key, args, [(0, 'model', key.upper())])
+        # the index only holds what was committed
+        assert index.indexed(store.path) == 5
+    finally:
+        search.configure()
+    store.connection.close() # a crash: c is neither committed nor written
+    with checkpoint.CheckpointStore(str(tmp_path / "store.sqlite")) as store:
+        assert store.finalized() == {'a', 'b'}
+        assert len(store) == 5 # the core and the turns of a and b
+    assert [r['source'] for r in lines(path)] == ['a', 'b']
+
+def test_torn_jsonl_line_is_dropped(tmp_path):
+    path = tmp_path / "out.jsonl"
+    path.write_text('{"source": "a"}\n{"source": "b"}\n{"sour')
+    sinks.JsonlSink(str(path))
+    assert [r['source'] for r in lines(path)] == ['a', 'b']
+
+def test_parquet_sink(tmp_path):
+    parquet = pytest.importorskip("pyarrow.parquet")
+    sink = sinks.ParquetSink(str(tmp_path / "out.parquet"))
+    args = argparse.Namespace(prompt="p")
+    for key in "ab":
+        sink.write(key, args, [(0, 'user', key), (1, 'model', key.upper())],
+                   prompt_tokens=3)
+    sink.close()
+    sink.write('c', args, [(0, 'user', 'c')])
+    sink.close()
+    table = parquet.read_table(str(tmp_path / "out.parquet")).to_pydict()
+    assert sorted(table['source']) == ['a', 'b', 'c']
+    assert sorted(table['output']) == ['A', 'B', 'c']
+    assert table['turns'][table['source'].index('a')][1] == \
+        {'idx': 1, 'role': 'model', 'text': 'A'}
+
+class FakeType:
+    def __init__(self, *accepted, fields=None):
+        self.accepted, self.fields = accepted, fields
+
+    def check(self, value):
+        if value is None:
+            return
+        assert isinstance(value, self.accepted), (value, self.accepted)
+        if self.fields is not None:
+            assert set(value) == set(self.fields)
+            for name, kind in self.fields.items():
+                kind.check(value[name])
+        if isinstance(value, list):
+            for item in value:
+                self.item.check(item)
+
+def fake_pyarrow():
+    """
+    The parts of pyarrow that `ParquetSink` uses, checking rows against the
+    schema and writing them as JSON.
+    """
+    import types
+    pyarrow = types.ModuleType("pyarrow")
+    pyarrow.int64 = lambda: FakeType(int)
+    pyarrow.float64 = lambda: FakeType(int, float)
+    pyarrow.string = lambda: FakeType(str)
+    pyarrow.struct = lambda fields: FakeType(dict, fields=dict(fields))
+    def list_(item):
+        kind = FakeType(list)
+        kind.item = item
+        return kind
+    pyarrow.list_ = list_
+    pyarrow.schema = dict
+    def from_pylist(rows, schema):
+        for row in rows:
+            assert set(row) == set(schema)
+            for name, kind in schema.items():
+                kind.check(row[name])
+        return rows
+    pyarrow.Table = types.SimpleNamespace(from_pylist=from_pylist)
+    parquet = types.ModuleType("pyarrow.parquet")
+    def write_table(rows, path):
+        with open(path, 'w') as f:
+            json.dump(rows, f)
+    parquet.write_table = write_table
+    pyarrow.parquet = parquet
+    return pyarrow, parquet
+
+def test_parquet_schema_fits_records(tmp_path, monkeypatch):
+    pyarrow, parquet = fake_pyarrow()
+    monkeypatch.setitem(sys.modules, "pyarrow", pyarrow)
+    monkeypatch.setitem(sys.modules, "pyarrow.parquet", parquet)
+    sink = sinks.ParquetSink(str(tmp_path / "out.parquet"))
+    args = argparse.Namespace(prompt="p")
+    sink.write('a', args, [(0, 'user', 'a'), (1, 'model', 'A')],
+               prompt_tokens=3, response_tokens=1, seconds=0.5, copied_from='b')
+    sink.write('c', args, [(0, 'user', 'c')])
+    sink.close()
+    parts = [name for name in os.listdir(tmp_path / "out.parquet")]
+    assert len(parts) == 1 and parts[0].endswith('.parquet')
+    rows = json.loads((tmp_path / "out.parquet" / parts[0]).read_text())
+    assert [row['source'] for row in rows] == ['a', 'c']
@@ -0,0 +1,25 @@
+import json
+from types import SimpleNamespace
+from metaprompt import telemetry
+
+def test_trace_and_summary(tmp_path):
+    trace = telemetry.Telemetry(str(tmp_path / "trace.jsonl"))
+    with trace.phase('checkpoint'):
+        pass
+    assert list(trace.timed(iter('abc'), 'discovery')) == ['a', 'b', 'c']
+    usage = SimpleNamespace(prompt_token_count=100, candidates_token_count=20,
+                            total_token_count=120)
+    for latency in (1.0, 2.0, 3.0):
+        trace.record_request(SimpleNamespace(usage_metadata=usage), latency)
+    trace.record_file('a.txt', 3.0)
+    trace.close()
+    events = [json.loads(line) for line in open(tmp_path / "trace.jsonl")]
+    assert [e['event'] for e in events] == ['phase', 'phase'] + 3 * ['request'] + ['file']
+    assert events[1]['items'] == 3
+    summary = trace.summary()
+    assert "latency s: p50 2.000, p90 3.000, p99 3.000" in summary
+    assert "tokens: 300 prompt, 60 candidates, 360 total" in summary
+
+def test_percentile():
+    assert telemetry.percentile([3, 1, 2, 4], 50) == 2
+    assert telemetry.percentile([3, 1, 2, 4], 100) == 4
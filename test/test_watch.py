@@ -0,0 +1,49 @@
+import functools
+import threading
+import time
+from metaprompt import apply, utils, watch
+
+def test_content_keys_follow_edits_and_renames(tmp_path, corpus, run_apply):
+    main = functools.partial(run_apply, "--key_by", "content")
+    assert main() == {'done': 3, 'failed': 0}
+    assert main() == {'done': 0, 'failed': 0}
+
+    (corpus / "text0.txt").write_text("an edited text\n")
+    (corpus / "text1.txt").rename(corpus / "moved.txt")
+    assert main() == {'done': 1, 'failed': 0}
+    outputs = tmp_path / "outputs" / "corpus"
+    assert (outputs / "moved_work.txt").read_text() == \
+        (outputs / "text1_work.txt").read_text()
+    assert "edited" in (outputs / "text0_work.txt").read_text()
+    assert main() == {'done': 0, 'failed': 0}
+
+    # another prompt is another setup
+    assert main("--prompt", "translate") == {'done': 3, 'failed': 0}
+
+def test_collector_debounces():
+    collector = watch.ChangeCollector(debounce=0.05)
+    assert collector.batch(timeout=0.01) == []
+    for path in ["a", "b", "a"]:
+        collector.add(path)
+    start = time.monotonic()
+    assert collector.batch() == ["a", "b"]
+    assert time.monotonic() - start >= 0.04
+
+def test_watch_processes_changes(tmp_path, corpus, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    args = apply.build_parser().parse_args(
+        ["corpus", "fake_core.py", "--prompt", "summarise", "--yes", "--no-cache",
+         "--no-index", "--key_by", "content", "--watch_debounce", "0.2"])
+    utils.resolve_core(args)
+    core = utils.run_core_script(args)
+    assert apply.run(args, core)['done'] == 3
+    def change():
+        time.sleep(0.5)
+        (corpus / "new.txt").write_text("a new text\n")
+        (corpus / "text2.txt").write_text("text number 2, edited\n")
+    writer = threading.Thread(target=change)
+    writer.start()
+    counts = watch.watch(args, ["corpus"], apply.run, core, timeout=2)
+    writer.join()
+    assert counts == {'done': 2, 'failed': 0}
+    assert (tmp_path / "outputs" / "corpus" / "new_work.txt").exists()
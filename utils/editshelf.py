@@ -1,79 +1,177 @@
-import streamlit as st
-import shelve
+"""
+Read-only browser for checkpoint databases.
+
+    streamlit run utils/editshelf.py -- database/core_example.sqlite
+
+Databases are opened in place, read-only, from a path (a folder lists the
+checkpoints in it). File records are listed a page at a time, a record's
+turns are only loaded when it is expanded, and the history is read one slice
+at a time. Open databases, pages and slices are cached across reruns until
+the database changes on disk.
+
+SQLite checkpoints (`.sqlite`) are read from their plain columns without
+unpickling. Legacy shelve checkpoints can be browsed too, but their history
+is a single pickle and is loaded whole the first time it is viewed; open
+them once with `apply.py` to migrate them.
+"""
+import dbm
+import itertools
 import os
-import pandas as pd
-from rich.console import Console
-
-def open_shelve_db(file_path):
-    """Open a shelve database, removing the .db extension if necessary."""
-    if file_path.endswith('.db'):
-        file_path = file_path[:-3]
-    return shelve.open(file_path)
-
-def display_shelve_contents(shelf):
-    """Display and edit shelve contents, excluding 'history' key."""
-    data = {"Key": [], "Value": []}
-    for key in list(shelf.keys()):
-        if key == 'history':
-            continue
-        value = shelf[key]
-        data["Key"].append(key)
-        data["Value"].append(value)
-    
-    # Display the contents as a table
-    df = pd.DataFrame(data)
-    st.dataframe(df)
-
-def add_new_entry_to_shelve(shelf):
-    """Add a new key-value pair to the shelve."""
-    with st.expander("Add New Entry"):
-        new_key = st.text_input("New Key")
-        new_value = st.text_area("New Value")
-        if st.button("Add to Shelve"):
-            if new_key and new_value:
-                shelf[new_key] = new_value
-                st.success(f"Added {new_key} to the shelve.")
-            else:
-                st.error("Both key and value are required.")
-
-def view_history(shelf):
-    """View a range of the history key."""
-    if 'history' not in shelf:
-        st.error("No history found in the shelve database.")
+import shelve
+import sys
+import streamlit as st
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from metaprompt import checkpoint
+
+PAGE_SIZES = (25, 50, 100, 500)
+
+class ShelveReader:
+    """
+    The `CheckpointStore` reading methods over a legacy shelve checkpoint.
+    Keys are listed from the underlying dbm without unpickling any values.
+    """
+
+    def __init__(self, path:str):
+        self.shelf = shelve.open(path, flag='r')
+        self.all_keys = sorted(key.decode('utf-8') for key in self.shelf.dict.keys()
+                               if key != b'history')
+        self._history = None
+
+    def matching(self, pattern:str=None):
+        import fnmatch
+        return (key for key in self.all_keys
+                if pattern is None or fnmatch.fnmatchcase(key, pattern))
+
+    def count(self, pattern:str=None)->int:
+        return sum(1 for _ in self.matching(pattern))
+
+    def page(self, offset:int=0, limit:int=50, pattern:str=None)->list:
+        return [(key, None, None, None) for key in
+                itertools.islice(self.matching(pattern), offset, offset + limit)]
+
+    def __getitem__(self, key:str)->dict:
+        return self.shelf[key]
+
+    def __len__(self):
+        return len(self.history())
+
+    def history(self):
+        if self._history is None:
+            import google.ai # used in unpickling
+            self._history = self.shelf['history'] if 'history' in self.shelf else []
+        return self._history
+
+    def texts(self, start:int=0, stop:int=None)->list:
+        history = self.history()
+        stop = len(history) if stop is None else stop
+        return [(i, turn.role, checkpoint.turn_text(turn))
+                for i, turn in enumerate(history[start:stop], start)]
+
+DBM_SUFFIXES = ('.db', '.dat', '.dir', '.bak')
+
+def database_path(path:str)->str:
+    """
+    The path to open: shelve databases are named without their dbm suffix.
+    """
+    root, suffix = os.path.splitext(path)
+    if suffix in DBM_SUFFIXES and dbm.whichdb(root):
+        return root
+    return path
+
+def find_databases(folder:str)->list:
+    paths = {database_path(os.path.join(folder, name))
+             for name in os.listdir(folder)}
+    return sorted(path for path in paths if path.endswith(('.sqlite', '.shelve')))
+
+def modified(path:str)->float:
+    """
+    Last change of a database, including its SQLite write-ahead log or dbm
+    files.
+    """
+    return max(os.path.getmtime(p) for p in
+               [path, path + '-wal', *(path + s for s in DBM_SUFFIXES)]
+               if os.path.exists(p))
+
+@st.cache_resource(max_entries=4)
+def open_database(path:str, mtime:float):
+    """
+    Open a database read-only; `mtime` makes a changed database reopen.
+    """
+    if path.endswith('.sqlite'):
+        return checkpoint.CheckpointStore(path, readonly=True)
+    return ShelveReader(path)
+
+@st.cache_data(max_entries=64)
+def load_page(path:str, mtime:float, offset:int, limit:int, pattern:str):
+    database = open_database(path, mtime)
+    return database.count(pattern), database.page(offset, limit, pattern)
+
+@st.cache_data(max_entries=64)
+def load_texts(path:str, mtime:float, start:int, stop:int)->list:
+    return open_database(path, mtime).texts(start, stop)
+
+def show_turns(turns:list):
+    for idx, role, text in turns:
+        st.caption(f"{idx} · {role}")
+        st.text(text)
+
+def browse_records(path:str, mtime:float):
+    """List file records page by page; expand one to load its turns."""
+    pattern = st.text_input("Filter keys (glob)", value="") or None
+    page_size = st.selectbox("Records per page", PAGE_SIZES, index=1)
+    total, _ = load_page(path, mtime, 0, 0, pattern)
+    pages = max(-(-total // page_size), 1)
+    page = st.number_input(f"Page (of {pages}, {total} records)",
+                           min_value=1, max_value=pages, value=1)
+    _, rows = load_page(path, mtime, (page - 1) * page_size, page_size, pattern)
+    st.dataframe([{'key': key, 'start': start, 'stop': stop,
+                   'final': None if final is None else bool(final)}
+                  for key, start, stop, final in rows],
+                 use_container_width=True)
+
+    keys = [row[0] for row in rows]
+    key = st.selectbox("Expand record", [None] + keys,
+                       format_func=lambda key: "-" if key is None else key)
+    if key is None:
         return
-    history = shelf['history']
-    start_index = st.number_input("Start Index", min_value=0, max_value=len(history)-1, value=0)
-    end_index = st.number_input("End Index", min_value=start_index+1, max_value=len(history), value=min(start_index+10, len(history)))
+    record = open_database(path, mtime)[key]
+    st.write(record)
+    show_turns(load_texts(path, mtime, record['input_index'].start,
+                          record['input_index'].stop))
 
-    if st.button("View History"):
-        for i in range(start_index, end_index):
-            st.write(f"History Item {i}:")
-            st.text(history[i].parts[0].text)
+def browse_history(path:str, mtime:float):
+    """View a slice of the history."""
+    length = len(open_database(path, mtime))
+    if not length:
+        st.info("The history is empty.")
+        return
+    start = st.number_input("Start Index", min_value=0, max_value=length - 1, value=0)
+    stop = st.number_input("End Index", min_value=start + 1, max_value=length,
+                           value=min(start + 10, length))
+    show_turns(load_texts(path, mtime, start, stop))
 
 # Streamlit app layout
-st.title("Shelve Database Editor")
-
-uploaded_file = st.file_uploader("Choose a shelve .db file", type="db")
-
-if uploaded_file is not None:
-    # Save the uploaded file temporarily
-    temp_file_path = f"./temp_{uploaded_file.name}"
-    with open(temp_file_path, "wb") as f:
-        f.write(uploaded_file.getbuffer())
-    
-    # Open the shelve database
-    with open_shelve_db(temp_file_path) as shelf:
-        st.write("Opened shelve database successfully.")
-
-        # Display and edit shelve contents
-        display_shelve_contents(shelf)
-        
-        # Option to add a new entry
-        add_new_entry_to_shelve(shelf)
-
-        # Option to view a range of history
-        with st.expander("History View"):
-            view_history(shelf)
-
-    # Remove temporary file after closing shelve
-    os.remove(temp_file_path)
+st.title("Checkpoint Browser")
+
+default = sys.argv[1] if len(sys.argv) > 1 else "database"
+path = st.text_input("Checkpoint database or folder", value=default)
+if os.path.isdir(path):
+    found = find_databases(path)
+    if not found:
+        st.error(f"No checkpoint databases in {path}.")
+        st.stop()
+    path = st.selectbox("Database", found)
+path = database_path(path)
+if not (os.path.isfile(path) or dbm.whichdb(path)):
+    st.error(f"{path} not found.")
+    st.stop()
+if not path.endswith('.sqlite'):
+    st.warning("Legacy shelve checkpoint: its history is loaded whole when "
+               "viewed. Run apply.py on it once to migrate it to SQLite.")
+mtime = modified(path)
+
+browse_records(path, mtime)
+# a checkbox rather than an expander, whose contents would run collapsed
+if st.checkbox("History View"):
+    browse_history(path, mtime)